@@ -0,0 +1,143 @@
+"""
+Benchmarks the parser backends used to load ratings files.
+
+Generates pipe-separated ratings files of the requested sizes and loads each
+one with read_ratings_file() once per available backend, reporting rows per
+second and peak memory. Every load runs in a fresh subprocess so the memory
+figures of one backend are not inflated by another.
+
+Usage:
+    python benchmark_parsers.py                          # 1M ratings
+    python benchmark_parsers.py 1000000 10000000 100000000
+    python benchmark_parsers.py --compress gz 1000000    # .txt.gz input
+    python benchmark_parsers.py --compact 10000000       # memory-budget mode
+"""
+import argparse
+import bz2
+import gzip
+import json
+import lzma
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import movie_data
+
+# Rows written per block while generating a file
+GENERATE_BLOCK = 1_000_000
+
+COMPRESSORS = {"gz": gzip.open, "bz2": bz2.open, "xz": lzma.open}
+
+
+def generate_ratings_file(path, n_rows, seed=0):
+    """Writes n_rows random half-star ratings over a 20k-title catalogue to path."""
+    rng = np.random.default_rng(seed)
+    titles = np.array([f"Movie {i} ({1950 + i % 70})" for i in range(20_000)], dtype=object)
+    n_users = max(n_rows // 20, 1)
+
+    with open(path, "w") as f:
+        pass
+    written = 0
+    while written < n_rows:
+        size = min(GENERATE_BLOCK, n_rows - written)
+        block = pd.DataFrame({
+            "movie_name": titles[rng.integers(0, len(titles), size)],
+            "rating": rng.integers(0, 11, size) / 2,
+            "user_id": rng.integers(1, n_users + 1, size),
+        })
+        block.to_csv(path, sep="|", header=False, index=False, mode="a")
+        written += size
+
+
+def dataset_path(data_dir, n_rows, compress):
+    """Generates (once) and returns the benchmark file for n_rows ratings."""
+    path = os.path.join(data_dir, f"ratings_{n_rows}.txt")
+    if not os.path.exists(path):
+        print(f"Generating {n_rows:,} ratings -> {path}")
+        generate_ratings_file(path, n_rows)
+    if not compress:
+        return path
+
+    compressed = f"{path}.{compress}"
+    if not os.path.exists(compressed):
+        print(f"Compressing -> {compressed}")
+        with open(path, "rb") as src, COMPRESSORS[compress](compressed, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1 << 24)
+    return compressed
+
+
+def peak_rss_bytes():
+    """Returns this process's peak resident set size in bytes, or None where unsupported."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_child(backend, path, compact):
+    """Loads one file with one backend and prints the measurement as JSON (subprocess entry point)."""
+    baseline = peak_rss_bytes()
+    start = time.perf_counter()
+    ratings = movie_data.read_ratings_file(path, backend=backend, compact=compact == "compact")
+    seconds = time.perf_counter() - start
+    peak = peak_rss_bytes()
+    print(json.dumps({
+        "rows": len(ratings),
+        "seconds": seconds,
+        "peak_rss": peak,
+        "parse_rss": None if peak is None else peak - baseline,
+        "frame_bytes": int(ratings.memory_usage(deep=True).sum()),
+        "bytes_per_rating": movie_data.bytes_per_rating(ratings),
+    }))
+
+
+def measure(backend, path, compact):
+    """Runs run_child() in a fresh interpreter and returns its measurement."""
+    mode = "compact" if compact else "default"
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", backend, path, mode],
+                         check=True, capture_output=True, text=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare ratings parser backends.")
+    parser.add_argument("sizes", nargs="*", type=int, default=[1_000_000], help="ratings per generated file")
+    parser.add_argument("--compress", choices=["gz", "bz2", "xz"], help="benchmark compressed input")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "movie_recommender_bench"),
+                        help="where generated files are kept between runs")
+    parser.add_argument("--compact", action="store_true", help="load with the compact ratings representation")
+    parser.add_argument("--child", nargs=3, metavar=("BACKEND", "PATH", "MODE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(*args.child)
+        return
+
+    backends = ["pandas"] + (["pyarrow"] if movie_data.pa_csv is not None else [])
+    if len(backends) == 1:
+        print("pyarrow is not installed; only the pandas backend will be measured.")
+    os.makedirs(args.data_dir, exist_ok=True)
+
+    print(f"\n{'Rows':>12} {'Backend':<8} {'Seconds':>9} {'Rows/s':>12} {'Parse RSS MB':>13} {'Frame MB':>9} "
+          f"{'B/rating':>9}")
+    for n_rows in args.sizes:
+        path = dataset_path(args.data_dir, n_rows, args.compress)
+        for backend in backends:
+            result = measure(backend, path, args.compact)
+            parse_mb = "n/a" if result["parse_rss"] is None else f"{result['parse_rss'] / 2**20:.0f}"
+            print(f"{result['rows']:>12,} {backend:<8} {result['seconds']:>9.2f} "
+                  f"{result['rows'] / result['seconds']:>12,.0f} {parse_mb:>13} {result['frame_bytes'] / 2**20:>9.0f} "
+                  f"{result['bytes_per_rating']:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
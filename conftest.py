@@ -0,0 +1,72 @@
+"""Datasets shared by the engine tests, loaded through the same readers as the menu."""
+import io
+
+import pandas as pd
+import pytest
+
+import movie_data
+import snapshots
+
+# Movie X is listed once per genre and Movie Z with a genre list; Movie Y is rated but not in the catalogue
+MOVIE_CONTENT = """Action|Comedy|101|Movie Z
+Action|102|Movie X
+Comedy|102|Movie X
+Comedy|104|Movie A
+Drama|105|Movie B
+"""
+RATING_CONTENT = """Movie X|5.0|1
+Movie Y|4.0|1
+Movie Z|5.0|2
+Movie A|3.0|2
+Movie X|4.0|3
+Movie Y|4.0|3
+Movie A|5.0|4
+Movie Z|5.0|4
+Movie B|3.0|4
+"""
+
+
+@pytest.fixture
+def write_dataset(tmp_path):
+    """Returns write(name, content), which writes a dataset file into the test's directory and returns its path."""
+    def write(name, content):
+        path = tmp_path / name
+        path.write_text(content)
+        return str(path)
+    return write
+
+
+@pytest.fixture
+def dataset_files(write_dataset):
+    """The engine test datasets written to files: (movies_path, ratings_path)."""
+    return write_dataset("movies.txt", MOVIE_CONTENT), write_dataset("ratings.txt", RATING_CONTENT)
+
+
+@pytest.fixture
+def load_engine_data(write_dataset):
+    """
+    Returns load(movie_content, rating_content), which installs movie and
+    rating text (by default the engine test datasets) as the current snapshot.
+    """
+    def load(movie_content=MOVIE_CONTENT, rating_content=RATING_CONTENT):
+        snapshots.set_movies(movie_data.read_movies_file(write_dataset("movies.txt", movie_content)))
+        ratings = pd.read_csv(io.StringIO(rating_content), sep="|", header=None,
+                              names=["movie_name", "rating", "user_id"])
+        snapshots.set_ratings(movie_data.clean_ratings(ratings))
+        return snapshots.current_dataset
+    return load
+
+
+@pytest.fixture
+def engine_data(load_engine_data):
+    """The engine test datasets, installed as the current snapshot."""
+    return load_engine_data()
+
+
+@pytest.fixture
+def unload_ratings():
+    """Returns unload(), which publishes the loaded movies with no ratings."""
+    def unload():
+        movies = snapshots.current_dataset.movies_df
+        snapshots.publish(snapshots.dataset_with(snapshots.Dataset(snapshots.current_dataset.version), movies=movies))
+    return unload
@@ -0,0 +1,50 @@
+"""
+Measures how well the rankings and recommendations predict held-out ratings.
+
+Loads a movies and a ratings file, splits each user's ratings into folds
+and, for every fold, trains each method on the other folds and scores it on
+the held-out ratings: RMSE of the predicted ratings and precision@k /
+recall@k of the top-k recommendations, counting held-out ratings of at least
+RELEVANT_RATING as movies the user liked. Folds run in parallel in a pool of
+worker processes; the report also gives the time each method took.
+
+Usage:
+    python evaluate_rankers.py gpt_movies.txt gpt_ratings.txt
+    python evaluate_rankers.py MOVIES RATINGS --folds 10 -k 20 --workers 4
+    python evaluate_rankers.py MOVIES RATINGS --methods "global average" "genre affinity"
+"""
+import argparse
+import os
+import time
+
+import evaluation
+import snapshots
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cross-validate the ranking and recommendation methods.")
+    parser.add_argument("movies", help="movies dataset")
+    parser.add_argument("ratings", help="ratings dataset")
+    parser.add_argument("--folds", type=int, default=5, help="folds per user")
+    parser.add_argument("-k", type=int, default=10, help="recommendations scored per user")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--methods", nargs="*", choices=list(evaluation.EVALUATION_METHODS), help="methods to compare")
+    parser.add_argument("--relevant", type=float, default=evaluation.RELEVANT_RATING,
+                        help="lowest held-out rating counted as a liked movie")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the fold split")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    _, ratings = snapshots.load_datasets(args.movies, args.ratings)
+    print(f"Loaded {len(ratings):,} ratings by {ratings['user_id'].nunique():,} users "
+          f"in {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    report = evaluation.evaluate_rankers(args.folds, args.k, args.methods, args.workers, args.seed, args.relevant)
+    print(f"Evaluated {args.folds} folds in {time.perf_counter() - start:.2f}s "
+          f"(method seconds are summed over the folds)\n")
+    print(report.to_string(float_format="{:.4f}".format, na_rep="-"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""
+Cross-validation of the ranking and recommendation methods.
+
+Splits the loaded ratings into per-user folds, trains every method on a
+private snapshot of the other folds and scores RMSE, precision@k and
+recall@k, in worker processes if asked to (see evaluate_rankers()).
+"""
+import pandas as pd
+import numpy as np
+import importlib
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import snapshots
+from movie_data import rating_values
+from movie_recommender import (best_unseen_movies, genre_affinity, movie_affinity, movie_name_ranks, neighbour_scores,
+                               scorable_averages, user_genre_totals)
+from snapshots import dataset_with, genre_matrix, get_neighbour_index, prepare_ratings, publish
+
+
+# Held-out ratings at or above this count as movies the user liked, for precision@k and recall@k
+RELEVANT_RATING = 4.0
+
+# Neighbours whose ratings score the movies of the "similar users" method
+EVALUATION_NEIGHBOURS = 20
+
+
+def split_user_folds(user_ids, folds=5, seed=0):
+    """
+    Assigns every rating to one of `folds` folds, per user.
+
+    Each user's ratings are shuffled and dealt out one fold after another,
+    starting at a random fold, so every user's ratings spread evenly over
+    the folds and users with fewer ratings than folds are not all tested
+    in the first ones.
+
+    Args:
+        user_ids (pd.Series): The user id of each rating.
+
+    Returns: np.ndarray: The fold (0 to folds - 1) of each rating.
+    """
+    rng = np.random.default_rng(seed)
+    codes, keys = pd.factorize(user_ids)
+    order = np.lexsort((rng.random(len(codes)), codes))
+    sorted_codes = codes[order]
+    ranks = np.arange(len(codes)) - np.searchsorted(sorted_codes, sorted_codes)
+    assignment = np.empty(len(codes), dtype=np.intp)
+    assignment[order] = (ranks + rng.integers(0, folds, len(keys))[sorted_codes]) % folds
+    return assignment
+
+
+def rmse(predicted, actual):
+    """Root mean squared error of the finite predictions (NaN without any)."""
+    valid = np.isfinite(predicted)
+    if not valid.any():
+        return np.nan
+    return float(np.sqrt(np.mean((predicted[valid] - actual[valid]) ** 2)))
+
+
+def precision_recall_at_k(users, movies, relevant_users, relevant_movies, k):
+    """
+    Mean precision@k and recall@k over the users with relevant held-out movies.
+
+    Args:
+        users, movies (np.ndarray): The recommended (user code, movie row) pairs, at most k per user.
+        relevant_users, relevant_movies (np.ndarray): The held-out (user code, movie row) pairs the users liked.
+
+    Returns: (precision, recall); precision counts hits out of k, even for shorter lists.
+    """
+    if not len(relevant_users):
+        return np.nan, np.nan
+    width = int(max(movies.max(initial=0), relevant_movies.max()) + 1)
+    relevant = np.sort(relevant_users * width + relevant_movies)
+    relevant = relevant[np.r_[True, relevant[1:] != relevant[:-1]]]
+    hits = np.isin(users * width + movies, relevant)
+
+    n_users = int(max(users.max(initial=0), relevant_users.max()) + 1)
+    wanted = np.bincount(relevant // width, minlength=n_users)
+    found = np.bincount(users[hits], minlength=n_users)
+    tested = wanted > 0
+    return float(np.mean(found[tested] / k)), float(np.mean(found[tested] / wanted[tested]))
+
+
+def average_predictions(dataset, test_movies):
+    """Each movie's average rating, or the overall average for movies without ratings."""
+    movie_sums, movie_counts = dataset.movie_sums, dataset.movie_counts
+    with np.errstate(invalid="ignore", divide="ignore"):
+        averages = movie_sums[test_movies] / movie_counts[test_movies]
+    return np.where(np.isnan(averages), movie_sums.sum() / max(movie_counts.sum(), 1), averages)
+
+
+def ranked_movies(dataset, movies=None):
+    """The movies_df rows (of `movies`, if given) with ratings, best average first, ties by name."""
+    averages = scorable_averages(dataset)
+    movies = np.flatnonzero(~np.isnan(averages)) if movies is None else movies[~np.isnan(averages[movies])]
+    return movies[np.lexsort((movie_name_ranks(dataset)[movies], -averages[movies]))]
+
+
+def first_unseen_movies(dataset, order, k, users, pair_users, pair_movies):
+    """
+    Finds, for users who share one ranking, the first k movies of it each has not rated.
+
+    Instead of scoring a user x movie matrix, each user's window of the
+    ranking is widened by the rated movies inside it until it holds k
+    unseen ones; every step is one vectorized search over all the users.
+
+    Args:
+        order (np.ndarray): movies_df rows, best first.
+        users (np.ndarray): The user codes to recommend for, sorted.
+        pair_users, pair_movies (np.ndarray): The rated (user code, movie row) pairs.
+
+    Returns: (user codes, movie rows) of the recommendations, by user then rank.
+    """
+    stride = len(order) + 1
+    positions = np.full(len(dataset.movies_df), len(order))
+    positions[order] = np.arange(len(order))
+    rated = np.isin(pair_users, users)
+    owners = np.searchsorted(users, pair_users[rated])
+    seen = np.sort(owners * stride + positions[pair_movies[rated]])
+
+    starts = np.searchsorted(seen, np.arange(len(users)) * stride)
+    skipped = np.zeros(len(users), dtype=np.intp)
+    while True:
+        lengths = np.minimum(k + skipped, len(order))
+        inside = np.searchsorted(seen, np.arange(len(users)) * stride + lengths) - starts
+        if np.array_equal(inside, skipped):
+            break
+        skipped = inside
+
+    owners = np.repeat(np.arange(len(users)), lengths)
+    ranks = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    unseen = ~np.isin(owners * stride + ranks, seen)
+    return users[owners[unseen]], order[ranks[unseen]]
+
+
+def evaluate_global_average(dataset, totals, test_users, test_movies, k):
+    """Predicts every rating as the movie's average; recommends the best-rated unseen movies."""
+    users = np.arange(len(dataset.user_keys))
+    ranked = first_unseen_movies(dataset, ranked_movies(dataset), k, users, totals[0], totals[1])
+    return average_predictions(dataset, test_movies), ranked
+
+
+def evaluate_favourite_genre(dataset, totals, test_users, test_movies, k):
+    """
+    Recommends the best-rated unseen movies of the user's favourite genres
+    (see get_all_users_top_3_fav_genre); predicts no ratings. Users with
+    the same favourite genres share one ranking.
+    """
+    user_sums, user_counts = totals[5], totals[6]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        averages = user_sums / user_counts
+    best = np.max(np.where(user_counts > 0, averages, -np.inf), axis=1, initial=-np.inf)
+    favourite = (user_counts > 0) & (averages == best[:, None])
+    if not favourite.any():
+        return None, (np.array([], dtype=np.intp), np.array([], dtype=np.intp))
+
+    favourite_sets, user_sets = np.unique(favourite, axis=0, return_inverse=True)
+    indicator = genre_matrix(dataset)
+    users, movies = [], []
+    for set_code, genres in enumerate(favourite_sets):
+        if genres.any():
+            in_genres = np.flatnonzero(indicator[:, genres].any(axis=1))
+            found = first_unseen_movies(dataset, ranked_movies(dataset, in_genres), k,
+                                        np.flatnonzero(user_sets == set_code), totals[0], totals[1])
+            users.append(found[0])
+            movies.append(found[1])
+    return None, (np.concatenate(users), np.concatenate(movies))
+
+
+def evaluate_genre_affinity(dataset, totals, test_users, test_movies, k):
+    """Scores movies as get_recommendations() does: their average plus the user's affinity for their genres."""
+    pair_users, pair_movies, pair_sums, pair_counts, _, user_sums, user_counts = totals
+    n_users = len(dataset.user_keys)
+    affinity = genre_affinity(user_sums, user_counts,
+                              np.bincount(pair_users, weights=pair_sums, minlength=n_users),
+                              np.bincount(pair_users, weights=pair_counts, minlength=n_users))
+    indicator = genre_matrix(dataset).astype(np.float64)
+    scores = np.nan_to_num(scorable_averages(dataset), nan=-np.inf)
+    ranked = best_unseen_movies(dataset, lambda first, last: scores + movie_affinity(affinity[first:last], indicator),
+                                k, pair_users, pair_movies)
+
+    # The affinity of each (user, movie) pair: a row-wise product instead of a user x movie matrix
+    genres = indicator[test_movies]
+    lift = np.einsum("ij,ij->i", affinity[np.maximum(test_users, 0)], genres) / np.maximum(genres.sum(axis=1), 1)
+    return average_predictions(dataset, test_movies) + np.where(test_users >= 0, lift, 0.0), ranked[:2]
+
+
+def evaluate_similar_users(dataset, totals, test_users, test_movies, k):
+    """
+    Scores movies as get_neighbour_recommendations() does, from the ratings
+    of the user's nearest neighbours; movies no neighbour rated are
+    predicted from their average. Runs one neighbour query per tested user.
+    """
+    # The training snapshot is never published, so its neighbour index is built once here
+    dataset = dataset.replace(neighbour_index=get_neighbour_index(dataset))
+    predictions = average_predictions(dataset, test_movies)
+    users, movies = [], []
+    order = np.argsort(test_users, kind="stable")
+    bounds = np.searchsorted(test_users[order], np.arange(len(dataset.user_keys) + 1))
+    for code in np.flatnonzero(np.diff(bounds)):
+        scores = neighbour_scores(dataset, dataset.user_keys[code], EVALUATION_NEIGHBOURS)
+        rows = order[bounds[code]:bounds[code + 1]]
+        found = scores[test_movies[rows]]
+        predictions[rows] = np.where(np.isnan(found), predictions[rows], found)
+        candidates = np.flatnonzero(np.isfinite(scores))
+        best = candidates[np.lexsort((candidates, -scores[candidates]))[:k]]
+        users.append(np.full(len(best), code))
+        movies.append(best)
+    if not users:
+        return predictions, (np.array([], dtype=np.intp), np.array([], dtype=np.intp))
+    return predictions, (np.concatenate(users), np.concatenate(movies))
+
+
+# Methods compared by evaluate_rankers(), in report order. Each takes the
+# training snapshot, its user_genre_totals(), the held-out (user code, movie
+# row) pairs and k, and returns (predicted ratings or None, (user codes,
+# movie rows) of its top k recommendations).
+EVALUATION_METHODS = {
+    "global average": evaluate_global_average,
+    "favourite genre": evaluate_favourite_genre,
+    "genre affinity": evaluate_genre_affinity,
+    "similar users": evaluate_similar_users,
+}
+
+
+def evaluate_fold(assignment, fold, k=10, methods=tuple(EVALUATION_METHODS), relevant=None):
+    """
+    Trains on the ratings outside one fold and scores every method on the held-out ones.
+
+    The fold's ratings are held out and the methods trained on a private
+    snapshot of the others, which is never published: the loaded ratings,
+    and any reload or append meanwhile, are left alone. Only held-out
+    ratings of catalogue movies are scored, and ranking metrics only for
+    users who also have training ratings.
+
+    Args:
+        assignment (np.ndarray): The fold of each rating_df row (see split_user_folds).
+        relevant (float, optional): Lowest held-out rating of a liked movie. Defaults to RELEVANT_RATING.
+
+    Returns:
+        list: One dict per method with its fold, rmse, precision, recall and seconds.
+    """
+    snapshot = snapshots.current_dataset
+    held_out = assignment == fold
+    test_movies = snapshot.rating_movie_rows[held_out]
+    test = snapshot.rating_df[held_out]
+    # The loaded ratings have their duplicates resolved already, so the training ones are kept as they are
+    training_df = snapshot.rating_df[~held_out]
+    training = dataset_with(snapshot, ratings=training_df, rating_indexes=prepare_ratings(training_df, "keep"))
+    matched = test_movies >= 0
+    test_users = training.user_keys.get_indexer(test["user_id"])[matched]
+    test_movies, actual = test_movies[matched], rating_values(test)[matched]
+    liked = (actual >= (RELEVANT_RATING if relevant is None else relevant)) & (test_users >= 0)
+    totals = user_genre_totals(training)
+
+    results = []
+    for method in methods:
+        start = time.perf_counter()
+        predictions, (users, movies) = EVALUATION_METHODS[method](training, totals, test_users, test_movies, k)
+        seconds = time.perf_counter() - start
+        precision, recall = precision_recall_at_k(users, movies, test_users[liked], test_movies[liked], k)
+        results.append({"method": method, "fold": fold, "seconds": seconds, "precision": precision, "recall": recall,
+                        "rmse": np.nan if predictions is None else rmse(predictions, actual)})
+    return results
+
+
+# Settings that change evaluation results, as (module, name): sent to worker processes along with the snapshot
+EVALUATION_SETTINGS = (("movie_data", "COMPACT_RATINGS"), ("snapshots", "DUPLICATE_POLICY"),
+                       ("evaluation", "RELEVANT_RATING"), ("evaluation", "EVALUATION_NEIGHBOURS"))
+
+
+def init_evaluation_worker(snapshot, settings):
+    """
+    Installs the evaluating process's snapshot and settings in a worker process.
+
+    The snapshot is published as it is: its ratings were loaded, cleaned and
+    had their duplicates resolved in the parent, and are not prepared again.
+    """
+    for (module, name), value in settings.items():
+        setattr(importlib.import_module(module), name, value)
+    publish(snapshot)
+
+
+def evaluate_rankers(folds=5, k=10, methods=None, workers=None, seed=0, relevant=None):
+    """
+    Cross-validates the ranking and recommendation methods on the loaded ratings.
+
+    rating_df is split into per-user folds (see split_user_folds) and each
+    fold is evaluated by evaluate_fold(), in a pool of `workers` processes
+    (by default one per CPU, at most one per fold) that each receive the
+    current snapshot and EVALUATION_SETTINGS once; with one worker the folds
+    run in this process. Workers are spawned rather than forked, since
+    background loads and watchers may have threads running.
+
+    Args:
+        methods (iterable, optional): Names from EVALUATION_METHODS. Defaults to all.
+        relevant (float, optional): Lowest held-out rating of a liked movie. Defaults to RELEVANT_RATING.
+
+    Returns:
+        pd.DataFrame: Indexed by method: RMSE, precision@k and recall@k
+        averaged over the folds (RMSE is NaN for methods that only rank),
+        and the seconds each method took, summed over the folds.
+    Raises: ValueError if a dataset is missing or a method is unknown.
+    """
+    snapshot = snapshots.current_dataset
+    if snapshot.movies_df is None or snapshot.rating_df is None:
+        raise ValueError("Load both the movies and the ratings before evaluating.")
+    methods = tuple(EVALUATION_METHODS if methods is None else methods)
+    unknown = set(methods) - set(EVALUATION_METHODS)
+    if unknown:
+        raise ValueError(f"Unknown evaluation methods: {', '.join(sorted(unknown))}")
+
+    assignment = split_user_folds(snapshot.rating_df["user_id"], folds, seed)
+    workers = min(workers or os.cpu_count() or 1, folds)
+    if workers == 1:
+        results = [evaluate_fold(assignment, fold, k, methods, relevant) for fold in range(folds)]
+    else:
+        # The neighbour index and the sample are not used by the folds, so they are not sent
+        shipped = snapshot.replace(neighbour_index=None, rating_sample=None)
+        settings = {(module, name): getattr(importlib.import_module(module), name)
+                    for module, name in EVALUATION_SETTINGS}
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=init_evaluation_worker, initargs=(shipped, settings)) as pool:
+            results = list(pool.map(evaluate_fold, itertools.repeat(assignment), range(folds),
+                                    itertools.repeat(k), itertools.repeat(methods), itertools.repeat(relevant)))
+
+    rows = pd.DataFrame([row for fold in results for row in fold])
+    report = rows.groupby("method", sort=False).agg(rmse=("rmse", "mean"), precision=("precision", "mean"),
+                                                    recall=("recall", "mean"), seconds=("seconds", "sum"))
+    return report.rename(columns={"precision": f"precision@{k}", "recall": f"recall@{k}"})
@@ -0,0 +1,108 @@
+"""
+Computes global rankings from partitioned ratings files with a local map-reduce.
+
+Map: a pool of worker processes each reads one ratings partition and reduces
+it to PartialAggregates (per-title, per-genre and per-user-genre sums and
+counts, and per-title rating histograms), serialized as JSON. Reduce: the
+partials are merged pairwise and installed with set_aggregates(), and the
+usual top-N, distribution and median queries answer for all the partitions
+together without ever concatenating the ratings. The merged.json saved with
+--out-dir loads in the menu too (option 2, then A).
+
+Usage:
+    python mapreduce_rankings.py MOVIES RATINGS [RATINGS ...]
+    python mapreduce_rankings.py gpt_movies.txt gpt_ratings.txt --split 4   # partition by user range first
+    python mapreduce_rankings.py MOVIES part_*.txt --out-dir partials --check
+"""
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import movie_data
+import movie_recommender as mr
+import snapshots
+
+
+def init_worker(movies_path):
+    """Loads the movies catalogue once per worker process."""
+    snapshots.set_movies(movie_data.read_movies_file(movies_path))
+
+
+def map_partition(ratings_path):
+    """Reduces one ratings partition to its serialized partial aggregates."""
+    return snapshots.PartialAggregates.from_ratings(movie_data.read_ratings_file(ratings_path)).to_json()
+
+
+def split_by_user_range(ratings_path, parts, out_dir):
+    """Writes the ratings file as `parts` files holding consecutive user id ranges; returns their paths."""
+    ratings = movie_data.read_ratings_file(ratings_path)
+    users = np.sort(ratings["user_id"].unique())
+    bounds = [users[min(len(users) - 1, len(users) * i // parts)] for i in range(1, parts)]
+    part_of = np.searchsorted(bounds, ratings["user_id"].to_numpy(), side="right")
+
+    paths = []
+    for part in range(parts):
+        path = os.path.join(out_dir, f"ratings_part_{part}.txt")
+        ratings[part_of == part].to_csv(path, sep="|", header=False, index=False)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rank movies across ratings partitions with mergeable aggregates.")
+    parser.add_argument("movies", help="movies dataset shared by every partition")
+    parser.add_argument("ratings", nargs="+", help="ratings partition files")
+    parser.add_argument("--split", type=int, help="first split a single ratings file into this many user ranges")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--out-dir", help="also save each partial and the merged result here")
+    parser.add_argument("-n", type=int, default=5, help="rows per ranking")
+    parser.add_argument("--check", action="store_true", help="compare with loading all ratings in one process")
+    args = parser.parse_args()
+
+    snapshots.set_movies(movie_data.read_movies_file(args.movies))
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = args.ratings
+        if args.split:
+            if len(paths) != 1:
+                parser.error("--split takes exactly one ratings file")
+            paths = split_by_user_range(paths[0], args.split, tmp)
+
+        start = time.perf_counter()
+        with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(args.movies,)) as pool:
+            documents = list(pool.map(map_partition, paths))
+        map_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        partials = [snapshots.PartialAggregates.from_json(document) for document in documents]
+        merged = snapshots.merge_partials(partials)
+        reduce_seconds = time.perf_counter() - start
+        print(f"Mapped {len(paths)} partition(s) in {map_seconds:.2f}s, merged in {reduce_seconds:.2f}s "
+              f"({int(merged.titles['rating_count'].sum()):,} ratings)")
+
+        if args.out_dir:
+            os.makedirs(args.out_dir, exist_ok=True)
+            for i, partial in enumerate(partials):
+                partial.save(os.path.join(args.out_dir, f"partial_{i}.json"))
+            merged.save(os.path.join(args.out_dir, "merged.json"))
+
+        snapshots.set_aggregates(merged)
+        answers = [mr.get_top_n_movies(args.n), mr.get_top_n_genres(args.n)]
+        print(f"\nTop {args.n} Movies:\n{answers[0].to_string()}")
+        print(f"\nTop {args.n} Genres:\n{answers[1].to_string()}")
+
+        if args.check:
+            snapshots.set_ratings(movie_data.concat_ratings([movie_data.read_ratings_file(path) for path in paths]))
+            expected = [mr.get_top_n_movies(args.n), mr.get_top_n_genres(args.n)]
+            same = all(a.index.equals(e.index) and np.allclose(a.to_numpy(), e.to_numpy())
+                       for a, e in zip(answers, expected))
+            print(f"\nSingle-process check: {'identical rankings' if same else 'MISMATCH'}")
+            if not same:
+                raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,513 @@
+"""
+Reading, validating and cleaning the movies and ratings files.
+
+The pipe-separated readers (pandas or pyarrow, plain or compressed), the
+compact ratings representation, title canonicalization and the atomic
+file writes used by the snapshots, the menu and the exports.
+"""
+import pandas as pd
+import numpy as np
+import contextlib
+import csv
+import io
+import lzma
+import os
+import tempfile
+import unicodedata
+
+# Optional: the multithreaded Arrow CSV reader, used as the faster parser backend when installed
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+    pa_csv = None
+
+
+def is_column_numeric(df, col_name):
+    """
+    Checks if a column can be reasonably converted to a numeric type.
+    A column passes if less than 10% of its non-null values become NaN after coercion.
+    """
+    col = pd.to_numeric(df[col_name], errors='coerce')
+
+    original_non_null_count = df[col_name].dropna().shape[0]
+    if original_non_null_count == 0:
+        return False
+
+    nan_count_after_coercion = col.isna().sum()
+
+    # Validation passes if less than 10% of the original non-null values became NaN
+    return nan_count_after_coercion < (original_non_null_count * 0.1)
+
+
+def validate_dataframe(df, expected_columns, numeric_check_col=None):
+    """
+    Checks if the loaded DataFrame has the correct column names and
+    performs a mandatory numeric check on a specific column to differentiate files.
+
+    Returns: True if validation passes, False otherwise.
+    """
+    # 1. Check Column Names/Count
+    if df.columns.tolist() != expected_columns:
+        return False
+
+    # 2. Check Key Numeric Column (Crucial for file differentiation)
+    if numeric_check_col and not is_column_numeric(df, numeric_check_col):
+        return False
+
+    return True
+
+
+RATING_COLUMNS = ["movie_name", "rating", "user_id"]
+
+# Rows parsed per block when reading ratings; keeps peak memory independent of file size
+RATINGS_CHUNK_SIZE = 500_000
+
+# Opt-in memory-budget mode: keep ratings as uint8 half-star units, small ints and categorical titles
+COMPACT_RATINGS = False
+
+# Compressed datasets are read through pandas' streaming decompression
+COMPRESSED_SUFFIXES = ".gz, .bz2 or .xz"
+
+
+def is_supported_dataset(file_path):
+    """Checks for a .txt dataset path, optionally compressed (.txt.gz, .txt.bz2, .txt.xz)."""
+    root, ext = os.path.splitext(file_path.lower())
+    if ext in (".gz", ".bz2", ".xz"):
+        root, ext = os.path.splitext(root)
+    return ext == ".txt"
+
+
+def is_compressed(file_path):
+    """Checks whether a dataset path names a compressed file."""
+    return file_path_suffix(file_path) in (".gz", ".bz2", ".xz")
+
+
+# Parser used for the pipe-separated files: "auto" (pyarrow when installed), "pyarrow" or "pandas"
+PARSER_BACKEND = "auto"
+PARSER_BACKENDS = ("auto", "pyarrow", "pandas")
+
+# Bytes of the file the Arrow reader parses at a time; bounds its memory as RATINGS_CHUNK_SIZE does for pandas
+ARROW_BLOCK_SIZE = 16 << 20
+
+
+def resolve_parser_backend(backend=None):
+    """
+    Picks the parser backend to use.
+
+    Args:
+        backend (str, optional): "auto", "pyarrow" or "pandas". Defaults to PARSER_BACKEND.
+
+    Returns: "pyarrow" or "pandas".
+    Raises: ValueError for an unknown backend, or "pyarrow" when it is not installed.
+    """
+    backend = (backend or PARSER_BACKEND).lower()
+    if backend not in PARSER_BACKENDS:
+        raise ValueError(f"Unknown parser backend '{backend}'. Choose from {', '.join(PARSER_BACKENDS)}.")
+    if backend == "auto":
+        return "pyarrow" if pa_csv is not None else "pandas"
+    if backend == "pyarrow" and pa_csv is None:
+        raise ValueError("The 'pyarrow' parser backend needs the pyarrow package, which is not installed.")
+    return backend
+
+
+def iter_arrow_batches(file_path, names, sep, column_types, block_size=None):
+    """
+    Parses a delimited file with the streaming Arrow CSV reader, yielding
+    one record batch per `block_size` bytes (default ARROW_BLOCK_SIZE) as it is read.
+
+    Arrow decompresses .gz and .bz2 itself; .xz is streamed through lzma.
+    Raises pyarrow's ArrowInvalid (when opening or at any batch) if a value
+    does not fit its column type.
+    """
+    block_size = ARROW_BLOCK_SIZE if block_size is None else block_size
+    source = lzma.open(file_path, "rb") if file_path_suffix(file_path) == ".xz" else file_path
+    try:
+        reader = pa_csv.open_csv(
+            source,
+            read_options=pa_csv.ReadOptions(column_names=names, use_threads=True, block_size=block_size),
+            parse_options=pa_csv.ParseOptions(delimiter=sep, quote_char='"' if sep == "|" else False),
+            convert_options=pa_csv.ConvertOptions(column_types=column_types),
+        )
+        with reader:
+            yield from reader
+    finally:
+        if source is not file_path:
+            source.close()
+
+
+def file_path_suffix(file_path):
+    """Returns the lower-cased last extension of a path (or '' for file-like objects)."""
+    return os.path.splitext(file_path.lower())[1] if isinstance(file_path, str) else ""
+
+
+def read_pipe_blocks(file_path, names, column_types, chunksize=RATINGS_CHUNK_SIZE, backend=None, sep="|"):
+    """
+    Parses a pipe-separated file into DataFrame blocks of at most `chunksize` rows.
+
+    Either backend reads the file incrementally, so memory does not grow
+    with its size: pandas with its C parser, pyarrow with its streaming
+    reader (using `column_types`), one ARROW_BLOCK_SIZE block at a time. If
+    Arrow cannot type the file cleanly (stray text in a numeric column,
+    ragged rows, an empty file), pandas reads on from the first row not yet
+    handed out, and the loaders validate what it makes of the rest.
+
+    Args:
+        names (list): Column names.
+        column_types (dict): Column name -> pyarrow type for the Arrow backend.
+        sep (str): Field separator; any other single character reads whole lines.
+    """
+    start = 0
+    if resolve_parser_backend(backend) == "pyarrow" and not isinstance(file_path, io.IOBase):
+        try:
+            for batch in iter_arrow_batches(file_path, names, sep, column_types):
+                for offset in range(0, batch.num_rows, chunksize):
+                    block = batch.slice(offset, chunksize).to_pandas()
+                    block.index = pd.RangeIndex(start, start + len(block))
+                    start += len(block)
+                    yield block
+            return
+        except pa.ArrowInvalid:
+            pass
+
+    # Rows Arrow already handed out are parsed again but skipped, a block at a time
+    options = {} if sep == "|" else {"dtype": str, "quoting": csv.QUOTE_NONE}
+    with pd.read_csv(file_path, sep=sep, header=None, names=names, chunksize=chunksize, **options) as reader:
+        for block in reader:
+            if block.index[-1] >= start:
+                yield block.iloc[max(start - block.index[0], 0):]
+
+
+class DatasetValidationError(ValueError):
+    """Raised when a file does not look like the dataset it was loaded as."""
+
+
+def read_movies_file(file_path, backend=None):
+    """
+    Reads and validates a pipe-separated movies file.
+
+    Compressed files (.txt.gz, .txt.bz2, .txt.xz) are decompressed as a stream.
+
+    Each line is 'genre|movie_id|movie_name'. A movie may list several genres
+    ('Action|Comedy|6|Heat (1995)'), so lines are split from the right and
+    everything before the id is kept as the movie's genre list. Movies that
+    appear on several lines (the old one-genre-per-row layout) are merged.
+
+    Returns: the cleaned DataFrame, one row per movie.
+    Raises: DatasetValidationError if the file is not a movies file.
+    """
+    expected_movie_cols = ["movie_genre", "movie_id", "movie_name"]
+
+    # Read whole lines (\x1f never occurs in the data) and split them here
+    column_types = {"line": pa.string()} if pa is not None else None
+    blocks = list(read_pipe_blocks(file_path, ["line"], column_types, backend=backend, sep="\x1f"))
+    if not blocks:
+        raise pd.errors.EmptyDataError("No columns to parse from file")
+    lines = pd.concat(blocks) if len(blocks) > 1 else blocks[0]
+    temp_df = lines["line"].astype(str).str.rsplit("|", n=2, expand=True).reindex(columns=range(3))
+    temp_df.columns = expected_movie_cols
+
+    # --- VALIDATION STEP 1: Check column count and 'movie_id' (Col 2) for numeric content ---
+    if not validate_dataframe(temp_df, expected_movie_cols, numeric_check_col="movie_id"):
+        raise DatasetValidationError(
+            f"❌ File structure mismatch! Column count or 'movie_id' data type is incorrect. Please check your file.")
+
+    # --- VALIDATION STEP 2: CRITICAL CHECK to block ratings.txt ---
+    try:
+        pd.to_numeric(temp_df["movie_name"], errors='raise').astype(int)
+        is_mostly_integer = True
+    except (ValueError, TypeError):
+        is_mostly_integer = False
+
+    if is_mostly_integer:
+        raise DatasetValidationError(
+            "❌ Validation Failed! The third column's data type suggests this is the RATINGS file (User IDs). You need to upload the .txt with the movies in to this one.")
+
+    # Final cleaning
+    temp_df["movie_id"] = pd.to_numeric(temp_df["movie_id"], errors='coerce')
+    temp_df = temp_df.dropna(subset=['movie_id'])
+    return combine_movie_rows(temp_df)
+
+
+def read_ratings_file(file_path, chunksize=RATINGS_CHUNK_SIZE, backend=None, compact=None, progress=None,
+                      resolver=None):
+    """
+    Reads and validates a pipe-separated ratings file ('movie_name|rating|user_id').
+
+    The file is parsed in blocks of `chunksize` rows, each validated and
+    cleaned as it arrives. Compressed files (.txt.gz, .txt.bz2, .txt.xz) are
+    decompressed as a stream straight into the parser, never to disk.
+    `backend` selects the parser (see resolve_parser_backend()). With
+    `compact` (default COMPACT_RATINGS) each block is converted by
+    compact_ratings() as soon as it is cleaned. `progress`, if given, is
+    called with the number of rows parsed so far after every block. With a
+    `resolver` (a DuplicateResolver) each block's duplicate ratings are
+    resolved as it arrives, and resolver.result() also gives their count
+    and pair index.
+
+    Returns: the cleaned DataFrame with out-of-range ratings removed.
+    Raises: DatasetValidationError if the file is not a ratings file.
+    """
+    if compact is None:
+        compact = COMPACT_RATINGS
+    chunks = []
+    for rows, temp_df in iter_ratings_blocks(file_path, chunksize, backend):
+        temp_df = compact_ratings(temp_df) if compact else temp_df
+        if resolver is None:
+            chunks.append(temp_df)
+        else:
+            resolver.add(temp_df)
+        if progress is not None:
+            progress(rows)
+    return concat_ratings(chunks) if resolver is None else resolver.result()[0]
+
+
+def iter_ratings_blocks(file_path, chunksize=RATINGS_CHUNK_SIZE, backend=None):
+    """
+    Yields the blocks of a ratings file as read_ratings_file() reads them:
+    (rows parsed so far, validated and cleaned block).
+
+    Raises: DatasetValidationError if the file is not a ratings file (after
+    the last block for the check that covers the whole file).
+    """
+    column_types = None
+    if pa is not None:
+        column_types = {"movie_name": pa.string(), "rating": pa.float64(), "user_id": pa.int64()}
+
+    structure_error = DatasetValidationError(
+        f"❌ File structure mismatch! The file columns ({RATING_COLUMNS}) or the 'rating' column data type is incorrect. Please ensure you are loading a ratings file.")
+
+    non_null = not_numeric = rows = 0
+    for temp_df in read_pipe_blocks(file_path, RATING_COLUMNS, column_types, chunksize, backend):
+        # --- VALIDATION STEP 1: Check column count; the 'rating' (Col 2) numeric check covers the whole file ---
+        if not validate_dataframe(temp_df, RATING_COLUMNS):
+            raise structure_error
+        non_null += temp_df["rating"].notna().sum()
+        not_numeric += pd.to_numeric(temp_df["rating"], errors="coerce").isna().sum()
+
+        validate_ratings_chunk(temp_df)
+        rows += len(temp_df)
+        yield rows, clean_ratings(temp_df)
+
+    # Same rule as is_column_numeric(), accumulated over every block
+    if non_null == 0 or not_numeric >= non_null * 0.1:
+        raise structure_error
+
+
+def validate_ratings_chunk(temp_df):
+    """
+    Checks that a block of parsed rows has integer user ids, as ratings do and movies do not.
+
+    Raises: DatasetValidationError if it does not.
+    """
+    # --- VALIDATION STEP 2: CRITICAL CHECK to block movies.txt ---
+    try:
+        pd.to_numeric(temp_df["user_id"], errors='raise').astype(int)
+        is_mostly_integer = True
+    except (ValueError, TypeError):
+        is_mostly_integer = False
+
+    # If the third column is NOT mostly integers, it's the wrong file.
+    if not is_mostly_integer:
+        raise DatasetValidationError(
+            "❌ Validation Failed! The third column's data type suggests this is the MOVIES file (Movie Names). You need to upload the .txt with the ratings in to this one.")
+
+
+def clean_ratings(df):
+    """Converts ratings to numbers and drops missing or out-of-range (not 0-5) values."""
+    df = df.copy()
+    df["rating"] = pd.to_numeric(df["rating"], errors="coerce")
+    df.dropna(subset=["rating"], inplace=True)
+    return df[(df["rating"] >= 0) & (df["rating"] <= 5)]
+
+
+def rating_values(df, rows=None):
+    """
+    Returns a ratings frame's ratings as float64 (only those at positions `rows`, if given), whatever their storage.
+
+    Compact frames keep ratings as uint8 half-star units, which are decoded here;
+    every query reads ratings through this helper.
+    """
+    ratings = df["rating"].to_numpy()
+    ratings = np.asarray(ratings if rows is None else ratings[rows], dtype=float)
+    return ratings / 2 if df["rating"].dtype == np.uint8 else ratings
+
+
+def is_compact(df):
+    """Checks whether a ratings frame uses the compact representation."""
+    return isinstance(df["movie_name"].dtype, pd.CategoricalDtype)
+
+
+def compact_ratings(df):
+    """
+    Converts cleaned ratings to the compact memory-budget representation.
+
+    - rating: uint8 half-star units (4.5 -> 9), or float32 if any rating is not a half step
+    - user_id: the smallest integer type that holds every id
+    - movie_name: categorical (one copy of each title plus small integer codes)
+    The index is reset to a RangeIndex, which takes no per-row memory.
+    """
+    ratings = rating_values(df)
+    units = ratings * 2
+    if np.array_equal(units, np.round(units)):
+        rating = units.astype(np.uint8)
+    else:
+        rating = ratings.astype(np.float32)
+
+    user_ids = pd.to_numeric(df["user_id"])
+    downcast = "unsigned" if len(user_ids) and user_ids.min() >= 0 else "integer"
+    return pd.DataFrame({
+        "movie_name": df["movie_name"].astype("category"),
+        "rating": rating,
+        "user_id": pd.to_numeric(user_ids, downcast=downcast).to_numpy(),
+    }).set_axis(pd.RangeIndex(len(df)))
+
+
+def concat_ratings(frames):
+    """
+    Concatenates ratings frames, keeping compact frames compact.
+
+    Compact blocks can disagree (one block with a non-half-step rating is
+    float32, a block with larger ids needs a wider int, each block has its
+    own title categories), so each column is combined at the widest type.
+    """
+    if len(frames) == 1:
+        return frames[0]
+    if not any(is_compact(f) for f in frames):
+        return pd.concat(frames)
+
+    frames = [f if is_compact(f) else compact_ratings(f) for f in frames]
+    if all(f["rating"].dtype == np.uint8 for f in frames):
+        rating = np.concatenate([f["rating"].to_numpy() for f in frames])
+    else:
+        rating = np.concatenate([rating_values(f).astype(np.float32) for f in frames])
+
+    user_ids = pd.Series(np.concatenate([f["user_id"].to_numpy(dtype=np.int64) for f in frames]))
+    downcast = "unsigned" if len(user_ids) and user_ids.min() >= 0 else "integer"
+    names = pd.api.types.union_categoricals([f["movie_name"].array for f in frames], ignore_order=True)
+    return pd.DataFrame({
+        "movie_name": names,
+        "rating": rating,
+        "user_id": pd.to_numeric(user_ids, downcast=downcast).to_numpy(),
+    })
+
+
+def bytes_per_rating(df):
+    """Returns the memory a ratings frame uses per row, including strings and the index."""
+    if len(df) == 0:
+        return 0.0
+    return df.memory_usage(deep=True, index=True).sum() / len(df)
+
+
+def ratings_preview(df, rows=5):
+    """Returns the first rows of a ratings frame with ratings shown as stars, for printing."""
+    head = df.head(rows)
+    return head.assign(rating=rating_values(head))
+
+
+def clean_titles(names):
+    """
+    Returns the display form of titles as an array: Unicode NFKC-normalized,
+    with runs of whitespace collapsed to one space and stripped.
+    """
+    titles = pd.Series(np.asarray(names, dtype=object), dtype=object)
+    return titles.str.normalize("NFKC").str.replace(r"\s+", " ", regex=True).str.strip().to_numpy()
+
+
+def title_keys(names):
+    """Returns the canonical keys titles are matched on: their clean_titles() form, case-folded."""
+    return pd.Series(clean_titles(names), dtype=object).str.casefold().to_numpy()
+
+
+def title_key(title):
+    """Returns the canonical key of a single title, as title_keys() computes it."""
+    return " ".join(unicodedata.normalize("NFKC", str(title)).split()).casefold()
+
+
+def combine_movie_rows(df):
+    """
+    Cleans the titles (see clean_titles) and collapses repeated rows for the
+    same movie - titles with the same canonical key - into a single row.
+
+    The genres of all rows for a movie are joined into one 'Action|Comedy'
+    style list (in first-seen order); the first row's title and movie_id are kept.
+    """
+    df = df.assign(movie_name=clean_titles(df["movie_name"]))
+    keys = pd.Series(df["movie_name"].to_numpy(), dtype=object).str.casefold().to_numpy()
+    genres = pd.DataFrame({"key": keys, "movie_genre": df["movie_genre"].fillna("").astype(str).str.split("|")})
+    genres = genres.explode("movie_genre")
+    genres["movie_genre"] = genres["movie_genre"].str.strip()
+    genres = genres[genres["movie_genre"] != ""].drop_duplicates()
+
+    first = ~pd.Index(keys).duplicated()
+    combined = df[first].reset_index(drop=True)
+    # Join each movie's genres from one sorted pass instead of a per-group aggregation
+    rows = pd.Index(keys[first]).get_indexer(genres["key"])
+    order = np.argsort(rows, kind="stable")
+    names = genres["movie_genre"].to_numpy(dtype=object)[order]
+    bounds = np.searchsorted(rows[order], np.arange(len(combined) + 1))
+    combined["movie_genre"] = ["|".join(names[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+    return combined
+
+
+def save_movies_file(df, file_path):
+    """
+    Writes a movies DataFrame as 'genre|movie_id|movie_name' lines.
+
+    Written by hand rather than with to_csv, which would quote genre lists
+    that contain the '|' separator, and atomically (see atomic_write), so an
+    interrupted save leaves the previous file in place.
+    """
+    ids = pd.to_numeric(df["movie_id"], errors="coerce").astype("Int64").astype(str)
+    lines = df["movie_genre"].astype(str) + "|" + ids + "|" + df["movie_name"].astype(str)
+    atomic_write(file_path, (line + "\n" for line in lines))
+
+
+def estimate_rows(file_path, sample_size=1 << 16):
+    """
+    Estimates the number of lines of a text file from the line length of its
+    first sample_size bytes; None for compressed or unreadable files.
+    """
+    if is_compressed(file_path):
+        return None
+    try:
+        size = os.path.getsize(file_path)
+        with open(file_path, "rb") as f:
+            sample = f.read(sample_size)
+    except OSError:
+        return None
+    lines = sample.count(b"\n")
+    if size <= len(sample):
+        return lines + (1 if sample and not sample.endswith(b"\n") else 0)
+    return int(size * lines / len(sample)) if lines else None
+
+
+@contextlib.contextmanager
+def atomic_file(file_path, mode="w"):
+    """
+    Opens a temporary file next to file_path for writing and renames it over
+    file_path once the block completes, so readers see either the old or the
+    new file. If the block raises, the temporary file is removed instead.
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=os.path.basename(file_path))
+    try:
+        with os.fdopen(fd, mode, **({} if "b" in mode else {"encoding": "utf-8", "newline": ""})) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def atomic_write(file_path, text):
+    """Writes text (a string, or an iterable of strings written as they come) to file_path atomically."""
+    with atomic_file(file_path) as f:
+        if isinstance(text, str):
+            f.write(text)
+        else:
+            f.writelines(text)
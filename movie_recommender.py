@@ -1,10 +1,113 @@
 import pandas as pd
+import numpy as np
+import io
+import json
 import os
+import statistics
+import sys
+import time
+
+import snapshots
+from movie_data import (COMPRESSED_SUFFIXES, DatasetValidationError, atomic_file, atomic_write, bytes_per_rating,
+                        clean_ratings, clean_titles, combine_movie_rows, estimate_rows, is_compact, is_compressed,
+                        is_supported_dataset, iter_ratings_blocks, rating_values, ratings_preview, read_movies_file,
+                        read_ratings_file, save_movies_file, title_key, title_keys)
+from result_cache import cached_result
+from snapshots import (HALF_STARS, PartialAggregates, append_ratings, build_user_index, file_fingerprint, find_genre,
+                       genre_matrix, get_neighbour_index, movie_positions, normalize_genre, publish, rank_descending,
+                       reload_datasets, set_aggregates, set_movies, set_ratings, title_labels, unchanged_source,
+                       unpack_genre_bits, user_rows, with_user_index)
+
+# The dataset globals below (from movies_df to rating_sample) mirror the fields of
+# current_dataset, the immutable Dataset snapshot last published by the snapshots
+# module (see mirror_dataset), for the menu and interactive use.
+# Queries never read them: they take current_dataset once and read its fields.
+current_dataset = None
 
 # Read the data from the text file into a DataFrame
 movies_df = None
 rating_df = None
 
+# Fingerprints of the files movies_df / rating_df were read from (see file_fingerprint);
+# None for data entered, appended or merged in memory. They key the result cache.
+movies_source = None
+ratings_source = None
+
+# Genre membership for movies_df: genre_names[i] is bit i of each movie's row in genre_bits
+genre_names = []
+genre_bits = None
+
+# Genre index built at load: normalized genre key -> movie rows / bit position
+genre_index = {}
+genre_positions = {}
+
+# Title search index over movies_df (a TitleIndex), built at load
+title_index = None
+
+# Canonical key of each movies_df title (see title_keys): ratings join the catalogue on these
+movie_keys = None
+
+# Rating aggregates, rebuilt whenever either dataset is (re)loaded.
+# movie_* are aligned with the rows of movies_df, genre_* with genre_names.
+movie_sums = None
+movie_counts = None
+genre_sums = None
+genre_counts = None
+rating_movie_rows = None
+
+# Half-star rating histograms (11 bins, 0.0 to 5.0), rebuilt and updated with the
+# aggregates above: one row per movie of movies_df / per genre of genre_names
+movie_histograms = None
+genre_histograms = None
+
+# Per-title rating totals (every title in rating_df, catalogue or not), built with the ratings
+title_totals = None
+
+# Per-title half-star histograms (a DataFrame indexed by movie_name, one column per half star)
+title_histograms = None
+
+# Rated titles with no catalogue movie: rating count per title, most rated first
+unmatched_titles = None
+
+# Ratings collapsed by the duplicate policy, and the (user, title) pairs of rating_df
+# (a RatingPairs) that appended ratings are resolved against
+duplicate_ratings = None
+rating_pairs = None
+
+# True when the ratings are merged aggregates (see set_aggregates) rather than rating_df:
+# the totals and histograms above are loaded, the per-rating indexes below are not
+aggregates_only = None
+
+# User index built with the ratings: the rating rows of user_keys[i] are
+# user_row_order[user_bounds[i]:user_bounds[i + 1]]. Reset to None when
+# ratings are appended and rebuilt on the next per-user query.
+user_keys = None
+user_row_order = None
+user_bounds = None
+
+# User neighbour index over rating_df (a UserNeighbourIndex), built on the first
+# similarity query and reset to None whenever the ratings change
+neighbour_index = None
+# Reservoir sample of a ratings file (a RatingsSample) answering approximate queries;
+# independent of rating_df, it is replaced only by set_sample()
+rating_sample = None
+
+
+def mirror_dataset(dataset):
+    """Sets current_dataset and the dataset globals to a newly published snapshot."""
+    global current_dataset
+    current_dataset = dataset
+    globals().update(dataset.fields())
+
+
+snapshots.follow_publishes(mirror_dataset)
+
+# Ratings file followed by the watch mode (a RatingsWatcher), polled before each menu action
+active_watcher = None
+
+# Files being loaded in the background (a BackgroundLoad); the menu reports the outcome
+pending_load = None
+
 # Define the menu options
 menu_options = """\n
 Select an option:
@@ -15,43 +118,294 @@ Select an option:
 5. Show top N genres
 6. Show your most preferred genre
 7. Show 3 most popular movies from your favorite genre
-8. Exit program
+8. Export ranked tables for every genre
+9. Watch a ratings file for appended data
+10. Recommend movies you have not rated yet
+11. Show users with similar taste
+12. Show rating distributions and medians
+13. Import movies and ratings datasets together
+14. Search movie titles
+15. Export the rating matrix for sparse-matrix tools
+16. Approximate top movies and genres from a ratings sample
+17. Exit program
 """
 
+# Datasets each menu option needs: while one of them is loading in the
+# background the option waits for it (or the user goes back to the menu)
+MENU_NEEDS = {
+    "1": ("movies",), "2": ("ratings",), "3": ("ratings",), "4": ("movies", "ratings"),
+    "5": ("movies", "ratings"), "6": ("movies", "ratings"), "7": ("movies", "ratings"),
+    "8": ("movies", "ratings"), "9": ("ratings",), "10": ("movies", "ratings"), "11": ("ratings",),
+    "12": ("movies", "ratings"), "13": ("movies", "ratings"), "14": ("movies",), "15": ("movies", "ratings"),
+    "16": ("movies",),
+}
 
-def is_column_numeric(df, col_name):
+
+class BackgroundLoad:
     """
-    Checks if a column can be reasonably converted to a numeric type.
-    A column passes if less than 10% of its non-null values become NaN after coercion.
+    A movies and/or ratings file being loaded by reload_datasets() while the menu stays usable.
+
+    The worker reports its stage and the ratings parsed so far through
+    update(); status() turns them into a progress line (with a percentage
+    when the file's line count can be estimated).
     """
-    col = pd.to_numeric(df[col_name], errors='coerce')
 
-    original_non_null_count = df[col_name].dropna().shape[0]
-    if original_non_null_count == 0:
-        return False
+    def __init__(self, movies_path=None, ratings_path=None):
+        self.kinds = {kind for kind, path in (("movies", movies_path), ("ratings", ratings_path)) if path}
+        self.expected_rows = estimate_rows(ratings_path) if ratings_path else None
+        self.stage = "queued"
+        self.rows = 0
+        self.started = time.perf_counter()
+        self.seconds = None
+        self.future = reload_datasets(movies_path, ratings_path, progress=self.update)
+        self.future.add_done_callback(self.finished)
+
+    def update(self, stage, rows=0):
+        """Records the worker's progress: its stage ('reading' or 'indexing') and the ratings parsed so far."""
+        self.stage, self.rows = stage, rows
+
+    def finished(self, future):
+        """Records how long the load took."""
+        self.seconds = time.perf_counter() - self.started
+
+    def elapsed(self):
+        """Seconds the load took, or has taken so far (done() turns True before finished() runs)."""
+        return self.seconds if self.seconds is not None else time.perf_counter() - self.started
+
+    def what(self):
+        """The datasets being loaded, as 'movies', 'ratings' or 'movies and ratings'."""
+        return " and ".join(sorted(self.kinds))
+
+    def status(self):
+        """One line describing the load: its stage, the ratings read so far and the time taken."""
+        if self.future.done():
+            return f"✔️ Loading {self.what()}: finished in {self.elapsed():.1f}s"
+        line = f"⏳ Loading {self.what()}: {self.stage}"
+        if self.stage == "reading" and "ratings" in self.kinds:
+            line += f", {self.rows:,} ratings"
+            if self.expected_rows:
+                line += f" (~{min(self.rows / self.expected_rows, 0.99):.0%})"
+        return f"{line}, {self.elapsed():.1f}s"
+
+
+class RatingsWatcher:
+    """
+    Follows a ratings file that another process keeps appending to.
+
+    The watcher remembers how many bytes of the file it has consumed. Each
+    poll() reads only the bytes appended since then, parses and validates
+    the complete lines among them as read_ratings_file() reads a whole
+    file and folds them in with append_ratings(); a trailing partial line
+    is left for the next poll, and a batch that is not valid ratings is
+    skipped. If the file shrinks or is replaced (truncation or log
+    rotation, detected by inode, size and the first bytes of the file), it
+    is reloaded from the start.
+    """
 
-    nan_count_after_coercion = col.isna().sum()
+    head_size = 64
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.offset = 0
+        self.inode = None
+        self.head = b""
+
+    def _read_new_lines(self):
+        """Returns the complete lines appended since the last read and advances the offset."""
+        with open(self.file_path, "rb") as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            if self.offset == 0:
+                self.head = f.read(self.head_size)
+            f.seek(self.offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        self.offset += end
+        return data[:end]
+
+    def _was_replaced(self, stat):
+        """Checks whether the file was truncated or swapped for another since the last read."""
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            return True
+        with open(self.file_path, "rb") as f:
+            return f.read(len(self.head)) != self.head
+
+    def start(self):
+        """
+        Loads the whole file (with the usual validation) and starts following it.
+
+        Returns: The number of ratings loaded.
+        Raises: DatasetValidationError if the file is not a ratings file.
+        """
+        self.offset = 0
+        data = self._read_new_lines()
+        if data.strip():
+            ratings = read_ratings_file(io.BytesIO(data))
+        else:
+            ratings = pd.DataFrame({"movie_name": pd.Series(dtype=object), "rating": pd.Series(dtype=float),
+                                    "user_id": pd.Series(dtype="int64")})
+        set_ratings(ratings)
+        return len(ratings)
+
+    def poll(self):
+        """
+        Folds any newly appended ratings into the loaded dataset.
+
+        Returns:
+            tuple: (new_ratings, reloaded) - the number of ratings added, and
+                   whether the file had been truncated or rotated and was reloaded.
+        Raises: DatasetValidationError if the new lines are not valid ratings.
+                They are skipped: the next poll reads on from after them.
+        """
+        try:
+            stat = os.stat(self.file_path)
+        except FileNotFoundError:
+            # Mid-rotation: the new file has not been created yet
+            return 0, False
 
-    # Validation passes if less than 10% of the original non-null values became NaN
-    return nan_count_after_coercion < (original_non_null_count * 0.1)
+        if stat.st_size == self.offset and stat.st_ino == self.inode:
+            return 0, False
+        if self._was_replaced(stat):
+            return self.start(), True
 
+        data = self._read_new_lines()
+        if not data.strip():
+            return 0, False
 
-def validate_dataframe(df, expected_columns, numeric_check_col=None):
+        try:
+            chunk = read_ratings_file(io.BytesIO(data))
+        except (DatasetValidationError, pd.errors.ParserError, UnicodeDecodeError) as e:
+            lines = data.count(b"\n")
+            raise DatasetValidationError(
+                f"⚠️ Skipped {lines} new line(s) of '{self.file_path}' that are not valid ratings:\n{e}") from e
+        append_ratings(chunk)
+        return len(chunk), False
+
+    def watch(self, interval=1.0, max_polls=None):
+        """
+        Polls the file every `interval` seconds, printing what arrives, until
+        interrupted with Ctrl+C (or after max_polls polls).
+        """
+        polls = 0
+        try:
+            while max_polls is None or polls < max_polls:
+                try:
+                    added, reloaded = self.poll()
+                except DatasetValidationError as e:
+                    print(e)
+                    added, reloaded = 0, False
+                except OSError as e:
+                    print(f"⚠️ Could not read the watched ratings file: {e}")
+                    added, reloaded = 0, False
+                if reloaded:
+                    print(f"🔄 '{self.file_path}' was truncated or rotated; reloaded {added} ratings.")
+                elif added:
+                    print(f"➕ {added} new ratings folded in ({len(current_dataset.rating_df)} total).")
+                polls += 1
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print("\nStopped watching.")
+
+
+# Rows formatted per block when rendering a result table, and rows shown per page by the menu
+RENDER_BLOCK = 10_000
+RENDER_PAGE_ROWS = 50
+
+
+def format_value(value, value_format):
+    """Formats one table entry, showing missing numbers as NaN."""
+    if isinstance(value, float) and value != value:
+        return "NaN"
+    return value_format.format(value)
+
+
+def column_width(values, value_format="{}"):
     """
-    Checks if the loaded DataFrame has the correct column names and
-    performs a mandatory numeric check on a specific column to differentiate files.
+    Width of the widest formatted entry of a column.
 
-    Returns: True if validation passes, False otherwise.
+    Numeric columns are measured from their extremes (fixed-point formats grow
+    with magnitude and sign), text columns block by block, so measuring a long
+    column neither formats it twice nor holds its strings in memory.
     """
-    # 1. Check Column Names/Count
-    if df.columns.tolist() != expected_columns:
-        return False
+    if len(values) == 0:
+        return 0
+    if pd.api.types.is_numeric_dtype(values):
+        array = np.asarray(values)
+        missing = pd.isna(array)
+        present = array[~missing]
+        widths = [len(format_value(v, value_format)) for v in (present.min(), present.max())] if len(present) else []
+        return max(widths + ([3] if missing.any() else []))
+    return max(int(pd.Index(values[start:start + RENDER_BLOCK]).astype(str).str.len().max())
+               for start in range(0, len(values), RENDER_BLOCK))
+
+
+def iter_table_lines(series, headers, value_format="{:.2f}"):
+    """
+    Lazily yields the lines of a two-column table: the series index, then its values.
 
-    # 2. Check Key Numeric Column (Crucial for file differentiation)
-    if numeric_check_col and not is_column_numeric(df, numeric_check_col):
-        return False
+    Column widths are measured up front; rows are then formatted one block of
+    RENDER_BLOCK at a time as they are consumed, so the first rows of a large
+    result are ready at once and the rendered text is never held in memory.
 
-    return True
+    Args:
+        series (pd.Series): A query result, such as get_top_n_movies(n).
+        headers (tuple): Titles of the index and the value column.
+        value_format (str): Format of the values.
+    """
+    label_align = ">" if pd.api.types.is_numeric_dtype(series.index) else "<"
+    label_width = max(len(headers[0]), column_width(series.index))
+    value_width = max(len(headers[1]), column_width(series, value_format))
+    yield f"{headers[0]:{label_align}{label_width}} {headers[1]:>{value_width}}"
+
+    values = series.to_numpy()
+    for start in range(0, len(series), RENDER_BLOCK):
+        labels = series.index[start:start + RENDER_BLOCK].to_numpy()
+        for label, value in zip(labels, values[start:start + RENDER_BLOCK]):
+            yield f"{label!s:{label_align}{label_width}} {format_value(value, value_format):>{value_width}}"
+
+
+def write_table(series, headers, out=None, value_format="{:.2f}"):
+    """Writes a result table line by line to a text stream (stdout by default); returns the rows written."""
+    out = sys.stdout if out is None else out
+    for line in iter_table_lines(series, headers, value_format):
+        out.write(line + "\n")
+    return len(series)
+
+
+def save_table(series, headers, file_path, value_format="{:.2f}"):
+    """Streams a result table to file_path, replacing it atomically once every row is written."""
+    atomic_write(file_path, (line + "\n" for line in iter_table_lines(series, headers, value_format)))
+
+
+def show_table(series, headers, value_format="{:.2f}", page_rows=RENDER_PAGE_ROWS):
+    """
+    Prints a result table a page at a time.
+
+    After each page of a longer table the user can show the next page, print
+    all remaining rows, save the whole table to a file, or stop.
+    """
+    lines = iter_table_lines(series, headers, value_format)
+    print(next(lines))
+    for shown, line in enumerate(lines, 1):
+        print(line)
+        if shown % page_rows or shown == len(series):
+            continue
+        answer = input(f"-- {shown:,} of {len(series):,} rows. Enter: next page, a: all, s: save to file, q: stop -- ")
+        answer = answer.strip().lower()
+        if answer == "a":
+            for rest in lines:
+                print(rest)
+            break
+        if answer == "s":
+            file_path = input("Save the table to: ").strip()
+            try:
+                save_table(series, headers, file_path, value_format)
+                print(f"✅ Saved {len(series):,} rows to '{file_path}'.")
+            except OSError as e:
+                print(f"❌ Could not save the table: {e}")
+            break
+        if answer == "q":
+            break
+    print()
 
 
 # Function to display the menu and handle user input
@@ -63,9 +417,22 @@ def main_menu():
     Each option calls a corresponding function until the user chooses to exit.
     """
     while True:
+        if pending_load is not None:
+            if pending_load.future.done():
+                report_loaded(pending_load)
+            else:
+                print(f"\n{pending_load.status()}")
         print(menu_options)
 
-        choice = input("Enter your choice (1-8): ").strip()
+        choice = input("Enter your choice (1-17): ").strip()
+
+        # Options that need data still loading in the background wait for it, or are skipped
+        if choice in MENU_NEEDS and not ready_for(MENU_NEEDS[choice]):
+            continue
+
+        # Keep answers fresh while a ratings file is being watched
+        if active_watcher is not None:
+            poll_watcher()
 
         if choice == "1":
             print("Loading movies dataset...")
@@ -96,6 +463,44 @@ def main_menu():
             top_3_movies_fav_genre()
 
         elif choice == "8":
+            print("Exporting ranked tables...")
+            export_rankings()
+
+        elif choice == "9":
+            print("Watching a ratings file...")
+            watch_ratings()
+
+        elif choice == "10":
+            print("Recommending movies for you...")
+            recommend_movies()
+
+        elif choice == "11":
+            print("Finding users with similar taste...")
+            similar_users()
+
+        elif choice == "12":
+            print("Showing rating distributions...")
+            rating_distribution()
+
+        elif choice == "13":
+            print("Loading movies and ratings datasets...")
+            load_both()
+
+        elif choice == "14":
+            print("Searching movie titles...")
+            search_movies()
+
+        elif choice == "15":
+            print("Exporting the rating matrix...")
+            export_rating_matrix()
+
+        elif choice == "16":
+            print("Estimating rankings from a sample...")
+            approximate_rankings()
+
+        elif choice == "17":
+            if pending_load is not None and not pending_load.future.done():
+                print("Finishing the background load first...")
             print("Exiting program. Goodbye!")
             break
 
@@ -109,18 +514,16 @@ def load_movies():
     Loads or creates a movies dataset.
 
     Options:
-        - Load from a .txt file (pipe-separated)
+        - Load from a .txt file (pipe-separated), optionally .gz/.bz2/.xz compressed
         - Enter new data manually and save to a file
 
-    The dataset contains columns: ['movie_genre', 'movie_id', 'movie_name']
+    The dataset contains columns: ['movie_genre', 'movie_id', 'movie_name'],
+    one row per movie; 'movie_genre' may list several genres ('Action|Comedy').
 
     Validation requires 'movie_id' (Col 2) to be numeric AND
     'movie_name' (Col 3, which would be User ID in ratings.txt) to NOT be cleanly convertible to integers.
     """
-    global movies_df
     choice = input("Load from file (F) or enter new data (N)? ").strip().lower()
-    
-    expected_movie_cols = ["movie_genre", "movie_id", "movie_name"]
 
     # --- OPTION 1: Load from file ---
     if choice == "f":
@@ -138,56 +541,46 @@ def load_movies():
             if not os.path.splitext(file_path)[1]:
                 file_path += ".txt"
 
-            # Only allow .txt files
-            if not file_path.lower().endswith(".txt"):
-                print("⚠️ Only .txt files are supported. Please try again.\n")
+            # Only allow .txt files (optionally compressed)
+            if not is_supported_dataset(file_path):
+                print(f"⚠️ Only .txt files (optionally compressed as {COMPRESSED_SUFFIXES}) are supported. Please try again.\n")
                 continue
 
             # Try reading file
             try:
-                temp_df = pd.read_csv(file_path, sep="|", header=None, names=expected_movie_cols)
-
-                # --- VALIDATION STEP 1: Check column count and 'movie_id' (Col 2) for numeric content ---
-                if not validate_dataframe(temp_df, expected_movie_cols, numeric_check_col="movie_id"):
-                    print(
-                        f"❌ File structure mismatch! Column count or 'movie_id' data type is incorrect. Please check your file.")
-                    continue
-
-                    # --- VALIDATION STEP 2: CRITICAL CHECK to block ratings.txt ---
-                try:
-                    pd.to_numeric(temp_df["movie_name"], errors='raise').astype(int)
-                    is_mostly_integer = True
-                except (ValueError, TypeError):
-                    is_mostly_integer = False
-
-                if is_mostly_integer:
-                    print(
-                        "❌ Validation Failed! The third column's data type suggests this is the RATINGS file (User IDs). You need to upload the .txt with the movies in to this one.")
-                    continue
-
-                # Final cleaning and assignment
-                temp_df["movie_id"] = pd.to_numeric(temp_df["movie_id"], errors='coerce')
-                movies_df = temp_df.dropna(subset=['movie_id'])
-                
-                print("\n✅ Movies dataset loaded successfully.")
-                print(movies_df.head(), "\n")
-                break
+                source = file_fingerprint(file_path)
+                temp_df = read_movies_file(file_path)
+                source = unchanged_source(source, file_path)
+            except DatasetValidationError as e:
+                print(e)
+                continue
             except FileNotFoundError:
                 print("❌ File not found. Try again.\n")
+                continue
             except Exception as e:
                 print(f"⚠️ Error reading file: {e}\nPlease make sure it's a valid .txt file with '|' separators.\n")
+                continue
+
+            set_movies(temp_df, source)
+
+            print("\n✅ Movies dataset loaded successfully.")
+            print(movies_df.head(), "\n")
+            report_unmatched_titles()
+            break
 
     # --- OPTION 2: Enter new data manually ---
     elif choice == "n":
-        movies_df = pd.DataFrame(columns=["movie_genre", "movie_id", "movie_name"])
+        new_movies = pd.DataFrame(columns=["movie_genre", "movie_id", "movie_name"])
         print("Enter movie data (type 'done' to finish):\n")
         while True:
             movie_name = input("Movie name (or 'done' to stop): ").strip()
             if movie_name.lower() == "done":
                 break
-            movie_genre = input("Genre: ").strip()
+            movie_genre = input("Genre (separate several with '|'): ").strip()
             movie_id = int(input("Movie ID: ").strip())
-            movies_df.loc[len(movies_df)] = [movie_genre, movie_id, movie_name]
+            new_movies.loc[len(new_movies)] = [movie_genre, movie_id, movie_name]
+
+        set_movies(combine_movie_rows(new_movies))
 
         # Save file safely
         while True:
@@ -208,7 +601,7 @@ def load_movies():
                     continue
 
             # Save the file
-            movies_df.to_csv(file_path, sep="|", index=False, header=False)
+            save_movies_file(movies_df, file_path)
             print(f"\n✅ Movies data successfully saved to '{file_path}'.")
             print(movies_df, "\n")
             break
@@ -224,18 +617,20 @@ def load_ratings():
     Loads or creates a ratings dataset.
 
     Options:
-        - Load from a .txt file (pipe-separated)
+        - Load from a .txt file (pipe-separated), optionally .gz/.bz2/.xz compressed
         - Enter new data manually and save to a file
+        - Load merged aggregates saved by mapreduce_rankings.py (a .json
+          file, see set_aggregates) in place of the ratings
 
     The dataset contains columns: ['movie_name', 'rating', 'user_id'].
 
     Validation requires 'rating' (Col 2) to be numeric AND
     'user_id' (Col 3, which would be Movie Name in movies.txt) to be cleanly convertible to integers.
+
+    A file is loaded in the background (see start_background_load): the menu
+    comes back at once and reports the outcome when the file is loaded.
     """
-    global rating_df
-    choice = input("Load from file (F) or enter new data (N)? ").strip().lower()
-    
-    expected_rating_cols = ["movie_name", "rating", "user_id"]
+    choice = input("Load from file (F), enter new data (N) or load merged aggregates (A)? ").strip().lower()
 
     # --- OPTION 1: Load from file ---
     if choice == "f":
@@ -252,51 +647,20 @@ def load_ratings():
             if not os.path.splitext(file_path)[1]:
                 file_path += ".txt"
 
-            if not file_path.lower().endswith(".txt"):
-                print("⚠️ Only .txt files are supported. Please try again.\n")
+            if not is_supported_dataset(file_path):
+                print(f"⚠️ Only .txt files (optionally compressed as {COMPRESSED_SUFFIXES}) are supported. Please try again.\n")
                 continue
 
-            try:
-                temp_df = pd.read_csv(file_path, sep="|", header=None, names=expected_rating_cols)
-
-                # --- VALIDATION STEP 1: Check column count and 'rating' (Col 2) for numeric content ---
-                if not validate_dataframe(temp_df, expected_rating_cols, numeric_check_col="rating"):
-                    print(
-                        f"❌ File structure mismatch! The file columns ({expected_rating_cols}) or the 'rating' column data type is incorrect. Please ensure you are loading a ratings file.")
-                    continue
-
-                # --- VALIDATION STEP 2: CRITICAL CHECK to block movies.txt ---
-                try:
-                    pd.to_numeric(temp_df["user_id"], errors='raise').astype(int)
-                    is_mostly_integer = True
-                except (ValueError, TypeError):
-                    is_mostly_integer = False
-
-                # If the third column is NOT mostly integers, it's the wrong file.
-                if not is_mostly_integer:
-                    print(
-                        "❌ Validation Failed! The third column's data type suggests this is the MOVIES file (Movie Names). You need to upload the .txt with the ratings in to this one.")
-                    continue
-
-                # Clean and filter the data AFTER validation passes
-                temp_df["rating"] = pd.to_numeric(temp_df["rating"], errors="coerce")
-                temp_df.dropna(subset=["rating"], inplace=True)
-                temp_df = temp_df[(temp_df["rating"] >= 0) & (temp_df["rating"] <= 5)]
-
-                rating_df = temp_df
-
-                print("\n✅ Ratings dataset loaded successfully.")
-                print(rating_df.head(), "\n")
-                break
-
-            except FileNotFoundError:
+            if not os.path.exists(file_path):
                 print("❌ File not found. Try again.\n")
-            except Exception as e:
-                print(f"⚠️ Error reading file: {e}\nPlease make sure it's a valid .txt file with '|' separators.\n")
+                continue
+
+            start_background_load(ratings_path=file_path)
+            break
 
     # --- OPTION 2: Enter new data manually ---
     elif choice == "n":
-        rating_df = pd.DataFrame(columns=["movie_name", "rating", "user_id"])
+        new_ratings = pd.DataFrame(columns=["movie_name", "rating", "user_id"])
         print("Enter rating data (type 'done' to finish):\n")
 
         while True:
@@ -305,12 +669,13 @@ def load_ratings():
                 break
             rating = float(input("Rating (0-5): ").strip())
             user_id = int(input("User ID: ").strip())
-            rating_df.loc[len(rating_df)] = [movie_name, rating, user_id]
+            new_ratings.loc[len(new_ratings)] = [movie_name, rating, user_id]
 
         # 🧠 Convert and clean ratings here too
-        rating_df["rating"] = pd.to_numeric(rating_df["rating"], errors="coerce")
-        rating_df.dropna(subset=["rating"], inplace=True)
-        rating_df = rating_df[(rating_df["rating"] >= 0) & (rating_df["rating"] <= 5)]
+        new_ratings["user_id"] = new_ratings["user_id"].astype("int64")
+        set_ratings(clean_ratings(new_ratings))
+        stop_watching()
+        report_duplicates()
 
         while True:
             file_path = input("Enter filename to save: ").strip()
@@ -327,17 +692,537 @@ def load_ratings():
                     print("Please choose a different filename.\n")
                     continue
 
-            rating_df.to_csv(file_path, sep="|", index=False, header=False)
+            atomic_write(file_path, rating_df.to_csv(sep="|", index=False, header=False))
             print(f"\n✅ Ratings data successfully saved to '{file_path}'.")
             print(rating_df, "\n")
             break
 
+    # --- OPTION 3: Load merged aggregates ---
+    elif choice == "a":
+        while True:
+            file_path = input("Enter path to merged aggregates (or 'E' to exit): ").strip()
+            if file_path.lower() == "e":
+                print("Returning to main menu.")
+                return
+            if not os.path.splitext(file_path)[1]:
+                file_path += ".json"
+            if not os.path.exists(file_path):
+                print("❌ File not found. Try again.\n")
+                continue
+            try:
+                partial = PartialAggregates.load(file_path)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print(f"⚠️ Error reading file: {e}\nPlease make sure it's a merged aggregates .json file.\n")
+                continue
+            set_aggregates(partial)
+            stop_watching()
+            print(f"\n✅ Merged aggregates of {int(partial.titles['rating_count'].sum()):,} ratings loaded. "
+                  "Options that need individual ratings require a ratings file.")
+            break
+
     # --- INVALID OPTION ---
     else:
-        print("Invalid choice. Please enter 'F' or 'N'.")
+        print("Invalid choice. Please enter 'F', 'N' or 'A'.")
+
+
+# Function to load the movies and ratings datasets together
+def load_both():
+    """
+    Loads a movies file and a ratings file at the same time, in the background.
+
+    Both files are parsed and validated concurrently; if either fails,
+    neither replaces the loaded data.
+    """
+    paths = []
+    for kind in ("movies", "ratings"):
+        while True:
+            file_path = input(f"Enter path to {kind} dataset (or 'E' to exit): ").strip()
+            if file_path.lower() == "e":
+                print("Returning to main menu.")
+                return
+            if not os.path.splitext(file_path)[1]:
+                file_path += ".txt"
+            if not is_supported_dataset(file_path):
+                print(f"⚠️ Only .txt files (optionally compressed as {COMPRESSED_SUFFIXES}) are supported. "
+                      "Please try again.\n")
+                continue
+            if not os.path.exists(file_path):
+                print("❌ File not found. Try again.\n")
+                continue
+            paths.append(file_path)
+            break
+
+    start_background_load(*paths)
+
+
+def start_background_load(movies_path=None, ratings_path=None):
+    """Starts loading files in the background (see BackgroundLoad); the menu reports the outcome."""
+    global pending_load
+    if ratings_path:
+        # Appends from a watched file must not land in the ratings being replaced
+        stop_watching()
+    pending_load = BackgroundLoad(movies_path, ratings_path)
+    print(f"\n{pending_load.status()}\nThe menu stays available; options that need this data will wait for it.\n")
+
+
+def report_loaded(load):
+    """Prints the outcome of a finished background load, like a foreground load would, and clears it."""
+    global pending_load
+    if pending_load is load:
+        pending_load = None
+    try:
+        load.future.result()
+    except DatasetValidationError as e:
+        print(e)
+        return
+    except FileNotFoundError:
+        print("❌ File not found. Please check the path.\n")
+        return
+    except Exception as e:
+        print(f"⚠️ Error reading file: {e}\nPlease make sure it's a valid .txt file with '|' separators.\n")
+        return
+
+    print(f"\n✅ {load.what().capitalize()} loaded in {load.elapsed():.2f}s.")
+    if "movies" in load.kinds:
+        print(movies_df.head(), "\n")
+    if "ratings" in load.kinds:
+        print(ratings_preview(rating_df), "\n")
+        print(f"📦 {bytes_per_rating(rating_df):.1f} bytes per rating"
+              f"{' (compact mode)' if is_compact(rating_df) else ''}.\n")
+        report_duplicates()
+    report_unmatched_titles()
+
+
+def wait_for_load(load):
+    """
+    Shows a background load's progress until it finishes, then reports it.
+
+    Ctrl+C stops waiting (the load carries on). Returns: Whether it finished.
+    """
+    try:
+        while not load.future.done():
+            print(f"\r{load.status()}   ", end="", flush=True)
+            time.sleep(0.2)
+    except KeyboardInterrupt:
+        print("\nStill loading in the background.\n")
+        return False
+    print(f"\r{load.status()}   ")
+    report_loaded(load)
+    return True
+
+
+def ready_for(needed):
+    """
+    Checks a menu option against the pending background load.
+
+    Options that need none of the datasets being loaded run at once, on the
+    data already loaded. Otherwise the load's status is shown and the user
+    can wait for it or go back to the menu.
+
+    Args:
+        needed (tuple): The datasets the option reads, 'movies' and/or 'ratings'.
+    Returns: Whether to run the option.
+    """
+    load = pending_load
+    if load is None or not load.kinds & set(needed):
+        return True
+    if load.future.done():
+        report_loaded(load)
+        return True
+    print(load.status())
+    if input("This option needs the data being loaded. Wait for it? (Y/n): ").strip().lower() == "n":
+        return False
+    return wait_for_load(load)
+
+
+# Function to start following a growing ratings file
+def watch_ratings():
+    """
+    Loads a ratings file and keeps following it as another process appends to it.
+
+    New lines are folded in before every later menu action. The user can also
+    stay in a live view that prints arrivals until Ctrl+C.
+    """
+    global active_watcher
+    file_path = input("Enter path to ratings file to watch (or 'E' to exit): ").strip()
+    if file_path.lower() == 'e':
+        print("Returning to main menu.")
+        return
+    if not os.path.splitext(file_path)[1]:
+        file_path += ".txt"
+    if is_compressed(file_path):
+        print("⚠️ Compressed files cannot be followed as they grow. Load them with option 2 instead.\n")
+        return
+
+    watcher = RatingsWatcher(file_path)
+    try:
+        loaded = watcher.start()
+    except DatasetValidationError as e:
+        print(e)
+        return
+    except FileNotFoundError:
+        print("❌ File not found.\n")
+        return
+    except Exception as e:
+        print(f"⚠️ Error reading file: {e}\nPlease make sure it's a valid .txt file with '|' separators.\n")
+        return
+
+    active_watcher = watcher
+    print(f"\n✅ Loaded {loaded} ratings; new lines will be picked up before each menu action.")
+    report_duplicates()
+    if input("Show arrivals live until Ctrl+C (Y/N)? ").strip().lower() == "y":
+        watcher.watch()
+
+
+def stop_watching():
+    """Stops following the watched ratings file (e.g. because another ratings file was loaded)."""
+    global active_watcher
+    if active_watcher is not None:
+        print(f"Stopped watching '{active_watcher.file_path}'.")
+        active_watcher = None
+
+
+def poll_watcher():
+    """Folds new lines from the watched ratings file into the loaded data, reporting what changed."""
+    before = duplicate_ratings or 0
+    try:
+        added, reloaded = active_watcher.poll()
+    except DatasetValidationError as e:
+        print(e)
+        return
+    except Exception as e:
+        print(f"⚠️ Could not read the watched ratings file: {e}")
+        return
+    if reloaded:
+        print(f"🔄 Watched ratings file was truncated or rotated; reloaded {added} ratings.")
+        report_duplicates()
+    elif added:
+        print(f"➕ {added} new ratings picked up from the watched file.")
+        report_duplicates((duplicate_ratings or 0) - before)
+
+
+# Function to report ratings that match no movie
+def get_unmatched_titles(n=None):
+    """
+    Returns the rated titles that match no catalogue movie, even by canonical key.
+
+    Computed once per load or append, so this is a lookup.
+
+    Returns:
+        pd.Series | None: Rating count per title, most rated first (the top n
+        if given), or None unless both datasets are loaded.
+    """
+    dataset = current_dataset
+    unmatched = dataset.unmatched_titles
+    if dataset.movies_df is None or unmatched is None:
+        return None
+    return unmatched if n is None else unmatched.head(n)
+
+
+def report_duplicates(collapsed=None):
+    """Prints how many duplicate ratings (same user and movie) were collapsed: `collapsed`, else all those of the loaded ratings."""
+    collapsed = duplicate_ratings if collapsed is None else collapsed
+    if collapsed:
+        print(f"🔁 {collapsed:,} duplicate ratings of a movie by the same user collapsed ('{snapshots.DUPLICATE_POLICY}' policy).\n")
+
+
+def report_unmatched_titles():
+    """Prints how many ratings are left out of the genre queries because their title is not in the catalogue."""
+    unmatched = get_unmatched_titles()
+    if unmatched is None or unmatched.empty:
+        return
+    examples = ", ".join(f"'{title}' ({count})" for title, count in unmatched.head(3).items())
+    print(f"⚠️ {int(unmatched.sum()):,} ratings of {len(unmatched):,} titles match no movie in the catalogue, "
+          f"e.g. {examples}.\n")
+
+
+class Query:
+    """
+    A lazy query over the loaded data: filters, a grouping and a top-k,
+    recorded by chained calls and run together by execute().
+
+        Query().genre("Comedy").raters_of("Toy Story (1995)").min_ratings(50).top(20).execute()
+
+    Every call returns a new Query, so a partial query can be shared and
+    extended. Nothing is computed until execute(), which plans the chain as
+    a whole:
+
+    - Without rating-level filters (users, raters_of, ratings_between) the
+      answer is read from the aggregates built at load: the per-title
+      totals, or the per-movie and per-genre sums sliced through the genre
+      index.
+    - Otherwise only the candidate rating rows are visited - those of the
+      named users, sliced out through the user index, or every row if no
+      user is named. All filters are applied to them as one mask and a
+      single bincount reduces them to per-movie (or per-genre) sums.
+    - min_ratings and top run last, on the grouped averages.
+
+    Movie filters (genre, movies) select catalogue movies; several of them
+    keep only the movies matching all. The grouping is by movie unless
+    by_genre() is called, in which case each rating counts toward every
+    genre of its movie.
+    """
+
+    def __init__(self, steps=()):
+        self.steps = tuple(steps)
+
+    def __repr__(self):
+        return f"Query({self.steps!r})"
+
+    def step(self, name, *args):
+        """Returns a copy of this query with one more step recorded."""
+        return Query(self.steps + ((name, args),))
+
+    def genre(self, genre):
+        """Keeps the movies of a genre (matched case- and whitespace-insensitively)."""
+        return self.step("genre", genre)
+
+    def movies(self, titles):
+        """Keeps the given catalogue titles (matched on their canonical keys)."""
+        return self.step("movies", tuple(titles))
+
+    def users(self, user_ids):
+        """Keeps the ratings given by these users."""
+        return self.step("users", tuple(user_ids))
+
+    def raters_of(self, title):
+        """Keeps the ratings of users who rated a catalogue title."""
+        return self.step("raters_of", title)
+
+    def ratings_between(self, low, high):
+        """Keeps the ratings from low to high stars, inclusive."""
+        return self.step("ratings_between", low, high)
+
+    def by_genre(self):
+        """Groups the ratings by genre instead of by movie."""
+        return self.step("by_genre")
+
+    def include_unrated(self):
+        """Also lists the catalogue movies (or genres) without ratings, with a NaN average ranked last."""
+        return self.step("include_unrated")
+
+    def min_ratings(self, count):
+        """Keeps the movies (or genres) with at least `count` ratings."""
+        return self.step("min_ratings", count)
+
+    def top(self, n):
+        """Keeps the n highest averages (see rank_descending)."""
+        return self.step("top", n)
+
+    def plan(self):
+        """Folds the recorded steps into a dict describing the work to do."""
+        plan = {"genres": [], "titles": [], "users": [], "raters_of": [], "between": [], "by_genre": False,
+                "unrated": False, "min_count": 0, "n": None}
+        for name, args in self.steps:
+            if name == "genre":
+                plan["genres"].append(args[0])
+            elif name == "movies":
+                plan["titles"].append(args[0])
+            elif name == "users":
+                plan["users"].append(args[0])
+            elif name == "raters_of":
+                plan["raters_of"].append(args[0])
+            elif name == "ratings_between":
+                plan["between"].append(args)
+            elif name == "by_genre":
+                plan["by_genre"] = True
+            elif name == "include_unrated":
+                plan["unrated"] = True
+            elif name == "min_ratings":
+                plan["min_count"] = max(plan["min_count"], args[0])
+            elif name == "top" and args[0] is not None:
+                plan["n"] = args[0] if plan["n"] is None else min(plan["n"], args[0])
+        plan["scan"] = bool(plan["users"] or plan["raters_of"] or plan["between"])
+        return plan
+
+    def execute(self, dataset=None):
+        """
+        Runs the query against one snapshot: `dataset`, by default the current one.
+
+        Returns:
+            pd.Series | None: Average rating named 'rating', indexed by
+            movie_name (or movie_genre), best first; None if a genre is
+            unknown or the data the query needs is not loaded.
+        """
+        dataset = current_dataset if dataset is None else dataset
+        plan = self.plan()
+        if plan["genres"] or plan["titles"] or plan["by_genre"] or plan["unrated"]:
+            if dataset.movies_df is None:
+                return None
+        if dataset.title_totals is None or (plan["scan"] and dataset.rating_df is None):
+            return None
+
+        movies = query_movie_rows(dataset, plan)
+        if movies is False:
+            return None
+        if plan["scan"]:
+            grouped = scan_ratings(dataset, plan, movies)
+        else:
+            grouped = aggregated_ratings(dataset, plan, movies)
+
+        names, sums, counts = grouped
+        keep = counts >= max(plan["min_count"], 0 if plan["unrated"] else 1)
+        if not keep.all():
+            names, sums, counts = names[keep], sums[keep], counts[keep]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            averages = sums / counts
+        index = names if isinstance(names, pd.Index) else pd.Index(names)
+        index_name = "movie_genre" if plan["by_genre"] else "movie_name"
+        if index.name != index_name:
+            index = index.rename(index_name)
+        return rank_descending(pd.Series(averages, index=index, name="rating"), plan["n"])
+
+
+def query_movie_rows(dataset, plan):
+    """
+    Returns the movies_df rows a query's movie filters keep: None if it has
+    none, False if a genre is unknown.
+    """
+    rows = None
+    for genre in plan["genres"]:
+        in_genre = dataset.genre_index.get(normalize_genre(genre))
+        if in_genre is None:
+            return False
+        rows = in_genre if rows is None else np.intersect1d(rows, in_genre)
+    for titles in plan["titles"]:
+        found = dataset.movie_keys.get_indexer(title_keys(titles))
+        found = np.sort(found[found >= 0])
+        rows = found if rows is None else np.intersect1d(rows, found)
+    return rows
+
+
+def query_user_rows(dataset, plan):
+    """
+    Returns the rating rows of the users a query keeps (the users named, and
+    raters of each title); `dataset` has its user index (see with_user_index).
+    """
+    user_sets = [np.asarray(ids) for ids in plan["users"]]
+    user_ids = dataset.rating_df["user_id"].to_numpy()
+    for title in plan["raters_of"]:
+        movie = -1 if dataset.movie_keys is None else dataset.movie_keys.get_indexer([title_key(title)])[0]
+        rated = np.flatnonzero(dataset.rating_movie_rows == movie) if movie >= 0 else np.array([], dtype=np.intp)
+        user_sets.append(user_ids[rated])
+
+    codes = None
+    for ids in user_sets:
+        found = dataset.user_keys.get_indexer(ids)
+        codes = found[found >= 0] if codes is None else np.intersect1d(codes, found[found >= 0])
+    codes = np.sort(codes)
+    codes = codes[np.r_[True, codes[1:] != codes[:-1]]] if len(codes) else codes
+
+    bounds = dataset.user_bounds
+    starts, lengths = bounds[codes], bounds[codes + 1] - bounds[codes]
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return dataset.user_row_order[np.arange(lengths.sum()) + offsets]
+
+
+def scan_ratings(dataset, plan, movies):
+    """
+    Reduces the rating rows a query keeps to (names, sums, counts) per group, in one masked pass.
+
+    Rated titles outside the catalogue are grouped under their cleaned titles
+    when neither a movie filter nor the genre grouping excludes them.
+    """
+    ratings = dataset.rating_df
+    if plan["users"] or plan["raters_of"]:
+        dataset = with_user_index(dataset)
+        rows = query_user_rows(dataset, plan)
+    else:
+        rows = np.arange(len(ratings))
+    values = rating_values(ratings, rows)
+    n_movies = 0 if dataset.movies_df is None else len(dataset.movies_df)
+    movie_rows = np.full(len(rows), -1) if dataset.rating_movie_rows is None else dataset.rating_movie_rows[rows]
+
+    keep = np.ones(len(rows), dtype=bool)
+    for low, high in plan["between"]:
+        keep &= (values >= low) & (values <= high)
+    if movies is not None:
+        selected = np.zeros(n_movies + 1, dtype=bool)
+        selected[movies] = True
+        keep &= selected[movie_rows]
+    matched = keep & (movie_rows >= 0)
+    sums = np.bincount(movie_rows[matched], weights=values[matched], minlength=n_movies)
+    counts = np.bincount(movie_rows[matched], minlength=n_movies)
+    if plan["by_genre"]:
+        rated = np.flatnonzero(counts)
+        return group_by_genre(dataset, rated, sums[rated], counts[rated])
+
+    if movies is not None:
+        return query_movie_names(dataset, movies), sums[movies], counts[movies]
+    movies = np.arange(n_movies) if plan["unrated"] else np.flatnonzero(counts)
+    names, sums, counts = query_movie_names(dataset, movies), sums[movies], counts[movies]
+    unmatched = keep & (movie_rows < 0)
+    if unmatched.any():
+        codes, titles = pd.factorize(ratings["movie_name"].iloc[rows[unmatched]])
+        label_codes, labels = pd.factorize(clean_titles(titles))
+        label_rows = label_codes[codes]
+        names = names.append(pd.Index(np.asarray(labels, dtype=object)))
+        sums = np.concatenate([sums, np.bincount(label_rows, weights=values[unmatched], minlength=len(labels))])
+        counts = np.concatenate([counts, np.bincount(label_rows, minlength=len(labels))])
+    return names, sums, counts
+
+
+def aggregated_ratings(dataset, plan, movies):
+    """Reads (names, sums, counts) per group of a query without rating-level filters from the load-time aggregates."""
+    movie_sums, movie_counts = dataset.movie_sums, dataset.movie_counts
+    if plan["by_genre"]:
+        if movies is None:
+            return np.array(dataset.genre_names, dtype=object), dataset.genre_sums, dataset.genre_counts
+        return group_by_genre(dataset, movies, movie_sums[movies], movie_counts[movies])
+    if movies is not None:
+        return query_movie_names(dataset, movies), movie_sums[movies], movie_counts[movies]
+
+    totals = dataset.title_totals
+    names = totals.index
+    sums, counts = totals["rating_sum"].to_numpy(), totals["rating_count"].to_numpy()
+    if plan["unrated"] and dataset.movies_df is not None:
+        unrated = ~pd.Index(dataset.movies_df["movie_name"]).isin(totals.index)
+        names = names.append(query_movie_names(dataset, np.flatnonzero(unrated)))
+        sums = np.concatenate([sums, np.zeros(unrated.sum())])
+        counts = np.concatenate([counts, np.zeros(unrated.sum(), dtype=np.int64)])
+    return names, sums, counts
+
+
+def query_movie_names(dataset, movies):
+    """Returns the titles of some movies_df rows as a pd.Index, converting only those rows."""
+    if not len(movies):
+        return pd.Index([], dtype=object)
+    return pd.Index(dataset.movies_df["movie_name"].take(movies).to_numpy(dtype=object))
+
+
+def group_by_genre(dataset, movies, sums, counts):
+    """Folds per-movie sums and counts (of the movies_df rows `movies`) into per-genre ones: (names, sums, counts)."""
+    indicator = genre_matrix(dataset, movies)
+    names = np.array(dataset.genre_names, dtype=object)
+    return names, sums @ indicator, counts @ indicator
+
+
+def ratings_loaded(need_movies=False, need_rows=False):
+    """
+    Checks that the datasets a menu option needs are loaded, printing what to load if not.
+
+    Merged aggregates (see set_aggregates) count as loaded ratings, unless
+    the option needs the individual rating rows (need_rows).
+    """
+    if (need_movies and movies_df is None) or (rating_df is None and not aggregates_only):
+        if need_movies:
+            print("Error: Please load both movies and ratings datasets first.")
+        else:
+            print("Error: Please load the ratings dataset first (option 2).")
+        return False
+    if need_rows and rating_df is None:
+        print("Error: Only merged rating aggregates are loaded; this option needs a ratings file (option 2).")
+        return False
+    return True
 
 
 # Function to show top N movies overall
+@cached_result
+def get_top_n_movies(n):
+    """Returns the top N rated titles by average rating, from the per-title totals built at load."""
+    return Query().top(n).execute()
+
+
 def top_n_movies():
     """
     Displays the top N movies with the highest average ratings.
@@ -345,10 +1230,7 @@ def top_n_movies():
     Prompts the user to enter N and prints the movies sorted by their
     average rating in descending order.
     """
-    global rating_df
-
-    if rating_df is None:
-        print("Error: Please load the ratings dataset first (option 2).")
+    if not ratings_loaded():
         return
 
     try:
@@ -356,24 +1238,36 @@ def top_n_movies():
     except ValueError:
         print("Invalid number. Please enter a numeric value.")
         return
-    avg_ratings = rating_df.groupby("movie_name")["rating"].mean().sort_values(ascending=False).head(n)
-
-    avg_ratings_df = avg_ratings.reset_index()
-    avg_ratings_df.columns = ["Movie Name", "Average Rating"]
+    avg_ratings = get_top_n_movies(n)
 
     print(f"\nTop {n} Movies:")
-    print(avg_ratings_df.to_string(index=False, justify="left", formatters={"Average Rating": "{:.2f}".format}), "\n")
+    show_table(avg_ratings, ("Movie Name", "Average Rating"))
 
 
 # Function to show top N movies by genre
+@cached_result
+def get_top_n_movies_genre(genre, n):
+    """
+    Returns the top N movies of a genre by average rating.
+
+    The genre name is matched case- and whitespace-insensitively through the
+    genre index, and averages come from the per-movie aggregates, so the cost
+    is proportional to the number of movies in the genre.
+    Movies with no ratings are included with a NaN average, ranked last.
+
+    Returns:
+        pd.Series | None: Average rating indexed by movie name, or None if the genre is unknown.
+    """
+    return Query().genre(genre).include_unrated().top(n).execute()
+
+
 def top_n_movies_genre():
     """
     Displays the top N movies within a given genre based on average ratings.
 
     Requires both the movies and ratings datasets to be loaded.
     """
-    if movies_df is None or rating_df is None:
-        print("Error: Please load both movies and ratings datasets first.")
+    if not ratings_loaded(need_movies=True):
         return
     
     genre = input("Enter genre: ").strip().lower()
@@ -384,31 +1278,35 @@ def top_n_movies_genre():
         print("Invalid number. Please enter a numeric value.")
         return
     
-    genre_movies = movies_df[movies_df["movie_genre"].str.lower() == genre]
+    avg_ratings = get_top_n_movies_genre(genre, n)
 
-    if genre_movies.empty:
+    if avg_ratings is None or avg_ratings.empty:
         print(f"No movies found for genre '{genre}'.\n")
         return
-    
-    merged = rating_df.merge(genre_movies, on="movie_name", how="right")
-    avg_ratings = merged.groupby("movie_name")["rating"].mean().sort_values(ascending=False).head(n)
 
-    avg_ratings_df = avg_ratings.reset_index()
-    avg_ratings_df.columns = ["Movie Name", "Average Rating"]
-    
     print(f"\nTop {n} {genre} Movies:")
-    print(avg_ratings_df.to_string(index=False, formatters={"Average Rating": "{:.2f}".format}), "\n")
+    show_table(avg_ratings, ("Movie Name", "Average Rating"))
 
 
 # Function to show top N genres
+@cached_result
+def get_top_n_genres(n):
+    """
+    Returns the top N genres by the average of all ratings given to their movies.
+
+    Uses the per-genre sums and counts built at load time, so no ratings x
+    movies join is materialised.
+    """
+    return Query().by_genre().top(n).execute()
+
+
 def top_n_genre():
     """
     Displays the top N genres based on average movie ratings.
 
     Requires both the movies and ratings datasets to be loaded.
     """
-    if movies_df is None or rating_df is None:
-        print("Error: Please load both movies and ratings datasets first.")
+    if not ratings_loaded(need_movies=True):
         return
     
     try:
@@ -417,55 +1315,740 @@ def top_n_genre():
         print("Invalid number. Please enter a numeric value.")
         return
     
-    merged = rating_df.merge(movies_df, on="movie_name")
-    avg_ratings = merged.groupby("movie_genre")["rating"].mean().sort_values(ascending=False).head(n)
+    avg_ratings = get_top_n_genres(n)
 
-    avg_ratings_df = avg_ratings.reset_index()
-    avg_ratings_df.columns = ["Movie Genre", "Average Rating"]
-    
     print(f"\nTop {n} Genres:")
-    print(avg_ratings_df.to_string(index=False, justify="left", formatters={"Average Rating": "{:.2f}".format}), "\n")
+    show_table(avg_ratings, ("Movie Genre", "Average Rating"))
 
 
-# Function to show the user's most preferred genre
-def preferred_genre(user_id=None):
-    """
-    Displays the user's most preferred genre based on their average ratings.
+# Share of a ratings file kept by a uniform sample, ratings kept per title by a
+# stratified one, and the confidence level of the intervals on sampled averages
+SAMPLE_RATE = 0.01
+SAMPLE_PER_TITLE = 30
+SAMPLE_CONFIDENCE = 0.95
 
-    Args:
-        user_id (int, optional): User ID to calculate preferences for. 
-                                 If None, the user is prompted to enter one.
+# Ratings kept by a uniform sample of a file whose size cannot be estimated (compressed files)
+SAMPLE_DEFAULT_SIZE = 100_000
 
-    Returns:
-        str | list | None: The user's top genre(s), or None if no data is found.
-    """
-    global movies_df, rating_df
 
-    if movies_df is None or rating_df is None:
-        print("Error: Please load both movies and ratings datasets first.")
-        return
+class RatingsSample:
+    """
+    A reservoir sample of ratings, built block by block while a ratings file is read.
+
+    Every rating offered to add() draws a random key, and the sample keeps
+    the ratings with the smallest keys: the `capacity` smallest overall (a
+    uniform sample), or the `capacity` smallest of each title when
+    `stratified` (so every title is represented, and rarely rated titles
+    keep all their ratings). Either way the ratings kept of a title are a
+    simple random sample of them, whatever the order of the file, and the
+    memory used is bounded by the capacity. A rating whose key is above the
+    largest one kept (of its title, when stratified) cannot enter, so most
+    of a block is discarded before it is copied.
+
+    The kept ratings are stored by title code: values[i] rates
+    titles[codes[i]]. title_sizes counts every rating seen per title, to
+    scale the estimates of sample_estimates(). A sample must not be changed
+    once installed with set_sample().
+    """
 
-    if user_id is None:
-        try:
-            user_id = int(input("Enter your user ID: ").strip())
-        except ValueError:
-            print("Invalid user ID. Please enter a numeric value.\n")
+    def __init__(self, capacity, stratified=False, seed=None):
+        if capacity < (2 if stratified else 1):
+            raise ValueError("A sample keeps at least one rating, or two per title when stratified.")
+        self.capacity = int(capacity)
+        self.stratified = stratified
+        self.rng = np.random.default_rng(seed)
+        self.titles = pd.Index([], dtype=object)
+        self.title_sizes = np.zeros(0, dtype=np.int64)
+        self.thresholds = np.zeros(0)
+        self.codes = np.zeros(0, dtype=np.intp)
+        self.values = np.zeros(0)
+        self.keys = np.zeros(0)
+        self.rows_seen = 0
+        self.file_path = None
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __repr__(self):
+        kind = f"{self.capacity} per title" if self.stratified else "uniform"
+        return f"RatingsSample({kind}, {len(self):,} of {self.rows_seen:,} ratings)"
+
+    def title_codes(self, names):
+        """Maps a block's titles to positions in self.titles, adding the new ones (-1 for missing titles)."""
+        if isinstance(names.dtype, pd.CategoricalDtype):
+            codes, uniques = names.cat.codes.to_numpy(), names.cat.categories
+        else:
+            codes, uniques = pd.factorize(names)
+        found = self.titles.get_indexer(uniques)
+        new = found < 0
+        if new.any():
+            found[new] = np.arange(len(self.titles), len(self.titles) + new.sum())
+            self.titles = self.titles.append(pd.Index(np.asarray(uniques[new], dtype=object)))
+            self.title_sizes = np.concatenate([self.title_sizes, np.zeros(new.sum(), dtype=np.int64)])
+            self.thresholds = np.concatenate([self.thresholds, np.ones(new.sum())])
+        return np.append(found, -1)[codes]
+
+    def add(self, df):
+        """Offers a block of cleaned ratings to the sample."""
+        codes = self.title_codes(df["movie_name"])
+        keys = self.rng.random(len(df))
+        named = codes >= 0
+        self.rows_seen += int(named.sum())
+        self.title_sizes += np.bincount(codes[named], minlength=len(self.titles))
+        if self.stratified:
+            limits = self.thresholds[codes]
+        else:
+            limits = self.keys.max() if len(self.keys) >= self.capacity else 1.0
+        candidates = np.flatnonzero(named & (keys < limits))
+
+        self.codes = np.concatenate([self.codes, codes[candidates]])
+        self.values = np.concatenate([self.values, rating_values(df, candidates)])
+        self.keys = np.concatenate([self.keys, keys[candidates]])
+        self.evict()
+
+    def evict(self):
+        """Drops the ratings beyond the capacity (those with the largest keys) and updates the entry thresholds."""
+        if not self.stratified:
+            if len(self.keys) > self.capacity:
+                self.keep(np.sort(np.argpartition(self.keys, self.capacity - 1)[:self.capacity]))
             return
 
-    user_ratings = rating_df[rating_df["user_id"] == user_id]
-    merged = user_ratings.merge(movies_df, on="movie_name", how="inner")
-
-    if merged.empty:
-        print("No ratings found for this user.\n")
-        return None
+        kept = np.bincount(self.codes, minlength=len(self.titles))
+        over = kept > self.capacity
+        if over.any():
+            rows = np.flatnonzero(over[self.codes])
+            rows = rows[np.lexsort((self.keys[rows], self.codes[rows]))]
+            sorted_codes = self.codes[rows]
+            starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+            ranks = np.arange(len(rows)) - np.repeat(starts, np.diff(np.r_[starts, len(rows)]))
+            keep = np.ones(len(self.keys), dtype=bool)
+            keep[rows[ranks >= self.capacity]] = False
+            self.keep(np.flatnonzero(keep))
+
+        # A full title's threshold is its largest kept key; titles with room keep a threshold of 1
+        changed = over | ((kept >= self.capacity) & (self.thresholds >= 1))
+        if changed.any():
+            rows = np.flatnonzero(changed[self.codes])
+            self.thresholds[changed] = 0
+            np.maximum.at(self.thresholds, self.codes[rows], self.keys[rows])
+
+    def keep(self, rows):
+        """Keeps only the sampled ratings at positions `rows`."""
+        self.codes, self.values, self.keys = self.codes[rows], self.values[rows], self.keys[rows]
+
+    def rate(self):
+        """Share of the ratings seen that the sample kept."""
+        return len(self) / self.rows_seen if self.rows_seen else 1.0
+
+
+def load_ratings_sample(file_path, rate=SAMPLE_RATE, per_title=None, backend=None, seed=None):
+    """
+    Samples a ratings file while reading it, without keeping the whole file in memory.
 
-    avg_ratings = merged.groupby("movie_genre")["rating"].mean().sort_values(ascending=False)
+    The file is validated block by block as read_ratings_file() would. With
+    `per_title` the sample is stratified by title, keeping up to that many
+    ratings of each; otherwise it keeps about `rate` of the ratings,
+    uniformly (the reservoir is sized from estimate_rows()).
 
-    top_score = avg_ratings.iloc[0]
-    top_genres = avg_ratings[avg_ratings == top_score].index.tolist()
-    print(f"\nYour most preferred genre(s): {', '.join(top_genres)}\n")
+    Returns: The RatingsSample (not installed; see set_sample).
+    Raises: DatasetValidationError if the file is not a ratings file.
+    """
+    if per_title is not None:
+        sample = RatingsSample(per_title, stratified=True, seed=seed)
+    else:
+        rows = estimate_rows(file_path)
+        sample = RatingsSample(max(1, int(np.ceil(rate * rows))) if rows else SAMPLE_DEFAULT_SIZE, seed=seed)
+    for _, block in iter_ratings_blocks(file_path, backend=backend):
+        sample.add(block)
+    sample.file_path = file_path
+    return sample
 
-    return top_genres
+
+def set_sample(sample):
+    """Installs a RatingsSample (or None) for the approximate queries, leaving the loaded ratings alone."""
+    while True:
+        base = current_dataset
+        if publish(base.replace(version=base.version + 1, rating_sample=sample), base):
+            return
+
+
+def srs_estimates(n, sums, squares, population):
+    """
+    Estimates averages from simple random samples drawn without replacement.
+
+    Args:
+        n, sums, squares (np.ndarray): Size of each sample, sum of its ratings and of their squares.
+        population (np.ndarray): Number of ratings each sample was drawn from.
+
+    Returns: (means, variances of the means), with the finite population
+    correction; the variance is NaN for a single rating out of several.
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / n
+        spread = np.maximum(squares - sums * means, 0) / (n - 1)
+        correction = np.clip(1 - n / population, 0, 1)
+        variances = np.where(correction > 0, correction * spread / n, 0.0)
+    return means, variances
+
+
+def sample_estimates(by_genre=False, genre=None, confidence=SAMPLE_CONFIDENCE):
+    """
+    Estimates the average rating of every title (or genre) from the ratings sample.
+
+    The sampled ratings are summed per title, then grouped like the
+    exact queries: under catalogue names (see title_labels), or by genre,
+    each title counting toward every genre of its movie. A uniform sample
+    gives each group the mean of its sampled ratings; a stratified one
+    weights each title's mean by the number of ratings it has in the file.
+    Intervals use the normal approximation at the `confidence` level.
+
+    Args:
+        by_genre (bool): Group by genre instead of by title.
+        genre (str, optional): Keep the catalogue movies of this genre only.
+        confidence (float): Confidence level of the intervals.
+
+    Returns:
+        pd.DataFrame | None: Columns rating, low, high (the interval) and
+        sampled (the sampled ratings behind the estimate), indexed by
+        movie_name (or movie_genre); None if no sample is loaded, the genre
+        is unknown or a genre query has no movies loaded.
+    """
+    dataset = current_dataset
+    sample = dataset.rating_sample
+    if sample is None or ((by_genre or genre is not None) and dataset.movies_df is None):
+        return None
+
+    codes, values = sample.codes, sample.values
+    n = np.bincount(codes, minlength=len(sample.titles))
+    sums = np.bincount(codes, weights=values, minlength=len(sample.titles))
+    squares = np.bincount(codes, weights=values * values, minlength=len(sample.titles))
+    # Only the titles with sampled ratings are labelled and grouped
+    sampled_titles = np.flatnonzero(n)
+    n, sums, squares = n[sampled_titles], sums[sampled_titles], squares[sampled_titles]
+    titles = pd.Series(sample.titles.take(sampled_titles))
+
+    keep = slice(None)
+    if by_genre or genre is not None:
+        rows = movie_positions(titles, dataset.movie_keys)
+        keep = rows >= 0
+        if genre is not None:
+            in_genre = dataset.genre_index.get(normalize_genre(genre))
+            if in_genre is None:
+                return None
+            keep = np.isin(rows, in_genre)
+    if by_genre:
+        indicator = genre_matrix(dataset, rows[keep]).astype(float)
+        names = pd.Index(dataset.genre_names, dtype=object, name="movie_genre")
+
+        def total(x):
+            return x[keep] @ indicator
+    else:
+        labels = title_labels(titles[keep], dataset.movies_df, dataset.movie_keys)
+        label_codes, labels = pd.factorize(labels)
+        names = pd.Index(np.asarray(labels, dtype=object), name="movie_name")
+
+        def total(x):
+            return np.bincount(label_codes, weights=x[keep], minlength=len(names))
+
+    sampled = total(n)
+    if sample.stratified:
+        population = sample.title_sizes[sampled_titles].astype(float)
+        means, variances = srs_estimates(n, sums, squares, population)
+        weights = total(population)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            estimates = total(population * means) / weights
+            variances = total(population * population * variances) / (weights * weights)
+    else:
+        estimates, variances = srs_estimates(sampled, total(sums), total(squares), sampled / sample.rate())
+
+    margins = statistics.NormalDist().inv_cdf((1 + confidence) / 2) * np.sqrt(variances)
+    table = pd.DataFrame({"rating": estimates, "low": estimates - margins, "high": estimates + margins,
+                          "sampled": sampled.astype(np.int64)}, index=names)
+    return table[table["sampled"] > 0]
+
+
+def rank_estimates(table, n):
+    """Orders a sample_estimates() table like rank_descending() orders averages, keeping the top n rows."""
+    if table is None:
+        return None
+    return table.loc[rank_descending(table["rating"], n).index]
+
+
+def get_approximate_top_n_movies(n, genre=None, confidence=SAMPLE_CONFIDENCE):
+    """
+    Estimates the top N titles (of a genre, if given) from the ratings sample.
+
+    Returns: A sample_estimates() table, best first, or None (see sample_estimates).
+    """
+    return rank_estimates(sample_estimates(genre=genre, confidence=confidence), n)
+
+
+def get_approximate_top_n_genres(n, confidence=SAMPLE_CONFIDENCE):
+    """
+    Estimates the top N genres from the ratings sample.
+
+    Returns: A sample_estimates() table, best first, or None (see sample_estimates).
+    """
+    return rank_estimates(sample_estimates(by_genre=True, confidence=confidence), n)
+
+
+def format_estimates(table):
+    """Formats a sample_estimates() table as one 'average ± margin (n=sampled)' string per row."""
+    margins = (table["high"] - table["rating"]).to_numpy()
+    return pd.Series([f"{rating:.2f} ± {margin:.2f} (n={sampled:,})" if not np.isnan(margin)
+                      else f"{rating:.2f} ± ? (n={sampled:,})"
+                      for rating, margin, sampled in zip(table["rating"], margins, table["sampled"])],
+                     index=table.index)
+
+
+def approximate_rankings():
+    """
+    Displays rankings estimated from a sample of a ratings file, with confidence intervals.
+
+    The user samples a ratings file (uniformly at a chosen rate, or up to a
+    number of ratings per title) or reuses the sample taken last, then picks
+    the top N movies, the top N movies of a genre or the top N genres.
+    Genre rankings need the movies dataset.
+    """
+    file_path = input("Enter path to a ratings file to sample"
+                      f"{' (Enter to reuse the current sample)' if rating_sample is not None else ''}: ").strip()
+    if file_path:
+        if not os.path.splitext(file_path)[1]:
+            file_path += ".txt"
+        if not is_supported_dataset(file_path):
+            print(f"⚠️ Only .txt files (optionally compressed as {COMPRESSED_SUFFIXES}) are supported.\n")
+            return
+        try:
+            if input("Stratify by title (S) or sample uniformly (U)? ").strip().lower() == "s":
+                answer = input(f"Ratings to keep per title (default {SAMPLE_PER_TITLE}): ").strip()
+                rate, per_title = SAMPLE_RATE, int(answer) if answer else SAMPLE_PER_TITLE
+            else:
+                answer = input(f"Share of ratings to keep (default {SAMPLE_RATE}): ").strip()
+                rate, per_title = float(answer) if answer else SAMPLE_RATE, None
+        except ValueError:
+            print("Invalid number. Please enter a positive value.\n")
+            return
+        if not rate > 0 or (per_title is not None and per_title < 2):
+            print("Invalid number. Please keep a positive share of the ratings, or at least 2 per title.\n")
+            return
+
+        start = time.perf_counter()
+        try:
+            sample = load_ratings_sample(file_path, rate, per_title)
+        except DatasetValidationError as e:
+            print(e)
+            return
+        except FileNotFoundError:
+            print("❌ File not found. Please check the path.\n")
+            return
+        except (pd.errors.EmptyDataError, pd.errors.ParserError, UnicodeDecodeError) as e:
+            print(f"⚠️ Error reading file: {e}\nPlease make sure it's a valid .txt file with '|' separators.\n")
+            return
+        except OSError as e:
+            print(f"❌ Could not read '{file_path}': {e}\n")
+            return
+        set_sample(sample)
+        print(f"\n✅ Sampled {len(sample):,} of {sample.rows_seen:,} ratings ({sample.rate():.2%}) "
+              f"in {time.perf_counter() - start:.2f}s.\n")
+    elif rating_sample is None:
+        print("Error: Please enter a ratings file to sample.")
+        return
+
+    kind = input("Top movies (M), top movies of a genre (G) or top genres (R)? ").strip().lower()
+    try:
+        n = int(input("Enter N: ").strip())
+    except ValueError:
+        print("Invalid number. Please enter a numeric value.")
+        return
+    if kind == "g":
+        genre = input("Enter genre: ").strip().lower()
+        estimates, title, headers = get_approximate_top_n_movies(n, genre), f"{genre} Movies", "Movie Name"
+    elif kind == "r":
+        estimates, title, headers = get_approximate_top_n_genres(n), "Genres", "Movie Genre"
+    else:
+        estimates, title, headers = get_approximate_top_n_movies(n), "Movies", "Movie Name"
+
+    if estimates is None or estimates.empty:
+        print("No estimates: genre rankings need the movies dataset and a known genre.\n")
+        return
+    print(f"\nTop {n} {title} (estimated, {SAMPLE_CONFIDENCE:.0%} confidence):")
+    show_table(format_estimates(estimates), (headers, "Average Rating"), value_format="{}")
+
+
+# Function to search the movie titles
+def autocomplete_titles(prefix, limit=10):
+    """Returns up to `limit` catalogue titles starting with the prefix (case-insensitive), alphabetically."""
+    index = current_dataset.title_index
+    if index is None:
+        return []
+    return index.autocomplete(prefix, limit)
+
+
+def search_titles(query, limit=10, min_similarity=0.5):
+    """
+    Finds catalogue titles matching a partial or misspelt title.
+
+    Uses the trigram index built at load, so the cost depends on how many
+    titles share the query's rarest trigrams rather than on the catalogue size.
+
+    Returns:
+        pd.Series: The share of the query's trigrams each title contains,
+        indexed by movie name, best matches first (see TitleIndex.search).
+    """
+    index = current_dataset.title_index
+    if index is None:
+        return pd.Series(dtype=float, index=pd.Index([], name="movie_name"), name="similarity")
+    return index.search(query, limit, min_similarity)
+
+
+def search_movies():
+    """
+    Displays the titles that start with what the user typed, then the closest
+    matches anywhere in a title, tolerating typos.
+    """
+    if movies_df is None:
+        print("Error: Please load the movies dataset first (option 1).")
+        return
+    query = input("Enter part of a movie title: ").strip()
+    if not query:
+        print("Please enter some text to search for.\n")
+        return
+
+    completions = autocomplete_titles(query)
+    if completions:
+        print(f"\nTitles starting with '{query}':")
+        for title in completions:
+            print(f"  {title}")
+
+    matches = search_titles(query)
+    matches = matches[~matches.index.isin(completions)]
+    if not matches.empty:
+        print(f"\nOther titles matching '{query}':")
+        show_table(matches, ("Movie Name", "Match"), value_format="{:.0%}")
+    elif not completions:
+        print(f"No titles found for '{query}'.\n")
+    else:
+        print()
+
+
+def histogram_percentiles(histograms, q):
+    """
+    Percentiles of the ratings counted by each histogram row, in O(bins) per row.
+
+    Interpolates linearly between the two nearest ratings, like pandas'
+    quantile() on the ratings themselves.
+
+    Args:
+        histograms (np.ndarray): One histogram or a rows x 11 array of them.
+        q (float | sequence): Quantiles between 0 and 1.
+
+    Returns: A rows x len(q) array (NaN for rows without ratings).
+    """
+    histograms = np.atleast_2d(histograms)
+    q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+    cumulative = histograms.cumsum(axis=1)
+    position = q * np.maximum(cumulative[:, -1:] - 1, 0)
+    lower = np.floor(position)
+
+    def rating_at(rank):
+        # The rating of the rank-th smallest rating: how many bins end at or before it, in half stars
+        return (cumulative[:, None, :] <= rank[:, :, None]).sum(axis=2) / 2
+
+    low = rating_at(lower)
+    result = low + (position - lower) * (rating_at(np.ceil(position)) - low)
+    result[cumulative[:, -1] == 0] = np.nan
+    return result
+
+
+def rating_histogram(dataset, movie_name=None, genre=None):
+    """
+    Returns the half-star histogram of a title's or a genre's ratings in a
+    snapshot, or None if there is none (or the snapshot has no histograms).
+    """
+    if genre is not None:
+        if dataset.genre_histograms is None:
+            return None
+        pos = find_genre(genre, dataset)
+        return None if pos is None else dataset.genre_histograms[pos]
+    if dataset.title_histograms is None:
+        return None
+    label = title_labels([movie_name], dataset.movies_df, dataset.movie_keys)[0]
+    if label in dataset.title_histograms.index:
+        return dataset.title_histograms.loc[label].to_numpy()
+    return None
+
+
+@cached_result
+def get_rating_distribution(movie_name=None, genre=None):
+    """
+    Returns how many ratings a title (or a genre) received at each half star.
+
+    Returns:
+        pd.Series | None: Counts indexed by rating 0.0-5.0, or None for an
+        unknown title or genre, or if the ratings are not loaded.
+    """
+    histogram = rating_histogram(current_dataset, movie_name, genre)
+    if histogram is None:
+        return None
+    return pd.Series(histogram, index=pd.Index(HALF_STARS, name="rating"), name="count")
+
+
+@cached_result
+def get_rating_percentiles(movie_name=None, genre=None, q=(0.25, 0.5, 0.75)):
+    """
+    Returns percentiles of a title's (or a genre's) ratings from its histogram.
+
+    Returns:
+        pd.Series | None: Ratings indexed by quantile, or None for an unknown
+        title or genre, or if the ratings are not loaded.
+    """
+    histogram = rating_histogram(current_dataset, movie_name, genre)
+    if histogram is None:
+        return None
+    q = np.atleast_1d(q)
+    return pd.Series(histogram_percentiles(histogram, q)[0], index=pd.Index(q, name="quantile"), name="rating")
+
+
+@cached_result
+def get_top_n_movies_by_median(n, genre=None):
+    """
+    Returns the top N movies by median rating, overall or within a genre.
+
+    Medians come from the per-title (or per-movie) histograms, so no group
+    is sorted. Ties are broken by name; within a genre, movies without
+    ratings are listed last with a NaN median.
+
+    Returns:
+        pd.Series | None: Medians indexed by movie_name, or None for an
+        unknown genre or if the histograms it needs are not loaded.
+    """
+    dataset = current_dataset
+    if (dataset.title_histograms if genre is None else dataset.movie_histograms) is None:
+        return None
+    if genre is None:
+        histograms = dataset.title_histograms.to_numpy()
+        names = dataset.title_histograms.index
+    else:
+        pos = find_genre(genre, dataset)
+        if pos is None:
+            return None
+        rows = dataset.genre_index[normalize_genre(genre)]
+        histograms = dataset.movie_histograms[rows]
+        names = pd.Index(dataset.movies_df["movie_name"].to_numpy()[rows], name="movie_name")
+    medians = pd.Series(histogram_percentiles(histograms, 0.5)[:, 0], index=names, name="median_rating")
+    return rank_descending(medians, n)
+
+
+# Function to show rating distributions and medians
+def rating_distribution():
+    """
+    Displays the rating distribution and quartiles of a movie or a genre,
+    or the top N movies by median rating.
+    """
+    if not ratings_loaded():
+        return
+
+    print("1. Distribution of a movie's ratings")
+    print("2. Distribution of a genre's ratings")
+    print("3. Top N movies by median rating")
+    choice = input("Choose (1-3): ").strip()
+
+    if choice == "3":
+        try:
+            n = int(input("Enter N: ").strip())
+        except ValueError:
+            print("Invalid number. Please enter a numeric value.")
+            return
+        medians = get_top_n_movies_by_median(n)
+        print(f"\nTop {n} Movies by Median Rating:")
+        show_table(medians, ("Movie Name", "Median Rating"))
+        return
+
+    if choice == "1":
+        name = input("Enter the movie name: ").strip()
+        distribution = get_rating_distribution(movie_name=name)
+        quartiles = get_rating_percentiles(movie_name=name)
+    elif choice == "2":
+        if movies_df is None:
+            print("Error: Please load both movies and ratings datasets first.")
+            return
+        name = input("Enter the genre: ").strip()
+        distribution = get_rating_distribution(genre=name)
+        quartiles = get_rating_percentiles(genre=name)
+    else:
+        print("Invalid choice.")
+        return
+
+    if distribution is None or distribution.sum() == 0:
+        print(f"No ratings found for '{name}'.\n")
+        return
+
+    total = distribution.sum()
+    print(f"\nRatings of {name} ({total} ratings):")
+    for rating, count in distribution.items():
+        print(f"{rating:>4.1f} | {'#' * int(round(40 * count / distribution.max())):<40} {count}")
+    print(f"\nLower quartile: {quartiles[0.25]:.2f}  Median: {quartiles[0.5]:.2f}  "
+          f"Upper quartile: {quartiles[0.75]:.2f}\n")
+
+
+def user_favourites(user_id, k=3):
+    """
+    Finds a user's favourite genres and their top-k movies in each.
+
+    Both are Query runs over the user's own rating rows, sliced out through
+    the user index: grouped by genre for the averages, then filtered to each
+    favourite genre and ranked by movie.
+
+    Returns:
+        tuple: (genre_averages, favourites, top_movies) - the user's average
+               rating per genre (pd.Series, best first), the tied top genres
+               (list in genre order, empty if the user rated no catalogue
+               movie or a dataset is not loaded) and a dict mapping each
+               favourite genre to a pd.Series of its top-k movies.
+    """
+    dataset = with_user_index(current_dataset)
+    by_user = Query().users([user_id])
+    genre_averages = by_user.by_genre().execute(dataset)
+    if genre_averages is None:
+        genre_averages = pd.Series([], index=pd.Index([], dtype=object, name="movie_genre"), name="rating", dtype=float)
+    if genre_averages.empty:
+        return genre_averages, [], {}
+
+    favourites = sorted(genre_averages.index[genre_averages == genre_averages.max()],
+                        key=lambda genre: find_genre(genre, dataset))
+    top_movies = {genre: by_user.genre(genre).top(k).execute(dataset) for genre in favourites}
+    return genre_averages, favourites, top_movies
+
+
+@cached_result
+def get_preferred_genres(user_id):
+    """
+    Returns the genre(s) with the user's highest average rating.
+
+    Returns:
+        list | None: Tied top genres in name order, or None if the user has no genre ratings.
+    """
+    return user_favourites(user_id)[1] or None
+
+
+# Function to show the user's most preferred genre
+def preferred_genre(user_id=None):
+    """
+    Displays the user's most preferred genre based on their average ratings.
+
+    Args:
+        user_id (int, optional): User ID to calculate preferences for. 
+                                 If None, the user is prompted to enter one.
+
+    Returns:
+        str | list | None: The user's top genre(s), or None if no data is found.
+    """
+    if not ratings_loaded(need_movies=True, need_rows=True):
+        return
+
+    if user_id is None:
+        try:
+            user_id = int(input("Enter your user ID: ").strip())
+        except ValueError:
+            print("Invalid user ID. Please enter a numeric value.\n")
+            return
+
+    top_genres = get_preferred_genres(user_id)
+
+    if not top_genres:
+        print("No ratings found for this user.\n")
+        return None
+
+    print(f"\nYour most preferred genre(s): {', '.join(top_genres)}\n")
+
+    return top_genres
+
+
+@cached_result
+def get_top_3_movies_fav_genre(user_id):
+    """
+    Returns the user's three highest-rated movies in each of their favourite genres.
+
+    Returns:
+        dict: Genre -> pd.Series of the user's average rating per movie (at most 3 rows).
+    """
+    return user_favourites(user_id, k=3)[2]
+
+
+def user_genre_totals(dataset):
+    """
+    Reduces every rating of a snapshot with its user index (see
+    with_user_index) to per-(user, movie) totals and per-user genre totals.
+
+    Returns:
+        tuple: (pair_users, pair_movies, pair_sums, pair_counts, in_genre,
+               user_sums, user_counts) - the user code (position in
+               user_keys) and movies_df row of every rated catalogue
+               (user, movie) pair, sorted by user, with its rating sum and
+               count; the pair x genre indicator; and the user x genre rating
+               sums and counts.
+    """
+    user_codes = np.empty(len(dataset.rating_df), dtype=np.int64)
+    user_codes[dataset.user_row_order] = np.repeat(np.arange(len(dataset.user_keys)), np.diff(dataset.user_bounds))
+
+    movie_rows = dataset.rating_movie_rows
+    matched = movie_rows >= 0
+    n_movies = len(dataset.movies_df)
+    pair_keys = user_codes[matched] * n_movies + movie_rows[matched]
+    pairs, inverse = np.unique(pair_keys, return_inverse=True)
+    pair_sums = np.bincount(inverse, weights=rating_values(dataset.rating_df)[matched], minlength=len(pairs))
+    pair_counts = np.bincount(inverse, minlength=len(pairs))
+    pair_users = pairs // max(n_movies, 1)
+    pair_movies = pairs % max(n_movies, 1)
+
+    n_users = len(dataset.user_keys)
+    n_genres = len(dataset.genre_names)
+    in_genre = genre_matrix(dataset, pair_movies) if n_genres else np.zeros((len(pairs), 0), dtype=bool)
+    user_sums = np.zeros((n_users, n_genres))
+    user_counts = np.zeros((n_users, n_genres))
+    for pos in range(n_genres):
+        selected = in_genre[:, pos]
+        user_sums[:, pos] = np.bincount(pair_users[selected], weights=pair_sums[selected], minlength=n_users)
+        user_counts[:, pos] = np.bincount(pair_users[selected], weights=pair_counts[selected], minlength=n_users)
+    return pair_users, pair_movies, pair_sums, pair_counts, in_genre, user_sums, user_counts
+
+
+@cached_result
+def get_all_users_top_3_fav_genre(k=3):
+    """
+    Computes every user's top-k movies in each of their favourite genres at once.
+
+    Works on (user, movie) rating totals: one bincount per genre builds the
+    user x genre averages, the favourite genres are taken row-wise, and the
+    qualifying (user, genre, movie) rows are ranked with a single sort.
+
+    Returns:
+        pd.DataFrame: Columns ['user_id', 'movie_genre', 'movie_name', 'rating'],
+                      at most k rows per (user, favourite genre).
+    """
+    columns = ["user_id", "movie_genre", "movie_name", "rating"]
+    dataset = with_user_index(current_dataset)
+    pair_users, pair_movies, pair_sums, pair_counts, in_genre, user_sums, user_counts = user_genre_totals(dataset)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        averages = user_sums / user_counts
+    best = np.max(np.where(user_counts > 0, averages, -np.inf), axis=1, initial=-np.inf)
+    favourite = (user_counts > 0) & (averages == best[:, None])
+
+    pair_idx, genre_pos = np.nonzero(in_genre & favourite[pair_users])
+    if len(pair_idx) == 0:
+        return pd.DataFrame(columns=columns)
+
+    result = pd.DataFrame({
+        "user_id": dataset.user_keys.to_numpy()[pair_users[pair_idx]],
+        "movie_genre": np.array(dataset.genre_names, dtype=object)[genre_pos],
+        "movie_name": dataset.movies_df["movie_name"].to_numpy()[pair_movies[pair_idx]],
+        "rating": pair_sums[pair_idx] / pair_counts[pair_idx],
+        "genre_pos": genre_pos,
+    })
+    result = result.sort_values(["user_id", "genre_pos", "rating", "movie_name"], ascending=[True, True, False, True],
+                                kind="mergesort")
+    return result.groupby(["user_id", "genre_pos"], sort=False).head(k)[columns].reset_index(drop=True)
 
 
 # Function to show top 3 movies from the user's favorite genre
@@ -476,8 +2059,7 @@ def top_3_movies_fav_genre():
     Uses the user's ratings and preferred genre to identify their top-rated
     movies within that genre.
     """
-    if movies_df is None or rating_df is None:
-        print("Error: Please load both movies and ratings datasets first.")
+    if not ratings_loaded(need_movies=True, need_rows=True):
         return
     # 🔢 Keep user_id numeric for consistency
     try:
@@ -485,38 +2067,614 @@ def top_3_movies_fav_genre():
     except ValueError:
         print("Invalid user ID. Must be a number.")
         return
-    fav_genre = preferred_genre(user_id)  # calls previous function
+    # One pass over this user's ratings gives both the genres and their movies
+    _, fav_genre, top_movies = user_favourites(user_id, k=3)
     if not fav_genre:
+        print("No ratings found for this user.\n")
         return
-    
-    for genre in fav_genre:
-        genre_movies = movies_df[movies_df["movie_genre"] == genre]
-        merged = rating_df.merge(genre_movies, on="movie_name", how="inner")
 
-        # ✅ Only include movies that this user actually rated
-        merged = merged[merged["user_id"] == user_id]
+    print(f"\nYour most preferred genre(s): {', '.join(fav_genre)}\n")
 
-        if merged.empty:
-            print(f"No {genre} movies rated by user {user_id}.")
-            return
-        avg_ratings = (
-            merged.groupby("movie_name")["rating"]
-            .mean()
-            .sort_values(ascending=False)
-            .head(3)
-        )
-
-        avg_ratings_df = avg_ratings.reset_index()
-        avg_ratings_df.columns = ["Movie Name", "Average Rating"]
+    for genre, avg_ratings in top_movies.items():
         print(f"\nTop 3 {genre} Movies for User {user_id}:")
-        print(
-            avg_ratings_df.to_string(
-                index=False,
-                justify="left",
-                formatters={"Average Rating": "{:.2f}".format},
-            ),
-            "\n",
-        )
+        show_table(avg_ratings, ("Movie Name", "Average Rating"))
+
+
+def genre_affinity(sums, counts, total_sum, total_count):
+    """
+    How much more (or less) than usual a user rates each genre.
+
+    The user's average in each genre minus their overall average, 0 for
+    genres they have not rated. Works row-wise on user x genre arrays.
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        deviation = sums / counts - np.expand_dims(total_sum / total_count, -1)
+    return np.where(counts > 0, deviation, 0.0)
+
+
+def movie_affinity(affinity, indicator):
+    """
+    Averages genre affinities over each movie's genres.
+
+    Args:
+        affinity (np.ndarray): Genre affinities, one vector or a user x genre matrix.
+        indicator (np.ndarray): The movie x genre indicator from genre_matrix().
+
+    Returns: One value per movie (or a user x movie matrix).
+    """
+    # One product gives both the affinity totals and (from the row of ones) each movie's genre count
+    weights = np.vstack([affinity, np.ones(indicator.shape[1])])
+    totals = weights @ indicator.astype(np.float64, copy=False).T
+    return (totals[:-1] / np.maximum(totals[-1], 1)).reshape(np.shape(affinity)[:-1] + (-1,))
+
+
+def scorable_averages(dataset, min_ratings=1):
+    """Per-movie average ratings, NaN for movies with fewer than min_ratings ratings."""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        averages = dataset.movie_sums / dataset.movie_counts
+    averages[dataset.movie_counts < max(min_ratings, 1)] = np.nan
+    return averages
+
+
+def top_scores(dataset, scores, n):
+    """Selects the n highest finite scores with a partial sort and ranks them by score, then name."""
+    candidates = np.flatnonzero(np.isfinite(scores))
+    if len(candidates) > n > 0:
+        kth = np.partition(scores[candidates], len(candidates) - n)[len(candidates) - n]
+        candidates = candidates[scores[candidates] >= kth]
+    names = dataset.movies_df["movie_name"].iloc[candidates].to_numpy()
+    best = pd.Series(scores[candidates], index=pd.Index(names, name="movie_name"), name="score")
+    return rank_descending(best, n)
+
+
+@cached_result
+def get_recommendations(user_id, n=10, min_ratings=1):
+    """
+    Recommends the movies a user has not rated yet.
+
+    Each movie scores its overall average rating plus the user's mean
+    genre affinity over the movie's genres, so genres the user rates above
+    their own average lift their movies. Scoring is a single matrix-vector
+    product over the catalogue and only the best n scores are sorted.
+    Unknown users get the plain top-rated movies.
+
+    Returns:
+        pd.Series | None: Up to n scores indexed by movie_name, best first,
+        ties by name; None unless both datasets are loaded.
+    """
+    dataset = with_user_index(current_dataset)
+    if dataset.movie_sums is None:
+        return None
+    rows = user_rows(dataset, user_id)
+    movie_rows = dataset.rating_movie_rows[rows]
+    matched = movie_rows >= 0
+    movie_rows = movie_rows[matched]
+    values = rating_values(dataset.rating_df)[rows[matched]]
+
+    indicator = genre_matrix(dataset, movie_rows)
+    affinity = genre_affinity(values @ indicator, indicator.sum(axis=0), values.sum(), len(values))
+    scores = scorable_averages(dataset, min_ratings) + movie_affinity(affinity, genre_matrix(dataset))
+    scores[movie_rows] = np.nan
+    return top_scores(dataset, scores, n)
+
+
+@cached_result
+def get_all_users_recommendations(n=10, min_ratings=1, block_size=1024):
+    """
+    Recommends n unseen movies for every user at once.
+
+    Users are scored block_size at a time as one matrix product, their
+    rated movies are masked out, and each row keeps its n best scores
+    through a partial sort before the final ordering.
+
+    Returns:
+        pd.DataFrame: Columns ['user_id', 'rank', 'movie_name', 'score'],
+                      at most n rows per user, ordered by user_id then rank
+                      (no rows unless both datasets are loaded).
+    """
+    columns = ["user_id", "rank", "movie_name", "score"]
+    dataset = with_user_index(current_dataset)
+    if dataset.movie_sums is None:
+        return pd.DataFrame(columns=columns)
+    pair_users, pair_movies, pair_sums, pair_counts, _, user_sums, user_counts = user_genre_totals(dataset)
+    n_users = len(dataset.user_keys)
+    affinity = genre_affinity(user_sums, user_counts,
+                              np.bincount(pair_users, weights=pair_sums, minlength=n_users),
+                              np.bincount(pair_users, weights=pair_counts, minlength=n_users))
+    averages = np.nan_to_num(scorable_averages(dataset, min_ratings), nan=-np.inf)
+    indicator = genre_matrix(dataset).astype(np.float64)
+    n_keep = min(n, len(dataset.movies_df))
+    if n_users == 0 or n_keep <= 0:
+        return pd.DataFrame(columns=columns)
+
+    users, movie_rows, scores = best_unseen_movies(
+        dataset, lambda first, last: averages + movie_affinity(affinity[first:last], indicator),
+        n_keep, pair_users, pair_movies, block_size)
+    result = pd.DataFrame({
+        "user_id": dataset.user_keys.to_numpy()[users],
+        "movie_name": dataset.movies_df["movie_name"].to_numpy()[movie_rows],
+        "score": scores,
+    })
+    result = result.sort_values("user_id", kind="mergesort")
+    result.insert(1, "rank", result.groupby("user_id").cumcount() + 1)
+    return result.reset_index(drop=True)
+
+
+def best_unseen_movies(dataset, score_block, n, pair_users, pair_movies, block_size=1024):
+    """
+    Finds every user's n best-scoring movies among those they have not rated.
+
+    Users (in user_keys order) are scored block_size at a time:
+    score_block(first, last) returns the user x movie scores of users
+    first to last - 1, as a new array with -inf (not NaN) for movies that
+    cannot be recommended. Rated movies are masked out and each row keeps
+    its n best finite scores through a partial sort before the final ordering.
+
+    Args:
+        pair_users, pair_movies (np.ndarray): The rated (user code, movie row) pairs, sorted by user.
+
+    Returns:
+        tuple: (user codes, movies_df rows, scores) of at most n movies per
+               user, ordered by user code, then score (best first), then name.
+    """
+    n_users = len(dataset.user_keys)
+    pair_bounds = np.searchsorted(pair_users, np.arange(0, n_users + block_size, block_size))
+    users, movie_rows, scores = [], [], []
+    for block, first in enumerate(range(0, n_users, block_size)):
+        block_scores = score_block(first, min(first + block_size, n_users))
+        seen = slice(pair_bounds[block], pair_bounds[block + 1])
+        block_scores[pair_users[seen] - first, pair_movies[seen]] = -np.inf
+
+        n_keep = min(n, block_scores.shape[1])
+        kth = np.partition(block_scores, block_scores.shape[1] - n_keep, axis=1)[:, block_scores.shape[1] - n_keep]
+        # Users with fewer than n scorable movies left keep all of them, never the -inf ones
+        kth = np.maximum(kth, -np.finfo(np.float64).max)
+        user_pos, rows = np.nonzero(block_scores >= kth[:, None])
+        users.append(first + user_pos)
+        movie_rows.append(rows)
+        scores.append(block_scores[user_pos, rows])
+
+    users, movie_rows, scores = np.concatenate(users), np.concatenate(movie_rows), np.concatenate(scores)
+    order = np.lexsort((movie_name_ranks(dataset)[movie_rows], -scores, users))
+    users, movie_rows, scores = users[order], movie_rows[order], scores[order]
+    starts = np.searchsorted(users, users, side="left")
+    keep = np.arange(len(users)) - starts < n
+    return users[keep], movie_rows[keep], scores[keep]
+
+
+def movie_name_ranks(dataset):
+    """Position of each movies_df title in name order, to break ties between equal scores."""
+    names = dataset.movies_df["movie_name"].to_numpy(dtype=object)
+    ranks = np.empty(len(names), dtype=np.intp)
+    ranks[np.argsort(names, kind="stable")] = np.arange(len(names))
+    return ranks
+
+
+# Function to recommend unseen movies to a user
+def recommend_movies():
+    """
+    Displays the top N movies the user has not rated yet, scored by their genre affinity.
+    """
+    if not ratings_loaded(need_movies=True, need_rows=True):
+        return
+    try:
+        user_id = int(input("Enter your user ID: ").strip())
+        n = int(input("Enter how many recommendations you want: ").strip())
+    except ValueError:
+        print("Invalid input. Please enter numeric values.\n")
+        return
+    if n <= 0:
+        print("Please enter a positive number.\n")
+        return
+
+    recommendations = get_recommendations(user_id, n)
+    if recommendations.empty:
+        print("No movies left to recommend.\n")
+        return
+    if len(user_rows(with_user_index(current_dataset), user_id)) == 0:
+        print("No ratings found for this user - showing the top-rated movies instead.")
+
+    print(f"\nTop {len(recommendations)} Recommendations for User {user_id}:")
+    show_table(recommendations, ("Movie Name", "Score"))
+
+
+def get_similar_users(user_id, k=10, exact=False):
+    """
+    Returns the users whose rated movies overlap most with this user's.
+
+    Args:
+        exact (bool): Compare with every user instead of using the LSH index.
+
+    Returns:
+        pd.Series | None: Up to k Jaccard similarities (estimated unless
+        exact) indexed by user_id, or None if no ratings are loaded.
+    """
+    dataset = with_user_index(current_dataset)
+    if dataset.user_keys is None:
+        return None
+    index = get_neighbour_index(dataset)
+    return index.exact_neighbours(user_id, k) if exact else index.neighbours(user_id, k)
+
+
+def get_neighbour_recommendations(user_id, n=10, k=20):
+    """
+    Recommends unseen movies from the ratings of the user's k nearest neighbours.
+
+    Each movie scores the neighbours' ratings averaged with their
+    similarities as weights.
+
+    Returns:
+        pd.Series | None: Up to n scores indexed by movie_name, best first,
+        ties by name; None unless both datasets are loaded.
+    """
+    dataset = with_user_index(current_dataset)
+    if dataset.movie_sums is None:
+        return None
+    return top_scores(dataset, neighbour_scores(dataset, user_id, k), n)
+
+
+def neighbour_scores(dataset, user_id, k=20):
+    """
+    Scores every movie for a user by the similarity-weighted average rating
+    of their k nearest neighbours (see get_neighbour_recommendations), in a
+    snapshot with its user index.
+
+    Returns: One score per movies_df row, NaN for movies the user rated or no neighbour rated.
+    """
+    neighbours = get_neighbour_index(dataset).neighbours(user_id, k)
+    rows = [user_rows(dataset, neighbour) for neighbour in neighbours.index]
+    weights = np.repeat(neighbours.to_numpy(), [len(r) for r in rows])
+    rows = np.concatenate(rows) if rows else np.array([], dtype=np.intp)
+
+    n_movies = len(dataset.movies_df)
+    movie_rows = dataset.rating_movie_rows[rows]
+    matched = movie_rows >= 0
+    values = rating_values(dataset.rating_df)[rows]
+    weighted_sums = np.bincount(movie_rows[matched], weights=(weights * values)[matched], minlength=n_movies)
+    weight_sums = np.bincount(movie_rows[matched], weights=weights[matched], minlength=n_movies)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scores = weighted_sums / weight_sums
+
+    seen = dataset.rating_movie_rows[user_rows(dataset, user_id)]
+    scores[seen[seen >= 0]] = np.nan
+    return scores
+
+
+# Function to show users with similar taste and what they recommend
+def similar_users():
+    """
+    Displays the users whose rated movies overlap most with the user's,
+    and the unseen movies those neighbours rate highest.
+    """
+    if not ratings_loaded(need_movies=True, need_rows=True):
+        return
+    try:
+        user_id = int(input("Enter your user ID: ").strip())
+    except ValueError:
+        print("Invalid user ID. Please enter a numeric value.\n")
+        return
+
+    neighbours = get_similar_users(user_id)
+    if neighbours.empty:
+        print("No users with overlapping ratings found.\n")
+        return
+
+    print(f"\nUsers Similar to User {user_id}:")
+    show_table(neighbours, ("User ID", "Similarity"))
+
+    recommendations = get_neighbour_recommendations(user_id)
+    if recommendations.empty:
+        print("Your neighbours have not rated any movie you have not seen.\n")
+        return
+    print("Movies Your Neighbours Rate Highest:")
+    show_table(recommendations, ("Movie Name", "Score"))
+
+
+@cached_result
+def compute_rankings(n):
+    """
+    Builds every ranked table at once from the load-time aggregates.
+
+    The overall list comes from the per-title totals, the genre ranking from
+    the per-genre totals, and the per-genre lists from the per-movie totals
+    joined to the genre bitset with a single sort across all genres - no
+    pass over rating_df and no per-genre query.
+
+    Returns:
+        dict | None: 'overall' and 'genres' DataFrames (rank, name,
+              average_rating, rating_count) and 'by_genre', the same per genre
+              with a 'movie_genre' column; None unless both datasets are loaded.
+    """
+    dataset = current_dataset
+    if dataset.movie_sums is None:
+        return None
+    genre_names, genre_sums, genre_counts = dataset.genre_names, dataset.genre_sums, dataset.genre_counts
+    movie_sums, movie_counts = dataset.movie_sums, dataset.movie_counts
+    overall = Query().top(n).execute(dataset)
+    overall = pd.DataFrame({
+        "rank": np.arange(1, len(overall) + 1),
+        "movie_name": overall.index,
+        "average_rating": overall.to_numpy(),
+        "rating_count": dataset.title_totals["rating_count"].reindex(overall.index).to_numpy(),
+    })
+
+    rated = genre_counts > 0
+    genres = pd.DataFrame({
+        "movie_genre": np.array(genre_names, dtype=object)[rated],
+        "average_rating": genre_sums[rated] / genre_counts[rated],
+        "rating_count": genre_counts[rated],
+    })
+    genres = genres.sort_values(["average_rating", "movie_genre"], ascending=[False, True], kind="mergesort").head(n)
+    genres.insert(0, "rank", np.arange(1, len(genres) + 1))
+
+    movie_rows, genre_pos = np.nonzero(genre_matrix(dataset))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        averages = movie_sums[movie_rows] / movie_counts[movie_rows]
+    by_genre = pd.DataFrame({
+        "genre_pos": genre_pos,
+        "movie_genre": np.array(genre_names, dtype=object)[genre_pos],
+        "movie_name": dataset.movies_df["movie_name"].to_numpy()[movie_rows],
+        "average_rating": averages,
+        "rating_count": movie_counts[movie_rows],
+    })
+    by_genre = by_genre.sort_values(["genre_pos", "average_rating", "movie_name"], ascending=[True, False, True],
+                                    kind="mergesort", na_position="last")
+    by_genre = by_genre.groupby("genre_pos", sort=False).head(n)
+    by_genre.insert(2, "rank", by_genre.groupby("genre_pos").cumcount() + 1)
+    by_genre = by_genre.drop(columns="genre_pos")
+
+    return {
+        "overall": overall.reset_index(drop=True),
+        "genres": genres.reset_index(drop=True),
+        "by_genre": by_genre.reset_index(drop=True),
+    }
+
+
+def save_rankings(out_dir, n, fmt="txt"):
+    """
+    Writes the ranked tables from compute_rankings() to out_dir.
+
+    Args:
+        out_dir (str): Directory to write into (created if missing).
+        n (int): Length of every ranked list.
+        fmt (str): 'txt' for pipe-separated top_movies.txt, top_genres.txt and
+                   top_movies_by_genre.txt, or 'json' for a single rankings.json.
+
+    Returns:
+        list | None: The paths written, or None (nothing written) unless both datasets are loaded.
+    """
+    tables = compute_rankings(n)
+    if tables is None:
+        return None
+    os.makedirs(out_dir, exist_ok=True)
+
+    if fmt == "json":
+        def records(df):
+            return json.loads(df.to_json(orient="records"))
+
+        by_genre = {genre: records(group.drop(columns="movie_genre"))
+                    for genre, group in tables["by_genre"].groupby("movie_genre", sort=False)}
+        payload = {"top_n": n, "overall": records(tables["overall"]), "genres": records(tables["genres"]),
+                   "by_genre": by_genre}
+        path = os.path.join(out_dir, "rankings.json")
+        atomic_write(path, json.dumps(payload, indent=2, ensure_ascii=False))
+        return [path]
+
+    if fmt != "txt":
+        raise ValueError(f"Unknown export format '{fmt}'. Use 'txt' or 'json'.")
+
+    paths = []
+    for name, file_name in [("overall", "top_movies.txt"), ("genres", "top_genres.txt"),
+                            ("by_genre", "top_movies_by_genre.txt")]:
+        path = os.path.join(out_dir, file_name)
+        atomic_write(path, tables[name].to_csv(sep="|", index=False, header=False))
+        paths.append(path)
+    return paths
+
+
+# Function to export every ranked table in one go
+def export_rankings():
+    """
+    Exports the overall top N, the genre ranking and the top N of every genre.
+
+    Requires both the movies and ratings datasets to be loaded.
+    """
+    if not ratings_loaded(need_movies=True):
+        return
+
+    try:
+        n = int(input("Enter N: ").strip())
+    except ValueError:
+        print("Invalid number. Please enter a numeric value.")
+        return
+
+    fmt = input("Export as pipe-separated text (T) or JSON (J)? ").strip().lower()
+    if fmt not in ("t", "j"):
+        print("Invalid choice. Please enter 'T' or 'J'.")
+        return
+
+    out_dir = input("Enter output directory: ").strip() or "."
+    try:
+        paths = save_rankings(out_dir, n, "json" if fmt == "j" else "txt")
+    except OSError as e:
+        print(f"❌ Could not write the export: {e}\n")
+        return
+    if paths is None:
+        print("Error: Please load both movies and ratings datasets first.")
+        return
+
+    print(f"\n✅ Exported {len(paths)} file(s):")
+    for path in paths:
+        print(f"  {path}")
+    print()
+
+
+# Ratings (or genre flags) per block when building the sparse matrices for export
+SPARSE_EXPORT_BLOCK = 1 << 20
+
+
+def rating_matrix_columns(dataset):
+    """
+    Returns the matrix column of every rating in a snapshot, and the title of every column.
+
+    The columns are the catalogue movies in movies_df order followed by the
+    rated titles that match no movie (see get_unmatched_titles), so the
+    rating matrix and the genre matrix share their movie axis.
+    """
+    n_movies = len(dataset.movies_df)
+    unmatched = dataset.unmatched_titles
+    columns = dataset.rating_movie_rows.astype(np.int64)
+    missing = np.flatnonzero(columns < 0)
+    if missing.size:
+        codes, titles = pd.factorize(dataset.rating_df["movie_name"].iloc[missing])
+        columns[missing] = n_movies + unmatched.index.get_indexer(clean_titles(titles))[codes]
+    titles = np.concatenate([dataset.movies_df["movie_name"].to_numpy(dtype=object),
+                             np.asarray(unmatched.index, dtype=object)])
+    return columns, titles
+
+
+def csr_arrays(data, indices, row_sizes, shape):
+    """Assembles CSR blocks into one matrix dict, with 32-bit indices whenever they fit (as scipy does)."""
+    indptr = np.concatenate([[0], np.cumsum(np.concatenate(row_sizes), dtype=np.int64)])
+    index_dtype = np.int32 if max(indptr[-1], shape[1]) < 2 ** 31 else np.int64
+    return {"data": np.concatenate(data), "indices": np.concatenate(indices).astype(index_dtype),
+            "indptr": indptr.astype(index_dtype), "shape": shape}
+
+
+def build_rating_matrix(dataset=None, block_size=SPARSE_EXPORT_BLOCK):
+    """
+    Builds the user x movie rating matrix of a snapshot in compressed sparse row (CSR) form.
+
+    Row i holds the ratings of user_ids[i] and column j those of titles[j]
+    (see rating_matrix_columns); a user's repeated ratings of a title are
+    averaged into one entry. The ratings are taken from the user index one
+    block of users at a time, sorted by column within each user and reduced,
+    so no dense matrix and no full-size temporary is ever formed.
+
+    Args:
+        dataset (Dataset, optional): Snapshot to export. Defaults to the current one.
+        block_size (int): Ratings per block (a block always holds whole users).
+
+    Returns:
+        dict: The CSR arrays (data, indices, indptr) and shape, plus the
+        user_ids and titles labelling the rows and columns.
+    """
+    dataset = current_dataset if dataset is None else dataset
+    if dataset.user_keys is None:
+        keys, order, bounds = build_user_index(dataset.rating_df["user_id"])
+    else:
+        keys, order, bounds = dataset.user_keys, dataset.user_row_order, dataset.user_bounds
+    columns, titles = rating_matrix_columns(dataset)
+    values = rating_values(dataset.rating_df)
+    n_columns = len(titles)
+
+    data, indices, row_sizes = [np.empty(0)], [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    first = 0
+    while first < len(keys):
+        last = max(first + 1, int(np.searchsorted(bounds, bounds[first] + block_size, side="right")) - 1)
+        rows = order[bounds[first]:bounds[last]]
+        users = np.repeat(np.arange(last - first, dtype=np.int64), np.diff(bounds[first:last + 1]))
+        cells = users * n_columns + columns[rows]
+        sort = np.argsort(cells, kind="stable")
+        cells = cells[sort]
+        starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+        counts = np.diff(np.append(starts, len(cells)))
+        data.append(np.add.reduceat(values[rows][sort], starts) / counts)
+        indices.append(cells[starts] % n_columns)
+        row_sizes.append(np.bincount(cells[starts] // n_columns, minlength=last - first))
+        first = last
+
+    matrix = csr_arrays(data, indices, row_sizes, (len(keys), n_columns))
+    return {**matrix, "user_ids": np.asarray(keys), "titles": titles}
+
+
+def build_genre_matrix(dataset=None, n_rows=None, block_size=SPARSE_EXPORT_BLOCK):
+    """
+    Builds the movie x genre indicator matrix of a snapshot in CSR form.
+
+    Entry (i, j) is 1 when movie i of movies_df has genre_names[j]. The
+    genre bitset is expanded one block of movies at a time.
+
+    Args:
+        dataset (Dataset, optional): Snapshot to export. Defaults to the current one.
+        n_rows (int, optional): Total rows; the rows past the catalogue are
+            left empty (the unmatched titles of the rating matrix).
+        block_size (int): Genre flags expanded per block.
+    """
+    dataset = current_dataset if dataset is None else dataset
+    n_movies, n_genres = len(dataset.genre_bits), len(dataset.genre_names)
+    n_rows = n_movies if n_rows is None else n_rows
+    step = max(1, block_size // max(n_genres, 1))
+
+    indices, row_sizes = [np.empty(0, dtype=np.int64)], []
+    for start in range(0, n_movies, step):
+        indicator = unpack_genre_bits(dataset.genre_bits[start:start + step], n_genres)
+        indices.append(np.nonzero(indicator)[1])
+        row_sizes.append(indicator.sum(axis=1))
+    row_sizes.append(np.zeros(n_rows - n_movies, dtype=np.int64))
+    data = [np.ones(sum(len(block) for block in indices), dtype=np.int8)]
+    return csr_arrays(data, indices, row_sizes, (n_rows, n_genres))
+
+
+def save_sparse_matrix(file_path, matrix, compressed=True):
+    """Writes a CSR matrix dict as .npz in the layout of scipy.sparse.save_npz, so load_npz reads it back."""
+    savez = np.savez_compressed if compressed else np.savez
+    with atomic_file(file_path, "wb") as f:
+        savez(f, indices=matrix["indices"], indptr=matrix["indptr"], format=b"csr", shape=np.array(matrix["shape"]),
+              data=matrix["data"])
+
+
+def save_rating_matrix(out_dir, compressed=True):
+    """
+    Writes the loaded ratings to out_dir for sparse-matrix tooling.
+
+    ratings.npz is the user x movie rating matrix (see build_rating_matrix)
+    and movie_genres.npz the movie x genre indicator matrix over the same
+    movie axis; both load with scipy.sparse.load_npz. rating_matrix_index.npz
+    holds the axis labels: user_ids, titles and genres. Uncompressed files
+    are larger but write several times faster.
+
+    Requires both the movies and ratings datasets to be loaded.
+    Returns:
+        list: The paths written.
+    """
+    dataset = with_user_index(current_dataset)
+    ratings = build_rating_matrix(dataset)
+    genres = build_genre_matrix(dataset, n_rows=len(ratings["titles"]))
+    os.makedirs(out_dir, exist_ok=True)
+
+    paths = [os.path.join(out_dir, name) for name in ("ratings.npz", "movie_genres.npz", "rating_matrix_index.npz")]
+    save_sparse_matrix(paths[0], ratings, compressed)
+    save_sparse_matrix(paths[1], genres, compressed)
+    savez = np.savez_compressed if compressed else np.savez
+    with atomic_file(paths[2], "wb") as f:
+        savez(f, user_ids=ratings["user_ids"], titles=ratings["titles"].astype(str),
+              genres=np.array(dataset.genre_names, dtype=str))
+    return paths
+
+
+# Function to export the ratings as sparse matrices
+def export_rating_matrix():
+    """
+    Exports the user x movie rating matrix, the movie x genre matrix and their labels as .npz files.
+
+    Requires both the movies and ratings datasets to be loaded.
+    """
+    if not ratings_loaded(need_movies=True, need_rows=True):
+        return
+
+    out_dir = input("Enter output directory: ").strip() or "."
+    compressed = input("Compress the files? (Y/n): ").strip().lower() != "n"
+    try:
+        paths = save_rating_matrix(out_dir, compressed)
+    except OSError as e:
+        print(f"❌ Could not write the export: {e}\n")
+        return
+
+    print(f"\n✅ Exported {len(rating_df):,} ratings as sparse matrices:")
+    for path in paths:
+        print(f"  {path}")
+    print()
 
 
 if __name__ == "__main__":
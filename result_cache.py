@@ -0,0 +1,187 @@
+"""
+Opt-in on-disk cache of query results, shared across sessions.
+
+Query functions wrapped with cached_result() are answered from an SQLite
+file when every loaded dataset was read, unchanged, from a file whose
+answers were stored before (see result_key()).
+"""
+import contextlib
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import sqlite3
+import sys
+import time
+
+import snapshots
+from snapshots import file_fingerprint
+
+
+# Opt-in on-disk cache of query results shared across sessions (an SQLite file); None or "" disables it.
+# Off unless set here or through the MOVIE_RECOMMENDER_CACHE environment variable,
+# e.g. MOVIE_RECOMMENDER_CACHE=~/.cache/movie_recommender/results.sqlite
+RESULT_CACHE_PATH = os.path.expanduser(os.environ.get("MOVIE_RECOMMENDER_CACHE", "")) or None
+RESULT_CACHE_MAX_BYTES = 256 << 20
+
+# Bumped whenever the stored layout of cached results changes
+RESULT_CACHE_VERSION = 1
+
+
+class ResultCache:
+    """
+    Query results stored in an SQLite file, reused across processes.
+
+    Values are pickled under a caller-chosen key. Every read refreshes the
+    entry's last-used time, and once the stored values exceed max_bytes the
+    least recently used ones are evicted. The cache is an optimization
+    only: any error opening or using the file is treated as a miss.
+    """
+
+    def __init__(self, path, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ready = False
+        self.hits = self.misses = 0
+
+    def connect(self):
+        """Opens the database, creating its directory and table on first use."""
+        if not self.ready:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=5)
+        # Losing the last few writes in a power cut is fine for a cache; an fsync per lookup is not
+        connection.execute("PRAGMA synchronous=NORMAL")
+        if not self.ready:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS results "
+                               "(key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)")
+            self.ready = True
+        return connection
+
+    def get(self, key):
+        """Returns (True, value) for a stored key, else (False, None)."""
+        try:
+            with contextlib.closing(self.connect()) as connection, connection:
+                row = connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    connection.execute("UPDATE results SET used = ? WHERE key = ?", (time.time(), key))
+            if row is not None:
+                value = pickle.loads(row[0])
+                self.hits += 1
+                return True, value
+        except (sqlite3.Error, OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            pass
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value):
+        """Stores a value (skipped if it cannot be pickled or exceeds max_bytes), then evicts down to max_bytes."""
+        try:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return
+        if len(blob) > self.max_bytes:
+            return
+        try:
+            with contextlib.closing(self.connect()) as connection, connection:
+                connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                                   (key, blob, len(blob), time.time()))
+                connection.execute("DELETE FROM results WHERE key IN (SELECT key FROM "
+                                   "(SELECT key, SUM(size) OVER (ORDER BY used DESC, key) AS total FROM results) "
+                                   "WHERE total > ?)", (self.max_bytes,))
+        except (sqlite3.Error, OSError):
+            pass
+
+    def clear(self):
+        """Removes every stored result."""
+        try:
+            with contextlib.closing(self.connect()) as connection, connection:
+                connection.execute("DELETE FROM results")
+        except (sqlite3.Error, OSError):
+            pass
+
+    def size(self):
+        """Returns (entries, bytes) currently stored."""
+        try:
+            with contextlib.closing(self.connect()) as connection:
+                count, total = connection.execute("SELECT COUNT(*), SUM(size) FROM results").fetchone()
+            return count, total or 0
+        except (sqlite3.Error, OSError):
+            return 0, 0
+
+
+# ResultCache per cache path, opened on first use
+result_caches = {}
+
+
+def result_cache():
+    """Returns the ResultCache at RESULT_CACHE_PATH, or None if caching is disabled."""
+    if not RESULT_CACHE_PATH:
+        return None
+    cache = result_caches.get(RESULT_CACHE_PATH)
+    if cache is None:
+        cache = result_caches[RESULT_CACHE_PATH] = ResultCache(RESULT_CACHE_PATH)
+    return cache
+
+
+# Modules whose code every cached answer depends on, besides the query's own module
+ENGINE_MODULES = ("movie_data", "snapshots", __name__)
+
+
+@functools.cache
+def code_fingerprint(query_module):
+    """
+    Fingerprint of the engine modules' and the query module's source, so
+    results cached by other versions of the code are not reused.
+    """
+    try:
+        return ":".join(file_fingerprint(sys.modules[name].__file__) for name in ENGINE_MODULES + (query_module,))
+    except (OSError, KeyError, AttributeError, TypeError):
+        return None
+
+
+def result_key(dataset, query, args, kwargs):
+    """
+    Returns the cache key of a query call against a snapshot, or None if its answer cannot be cached.
+
+    Answers are cacheable when every loaded dataset was read from a file as
+    is and unchanged while it was read (it has a source fingerprint); the key
+    covers those fingerprints with the load settings they were taken under,
+    the code, the query and its arguments with the defaults filled in.
+    """
+    ratings_loaded = dataset.title_totals is not None
+    if (dataset.movies_df is not None and dataset.movies_source is None) or \
+            (ratings_loaded and dataset.ratings_source is None) or \
+            (dataset.movies_df is None and not ratings_loaded):
+        return None
+    call = inspect.signature(query).bind(*args, **kwargs)
+    call.apply_defaults()
+    described = repr((RESULT_CACHE_VERSION, code_fingerprint(query.__module__), dataset.movies_source,
+                      dataset.ratings_source, query.__qualname__, tuple(call.arguments.items())))
+    return hashlib.sha256(described.encode()).hexdigest()
+
+
+def cached_result(query):
+    """
+    Serves a query function from the on-disk result cache (see ResultCache and result_key).
+
+    On a miss the query runs as usual and its answer is stored, unless a
+    new snapshot was published meanwhile. A fresh process that loads the
+    same files answers repeated queries straight from the cache.
+    """
+    @functools.wraps(query)
+    def cached(*args, **kwargs):
+        cache = result_cache()
+        dataset = snapshots.current_dataset
+        key = None if cache is None else result_key(dataset, query, args, kwargs)
+        if key is None:
+            return query(*args, **kwargs)
+        hit, value = cache.get(key)
+        if hit:
+            return value
+        value = query(*args, **kwargs)
+        if snapshots.current_dataset.version == dataset.version:
+            cache.put(key, value)
+        return value
+    return cached
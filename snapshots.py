@@ -0,0 +1,1543 @@
+"""
+Immutable snapshots of the loaded datasets and everything derived from them.
+
+Builds the genre, title and user indexes, resolves duplicate ratings and
+computes the rating aggregates and histograms, then makes each new Dataset
+current in a single swap (see publish()). Loads, reloads, appends and
+merged partial aggregates all go through dataset_with() and publish().
+"""
+import pandas as pd
+import numpy as np
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import movie_data
+from movie_data import (atomic_write, clean_titles, compact_ratings, concat_ratings, is_compact, rating_values,
+                        read_movies_file, read_ratings_file, title_key, title_keys)
+
+
+def normalize_genre(genre):
+    """Returns the lookup key for a genre name: case-folded with all whitespace removed."""
+    return "".join(str(genre).split()).casefold()
+
+
+def build_genre_bitset(genre_col):
+    """
+    Builds the genre membership bitset for a movies table.
+
+    Genres are matched by their normalized key, so 'Sci-Fi' and 'sci-fi '
+    become one genre (displayed with its first spelling).
+
+    Args:
+        genre_col (pd.Series): 'Action|Comedy' style genre lists, one per movie.
+
+    Returns:
+        tuple: (names, bits) where names lists each distinct genre in key order
+               (genre i is bit i) and bits is a uint64 array with one row per
+               movie and one word per 64 genres.
+    """
+    exploded = genre_col.reset_index(drop=True).fillna("").astype(str).str.split("|").explode().str.strip()
+    exploded = exploded[exploded != ""]
+    keys = exploded.str.replace(r"\s+", "", regex=True).str.casefold()
+    codes, _ = pd.factorize(keys, sort=True)
+    names = exploded.groupby(codes).first().tolist()
+
+    n_words = max(1, -(-len(names) // 64))
+    bits = np.zeros((len(genre_col), n_words), dtype=np.uint64)
+    flags = np.left_shift(np.uint64(1), (codes % 64).astype(np.uint64))
+    np.bitwise_or.at(bits, (exploded.index.to_numpy(), codes // 64), flags)
+    return names, bits
+
+
+def build_genre_index(names, bits):
+    """
+    Builds the genre lookup tables from a genre bitset and its genre names.
+
+    Returns:
+        tuple: (index, positions) mapping each normalized genre key to the
+               sorted movies_df row positions of its movies, and to its bit.
+    """
+    movie_rows, genre_cols = np.nonzero(unpack_genre_bits(bits, len(names)))
+    order = np.argsort(genre_cols, kind="stable")
+    bounds = np.searchsorted(genre_cols[order], np.arange(len(names) + 1))
+
+    index = {}
+    positions = {}
+    for pos, name in enumerate(names):
+        key = normalize_genre(name)
+        index[key] = movie_rows[order[bounds[pos]:bounds[pos + 1]]]
+        positions[key] = pos
+    return index, positions
+
+
+# Titles whose trigrams are extracted per block while building a TitleIndex
+TITLE_INDEX_BLOCK = 1 << 16
+
+
+class TitleIndex:
+    """
+    Search index over the movie titles of a catalogue, built once per movies load.
+
+    Titles get ids in the order of their canonical keys (see title_keys).
+    Autocomplete binary-searches the sorted keys: the titles starting with a
+    prefix are one contiguous id range. Substring and fuzzy search use an
+    inverted index from each character trigram to the sorted ids of the
+    titles containing it; a title's similarity to a query is the share of
+    the query's trigrams it contains.
+    """
+
+    def __init__(self, titles, keys=None):
+        titles = [str(title) for title in titles]
+        keys = list(title_keys(titles) if keys is None else keys)
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self.titles = np.array([titles[i] for i in order], dtype=object)
+        self.keys = np.array([keys[i] for i in order], dtype=object)
+        self._build_trigrams()
+
+    def _build_trigrams(self):
+        """Builds the alphabet, the trigram codes and each trigram's posting list of title ids."""
+        n = len(self.keys)
+        lengths = np.fromiter(map(len, self.keys), dtype=np.int64, count=n)
+        ends = np.cumsum(lengths)
+        chars = np.frombuffer("".join(self.keys).encode("utf-32-le"), dtype=np.uint32)
+
+        # Dense ranks of the code points in use, so that a trigram code fits in a few bits
+        seen = np.bincount(chars, minlength=1) > 0
+        self.char_ranks = np.full(len(seen), -1, dtype=np.int64)
+        self.char_ranks[seen] = np.arange(seen.sum())
+        self.alphabet_size = max(int(seen.sum()), 1)
+        packed = self.alphabet_size ** 3 * max(n, 1) < 2 ** 63
+
+        blocks = []
+        for first in range(0, n, TITLE_INDEX_BLOCK):
+            last = min(first + TITLE_INDEX_BLOCK, n)
+            start, stop = ends[first] - lengths[first], ends[last - 1]
+            title = np.repeat(np.arange(first, last), lengths[first:last])
+            ranks = self.char_ranks[chars[start:stop]]
+            # Trigrams start at every position with two more characters of the same title
+            valid = np.flatnonzero(np.arange(start, stop) + 2 < ends[title])
+            codes = self.trigram_codes(ranks, valid)
+            blocks.append(codes * n + title[valid] if packed else np.stack([codes, title[valid]]))
+
+        # Sort the (trigram, title) pairs and drop repeats of a trigram within a title
+        if packed:
+            pairs = np.sort(np.concatenate(blocks)) if blocks else np.array([], dtype=np.int64)
+            pairs = pairs[np.append(True, np.diff(pairs) != 0)] if len(pairs) else pairs
+            codes, ids = np.divmod(pairs, max(n, 1))
+        else:
+            codes, ids = np.concatenate(blocks, axis=1)
+            order = np.lexsort((ids, codes))
+            codes, ids = codes[order], ids[order]
+            keep = np.append(True, (np.diff(codes) != 0) | (np.diff(ids) != 0))
+            codes, ids = codes[keep], ids[keep]
+        first = np.flatnonzero(np.append(True, np.diff(codes) != 0)) if len(codes) else np.array([], dtype=np.intp)
+        self.trigrams = codes[first]
+        self.bounds = np.append(first, len(codes))
+        self.postings = ids.astype(np.int32)
+
+    def trigram_codes(self, ranks, starts):
+        """Codes of the trigrams of a rank sequence that start at the given positions."""
+        size = self.alphabet_size
+        return (ranks[starts] * size + ranks[starts + 1]) * size + ranks[starts + 2]
+
+    def query_postings(self, key):
+        """Returns the posting list of each distinct trigram of a search key (empty for trigrams no title has)."""
+        grams = list({key[i:i + 3] for i in range(len(key) - 2)})
+        if not grams or not len(self.trigrams):
+            return [self.postings[:0] for _ in grams]
+        chars = np.array([[ord(c) for c in gram] for gram in grams])
+        ranks = np.where(chars < len(self.char_ranks), self.char_ranks[np.minimum(chars, len(self.char_ranks) - 1)], -1)
+        codes = self.trigram_codes(ranks.ravel(), np.arange(0, ranks.size, 3))
+        positions = np.minimum(np.searchsorted(self.trigrams, codes), len(self.trigrams) - 1)
+        known = (ranks >= 0).all(axis=1) & (self.trigrams[positions] == codes)
+        return [self.postings[self.bounds[p]:self.bounds[p + 1]] if found else self.postings[:0]
+                for p, found in zip(positions, known)]
+
+    def prefix_range(self, key):
+        """Returns the (first, last) id range of the titles whose search key starts with `key`."""
+        return (int(np.searchsorted(self.keys, key, side="left")),
+                int(np.searchsorted(self.keys, key + "\U0010ffff", side="left")))
+
+    def autocomplete(self, prefix, limit=10):
+        """Returns up to `limit` titles whose search key starts with the prefix, alphabetically."""
+        first, last = self.prefix_range(title_key(prefix))
+        return self.titles[first:min(last, first + limit)].tolist()
+
+    def search(self, query, limit=10, min_similarity=0.5):
+        """
+        Finds the titles that contain the query or most of its trigrams.
+
+        Args:
+            query (str): Any part of a title, possibly misspelt.
+            limit (int): Maximum number of titles returned.
+            min_similarity (float): Minimum share of the query's trigrams a title must contain.
+
+        Returns:
+            pd.Series: Similarity (1.0: every trigram of the query) indexed by
+            movie_name, highest first, ties alphabetical. Queries shorter than
+            three characters are matched as a prefix.
+        """
+        key = title_key(query)
+        postings = sorted(self.query_postings(key), key=len)
+        if not postings:
+            titles = self.autocomplete(key, limit)
+            return pd.Series(1.0, index=pd.Index(titles, name="movie_name"), name="similarity", dtype=float)
+
+        # A title sharing `needed` of the trigrams contains one of the rarest len - needed + 1
+        needed = max(1, int(np.ceil(min_similarity * len(postings))))
+        seeds = postings[:len(postings) - needed + 1]
+        candidates = seeds[0] if len(seeds) == 1 else np.unique(np.concatenate(seeds))
+        shared = np.zeros(len(candidates), dtype=np.int64)
+        for posting in postings:
+            if len(posting):
+                found = np.minimum(np.searchsorted(posting, candidates), len(posting) - 1)
+                shared += posting[found] == candidates
+        keep = shared >= needed
+        candidates, shared = candidates[keep], shared[keep]
+
+        # Rank by shared trigrams, then titles starting with the query, then id (alphabetical order)
+        first, last = self.prefix_range(key)
+        not_prefix = (candidates < first) | (candidates >= last)
+        rank = ((len(postings) - shared) * 2 + not_prefix) * len(self.keys) + candidates
+        if len(rank) > limit:
+            rank = rank[np.argpartition(rank, limit)[:limit]]
+        rank = np.sort(rank)
+        ids = rank % len(self.keys)
+        similarity = len(postings) - rank // len(self.keys) // 2
+        return pd.Series(similarity / len(postings), index=pd.Index(self.titles[ids], name="movie_name"),
+                         name="similarity")
+
+
+def prepare_movies(df):
+    """Builds the indexes that depend on the movies alone: (genre_names, genre_bits, title_index, movie_keys)."""
+    names, bits = build_genre_bitset(df["movie_genre"])
+    keys = pd.Index(title_keys(df["movie_name"]))
+    return names, bits, TitleIndex(df["movie_name"], keys), keys
+
+
+# How ratings of the same movie by the same user are resolved, at load and on append: "keep" leaves
+# every row, "first" / "last" keep one of the ratings, "mean" / "max" merge them into one
+DUPLICATE_POLICY = "keep"
+DUPLICATE_POLICIES = ("keep", "first", "last", "mean", "max")
+
+# Odd 64-bit multiplier that spreads user ids over 64 bits before they are combined with title hashes
+PAIR_HASH_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+def rating_pair_keys(df):
+    """
+    Returns the (user_id, title) pair of each rating as (hashes, users, titles).
+
+    Titles are compared on their canonical key (see title_keys), computed
+    once per distinct title, so spelling variants of a movie count as the
+    same movie: `titles` holds each row's key and `users` its int64 user id.
+    `hashes` is a uint64 hash of the pair, the same in any frame; pairs are
+    searched by hash and matches confirmed on the exact pair, so two pairs
+    whose hashes collide are never taken for one another.
+    """
+    names = df["movie_name"]
+    if isinstance(names.dtype, pd.CategoricalDtype):
+        codes, titles = names.cat.codes.to_numpy(), names.cat.categories
+    else:
+        codes, titles = pd.factorize(names)
+    keys = title_keys(titles)
+    users = df["user_id"].to_numpy(dtype=np.int64)
+    hashes = pd.util.hash_array(keys)[codes] ^ (users.astype(np.uint64) * PAIR_HASH_MIX)
+    return hashes, users, keys[codes]
+
+
+def take_pair_keys(keys, rows):
+    """Returns the rating_pair_keys() at positions (or a mask) `rows`."""
+    return tuple(array[rows] for array in keys)
+
+
+def group_rating_pairs(keys):
+    """
+    Groups ratings by their exact (user, title) pair.
+
+    Rows are grouped by factorizing their pair hashes (one hash table pass,
+    no sort) and each group checked against the pair of its first row; if
+    two pairs share a hash, the rows are grouped on the pairs themselves.
+
+    Returns:
+        tuple: (codes, pairs) - the group of each row, numbered in order of
+               first appearance, and the number of groups.
+    """
+    hashes, users, titles = keys
+    codes, uniques = pd.factorize(hashes)
+    # Groups are numbered in order of appearance, so group k first appears where the running maximum reaches k
+    leaders = np.searchsorted(np.maximum.accumulate(codes), np.arange(len(uniques)))[codes]
+    if (users[leaders] == users).all() and (titles[leaders] == titles).all():
+        return codes, len(uniques)
+    codes, uniques = pd.MultiIndex.from_arrays([users, titles]).factorize()
+    return codes, len(uniques)
+
+
+class RatingPairs:
+    """
+    Index of the (user, movie) pairs of a ratings frame, for resolving duplicates across read blocks and appends.
+
+    `hashes`, `users` and `titles` hold the rating_pair_keys() of the pairs
+    in hash order and `rows` the frame row of each; `weights`, kept for the
+    "mean" policy, the number of ratings averaged into each row (None: one
+    each). Lookups are binary searches on the hashes, confirmed on the exact
+    pairs, and new pairs are merged in with one pass over the arrays.
+    """
+
+    def __init__(self, keys, rows, weights=None):
+        self.hashes, self.users, self.titles = keys
+        self.rows = rows
+        self.weights = weights
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @classmethod
+    def of(cls, df):
+        """Indexes every row of a ratings frame."""
+        keys = rating_pair_keys(df)
+        order = np.argsort(keys[0], kind="stable")
+        return cls(take_pair_keys(keys, order), order)
+
+    def keys(self):
+        """Returns the indexed pairs as (hashes, users, titles), in index order."""
+        return self.hashes, self.users, self.titles
+
+    def find(self, keys):
+        """
+        Looks pairs (as rating_pair_keys() gives them) up.
+
+        Returns:
+            tuple: (rows, slots) - the frame row holding each pair and its
+                   position in the index, or -1 for pairs not in the index.
+        """
+        hashes, users, titles = keys
+        slots = np.searchsorted(self.hashes, hashes)
+        found = slots < len(self.hashes)
+        found[found] = self.hashes[slots[found]] == hashes[found]
+        candidates = np.flatnonzero(found)
+        at = slots[candidates]
+        collided = candidates[(self.users[at] != users[candidates]) | (self.titles[at] != titles[candidates])]
+        found[collided] = False
+        for i in collided:
+            # Another pair with the same hash comes first: look along the run of equal hashes
+            slot = slots[i] + 1
+            while slot < len(self.hashes) and self.hashes[slot] == hashes[i]:
+                if self.users[slot] == users[i] and self.titles[slot] == titles[i]:
+                    found[i], slots[i] = True, slot
+                    break
+                slot += 1
+        rows = np.full(len(hashes), -1, dtype=np.intp)
+        rows[found] = self.rows[slots[found]]
+        return rows, np.where(found, slots, -1)
+
+    def weight(self, slots):
+        """Number of ratings merged into the pairs at index positions `slots`."""
+        if self.weights is None:
+            return np.ones(len(slots), dtype=np.int64)
+        return self.weights[slots]
+
+    def reweighted(self, slots, weights):
+        """Returns a copy with the weights at index positions `slots` replaced."""
+        merged = self.weights.copy() if self.weights is not None else np.ones(len(self.hashes), dtype=np.int64)
+        merged[slots] = weights
+        return RatingPairs(self.keys(), self.rows, merged)
+
+    def added(self, keys, rows, weights=None):
+        """Returns a copy that also indexes pairs `keys` at frame rows `rows`."""
+        order = np.argsort(keys[0], kind="stable")
+        at = np.searchsorted(self.hashes, keys[0][order], side="right")
+        merged_weights = None
+        if self.weights is not None or weights is not None:
+            old = self.weight(np.arange(len(self.hashes)))
+            new = np.ones(len(rows), dtype=np.int64) if weights is None else weights
+            merged_weights = np.insert(old, at, new[order])
+        return RatingPairs(tuple(np.insert(old, at, new[order]) for old, new in zip(self.keys(), keys)),
+                           np.insert(self.rows, at, rows[order]), merged_weights)
+
+
+def with_rating_values(df, values):
+    """Returns a ratings frame with its ratings replaced by float `values`, keeping compact frames compact."""
+    df = df.assign(rating=values)
+    return compact_ratings(df) if is_compact(df) else df
+
+
+class DuplicateResolver:
+    """
+    Resolves ratings of the same movie by the same user block by block, as a file is read.
+
+    Each block added is resolved within itself and against the pairs of the
+    blocks before it, which are carried along in RatingPairs segments that
+    are merged as they grow (so each pair is copied O(log n) times). A
+    block's ratings of pairs already seen are dropped as it arrives; under
+    "last" they replace the earlier row instead, and under "mean" / "max"
+    they are folded into its value, both applied by result(). The outcome
+    is that of resolve_duplicates() on all the blocks at once.
+    """
+
+    def __init__(self, policy=None):
+        policy = DUPLICATE_POLICY if policy is None else policy
+        if policy not in DUPLICATE_POLICIES:
+            raise ValueError(f"Unknown duplicate policy '{policy}'. Choose from {', '.join(DUPLICATE_POLICIES)}.")
+        self.policy = policy
+        self.duplicates = 0
+        self.blocks = []
+        # Position of each block's first row among the rows kept so far, and of the end
+        self.starts = [0]
+        # "mean": rating sums and counts of each block's rows; "max": their highest ratings
+        self.values = []
+        self.counts = []
+        self.changed = set()
+        # "last": positions of rows replaced by a later rating of the same pair
+        self.replaced = []
+        self.segments = []
+        self.resolved = None
+
+    def add(self, block):
+        """Resolves a block of cleaned ratings within itself and against the blocks added before."""
+        if self.policy == "keep":
+            self.blocks.append(block)
+            return
+        keys = rating_pair_keys(block)
+        codes, pairs = group_rating_pairs(keys)
+        merging = self.policy in ("mean", "max")
+        if pairs < len(block):
+            self.duplicates += len(block) - pairs
+            chosen = np.full(pairs, -1 if self.policy == "last" else len(block))
+            (np.maximum if self.policy == "last" else np.minimum).at(chosen, codes, np.arange(len(block)))
+            kept = np.sort(chosen)
+            if merging:
+                values = rating_values(block)
+                if self.policy == "mean":
+                    merged = np.bincount(codes, values, minlength=pairs)
+                else:
+                    merged = np.full(pairs, -np.inf)
+                    np.maximum.at(merged, codes, values)
+                self.values.append(merged[codes[kept]])
+                self.counts.append(np.bincount(codes, minlength=pairs)[codes[kept]])
+                self.changed.add(len(self.blocks))
+            block, keys = block.take(kept), take_pair_keys(keys, kept)
+        elif merging:
+            self.values.append(rating_values(block).copy())
+            self.counts.append(np.ones(len(block), dtype=np.int64))
+
+        # Looked up in hash order, which keeps the binary searches local
+        order = np.argsort(keys[0])
+        keys = take_pair_keys(keys, order)
+        rows, segments, slots = self.find(keys)
+        seen = rows >= 0
+        start = self.starts[-1]
+        positions = order
+        if seen.any():
+            self.duplicates += int(seen.sum())
+            if self.policy == "last":
+                self.replaced.append(rows[seen])
+                for segment, slot, row in zip(segments[seen], slots[seen], start + order[seen]):
+                    self.segments[segment].rows[slot] = row
+                positions = order[~seen]
+            else:
+                kept = np.ones(len(block), dtype=bool)
+                kept[order[seen]] = False
+                if merging:
+                    self.fold(rows[seen], self.values[-1][order[seen]], self.counts[-1][order[seen]])
+                    self.values[-1], self.counts[-1] = self.values[-1][kept], self.counts[-1][kept]
+                block = block[kept]
+                positions = (np.cumsum(kept) - 1)[order[~seen]]
+            keys = take_pair_keys(keys, ~seen)
+        self.blocks.append(block)
+        self.starts.append(start + len(block))
+        self.push(RatingPairs(keys, start + positions))
+
+    def find(self, keys):
+        """Looks pairs up in every segment: returns (rows, segments, slots), -1 for pairs not seen yet."""
+        rows = np.full(len(keys[0]), -1, dtype=np.intp)
+        segments, slots = rows.copy(), rows.copy()
+        for i, segment in enumerate(self.segments):
+            todo = np.flatnonzero(rows < 0)
+            if not len(todo):
+                break
+            found, at = segment.find(take_pair_keys(keys, todo))
+            hit = found >= 0
+            rows[todo[hit]], segments[todo[hit]], slots[todo[hit]] = found[hit], i, at[hit]
+        return rows, segments, slots
+
+    def fold(self, positions, values, counts):
+        """Folds ratings into the kept rows at `positions`: adds to their sums and counts ("mean") or raises their maxima."""
+        blocks = np.searchsorted(self.starts, positions, side="right") - 1
+        for block in np.unique(blocks):
+            at = blocks == block
+            rows = positions[at] - self.starts[block]
+            if self.policy == "mean":
+                self.values[block][rows] += values[at]
+                self.counts[block][rows] += counts[at]
+            else:
+                self.values[block][rows] = np.maximum(self.values[block][rows], values[at])
+            self.changed.add(block)
+
+    def push(self, segment):
+        """Adds a segment of pairs, merging the newest segments while the older is less than twice the newer's size."""
+        if not len(segment):
+            return
+        self.segments.append(segment)
+        while len(self.segments) > 1 and len(self.segments[-2]) < 2 * len(self.segments[-1]):
+            newest = self.segments.pop()
+            self.segments[-1] = self.segments[-1].added(newest.keys(), newest.rows)
+
+    def result(self):
+        """
+        Returns the resolved ratings of every block added, as resolve_duplicates() does.
+
+        Returns:
+            tuple: (ratings, duplicates, pairs) - kept rows in file order, the
+                   number of rows collapsed and the RatingPairs index of the
+                   ratings (None and None under "keep").
+        """
+        if self.resolved is not None:
+            return self.resolved
+        blocks = list(self.blocks)
+        if self.policy == "keep":
+            self.resolved = concat_ratings(blocks), None, None
+            return self.resolved
+        for block in self.changed:
+            values = self.values[block]
+            blocks[block] = with_rating_values(blocks[block],
+                                               values / self.counts[block] if self.policy == "mean" else values)
+
+        segments = self.segments or [RatingPairs((np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64),
+                                                  np.empty(0, dtype=object)), np.empty(0, dtype=np.intp))]
+        pairs = segments[-1]
+        for segment in reversed(segments[:-1]):
+            pairs = segment.added(pairs.keys(), pairs.rows)
+        weights = np.concatenate(self.counts)[pairs.rows] if self.policy == "mean" else None
+        rows = pairs.rows
+        if self.replaced:
+            alive = np.ones(self.starts[-1], dtype=bool)
+            alive[np.concatenate(self.replaced)] = False
+            blocks = [block[alive[start:end]] for block, start, end in zip(blocks, self.starts, self.starts[1:])]
+            rows = (np.cumsum(alive) - 1)[rows]
+        self.resolved = concat_ratings(blocks), self.duplicates, RatingPairs(pairs.keys(), rows, weights)
+        return self.resolved
+
+
+def resolve_duplicates(df, policy=None):
+    """
+    Resolves ratings of the same movie by the same user in one vectorized pass.
+
+    Rows are grouped on their exact (user, title) pair (see
+    group_rating_pairs). Each group keeps its first or last row, or its
+    first row with the mean or the highest rating of the group, as `policy`
+    says (default DUPLICATE_POLICY). Kept rows stay in file order. Under
+    "keep" the frame is returned as is, at no cost. Files are resolved
+    block by block as they are read, with a DuplicateResolver.
+
+    Returns:
+        tuple: (ratings, duplicates, pairs) - the resolved frame, the number of
+               rows collapsed and the RatingPairs index of the resolved frame
+               (None and None under "keep").
+    """
+    resolver = DuplicateResolver(policy)
+    resolver.add(df)
+    return resolver.result()
+
+
+def prepare_ratings(df, policy=None, resolved=None):
+    """
+    Resolves duplicate ratings (see resolve_duplicates) and builds the indexes that depend on the ratings alone.
+
+    `resolved` is the result() of a DuplicateResolver the ratings were read
+    through, if any; they are then not resolved again.
+
+    Returns:
+        tuple: (ratings, duplicates, pairs, user index, title totals, title histograms)
+    """
+    df, duplicates, pairs = resolve_duplicates(df, policy) if resolved is None else resolved
+    return (df, duplicates, pairs, build_user_index(df["user_id"]), rating_totals_by_title(df),
+            rating_histograms_by_title(df))
+
+
+# Fields of a Dataset snapshot, mirrored by the dataset globals of movie_recommender
+DATASET_FIELDS = ("movies_df", "rating_df", "movies_source", "ratings_source", "genre_names", "genre_bits", "genre_index", "genre_positions",
+                  "title_index", "movie_keys", "movie_sums", "movie_counts", "genre_sums", "genre_counts",
+                  "rating_movie_rows", "movie_histograms", "genre_histograms", "title_totals", "title_histograms",
+                  "unmatched_titles", "duplicate_ratings", "rating_pairs", "aggregates_only",
+                  "user_keys", "user_row_order", "user_bounds", "neighbour_index", "rating_sample")
+
+
+class Dataset:
+    """
+    An immutable, versioned snapshot of the loaded data and everything derived from it.
+
+    Holds one value per name in DATASET_FIELDS - the frames, the genre bitset
+    and index, the rating aggregates and the user and neighbour indexes - and
+    a version that grows with every load, reload or append. Attributes cannot
+    be reassigned and its arrays are read-only: a change builds a new snapshot
+    (dataset_with(), replace()) and makes it current with publish(). Frames,
+    lists and dicts are shared between snapshots and must not be modified.
+    A reader that holds a snapshot sees the same data for as long as it keeps it.
+    """
+
+    __slots__ = ("version",) + DATASET_FIELDS
+
+    def __init__(self, version=0, **fields):
+        unknown = set(fields) - set(DATASET_FIELDS)
+        if unknown:
+            raise TypeError(f"Unknown dataset fields: {', '.join(sorted(unknown))}")
+        object.__setattr__(self, "version", version)
+        defaults = {"genre_names": [], "genre_index": {}, "genre_positions": {}}
+        for name in DATASET_FIELDS:
+            value = fields.get(name, defaults.get(name))
+            if isinstance(value, np.ndarray) and value.flags.writeable:
+                value = value.view()
+                value.flags.writeable = False
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Dataset snapshots are immutable; build a new one with replace()")
+
+    def __reduce__(self):
+        """Pickles the snapshot as its version and fields, so it can be sent to a worker process as it is."""
+        return Dataset, (self.version,), self.fields()
+
+    def __setstate__(self, fields):
+        Dataset.__init__(self, self.version, **fields)
+
+    def __repr__(self):
+        movies = "-" if self.movies_df is None else len(self.movies_df)
+        ratings = "-" if self.rating_df is None else len(self.rating_df)
+        return f"Dataset(version={self.version}, movies={movies}, ratings={ratings})"
+
+    def fields(self):
+        """Returns the snapshot's fields as a dict (without the version)."""
+        return {name: getattr(self, name) for name in DATASET_FIELDS}
+
+    def replace(self, **changes):
+        """Returns a copy with some fields (or the version) changed; the version is kept unless given."""
+        fields = {"version": self.version, **self.fields(), **changes}
+        return Dataset(**fields)
+
+
+current_dataset = Dataset()
+publish_lock = threading.Lock()
+
+# Called with every published snapshot, under publish_lock (see follow_publishes)
+publish_listeners = []
+
+# Background thread that builds reloaded snapshots, one reload at a time
+reload_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dataset-reload")
+
+
+def publish(dataset, base=None):
+    """
+    Makes a snapshot current: swaps current_dataset and passes it to the publish listeners.
+
+    With `base`, publishes only if `base` is still the current snapshot (so a
+    change built from it cannot overwrite a newer one) and returns whether it did.
+    Queries take current_dataset once and read everything from that snapshot,
+    so swapping the reference is all they need to see either the old data
+    or the new, never a mix; the listeners only mirror it for the menu.
+    """
+    global current_dataset
+    with publish_lock:
+        if base is not None and current_dataset is not base:
+            return False
+        current_dataset = dataset
+        for listener in publish_listeners:
+            listener(dataset)
+    return True
+
+
+def follow_publishes(listener):
+    """Calls listener(dataset) with the current snapshot now, then with every snapshot published."""
+    with publish_lock:
+        publish_listeners.append(listener)
+        listener(current_dataset)
+
+
+# Bytes read from each end of a file for its fingerprint
+FINGERPRINT_SAMPLE = 1 << 16
+
+
+def file_fingerprint(file_path):
+    """
+    Returns a short hash identifying the current contents of a file without reading all of it.
+
+    Covers the size, the modification time (in nanoseconds) and the first and
+    last FINGERPRINT_SAMPLE bytes, so rewriting, appending to or touching the
+    file gives a new fingerprint.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        digest.update(f"{stat.st_size}:{stat.st_mtime_ns}:".encode())
+        digest.update(f.read(FINGERPRINT_SAMPLE))
+        if stat.st_size > FINGERPRINT_SAMPLE:
+            f.seek(max(FINGERPRINT_SAMPLE, stat.st_size - FINGERPRINT_SAMPLE))
+            digest.update(f.read())
+    return digest.hexdigest()[:32]
+
+
+def ratings_fingerprint(file_path):
+    """
+    Returns the file_fingerprint() of a ratings file, qualified by the
+    settings it is loaded under (DUPLICATE_POLICY and COMPACT_RATINGS),
+    since they change the answers.
+    """
+    return f"{file_fingerprint(file_path)}:{DUPLICATE_POLICY}:{'compact' if movie_data.COMPACT_RATINGS else 'full'}"
+
+
+def unchanged_source(before, file_path, fingerprint=file_fingerprint):
+    """
+    Returns `before`, a fingerprint taken before reading a file, if the file
+    still has it once read, or None if it changed meanwhile: the data then
+    matches neither version, so answers from it are not cached.
+    """
+    try:
+        return before if fingerprint(file_path) == before else None
+    except OSError:
+        return None
+
+
+def dataset_with(base, movies=None, movie_indexes=None, ratings=None, rating_indexes=None,
+                 movies_source=None, ratings_source=None):
+    """
+    Builds the snapshot that follows `base` with its movies and/or ratings replaced.
+
+    Reads only `base` and the arguments, never current_dataset, so it can
+    run in a background thread while queries keep answering from `base`.
+    Indexes from prepare_movies() / prepare_ratings() are reused when given
+    (the latter then also supplies the ratings with their duplicates
+    resolved), and the sources are the fingerprints of the files the data was read from.
+    """
+    fields = base.fields()
+    if movies is not None:
+        names, bits, titles, keys = movie_indexes if movie_indexes is not None else prepare_movies(movies)
+        index, positions = build_genre_index(names, bits)
+        fields.update(movies_df=movies, movies_source=movies_source, genre_names=names, genre_bits=bits, genre_index=index,
+                      genre_positions=positions, title_index=titles, movie_keys=keys)
+    if ratings is not None:
+        ratings, duplicates, pairs, (keys, order, bounds), totals, histograms = (
+            rating_indexes if rating_indexes is not None else prepare_ratings(ratings))
+        fields.update(rating_df=ratings, ratings_source=ratings_source, duplicate_ratings=duplicates, rating_pairs=pairs,
+                      aggregates_only=None, user_keys=keys, user_row_order=order, user_bounds=bounds,
+                      title_totals=totals, title_histograms=histograms, neighbour_index=None)
+    fields.update(rating_aggregates(fields))
+    return Dataset(base.version + 1, **fields)
+
+
+def publish_update(**changes):
+    """
+    Builds the snapshot following the current one (see dataset_with) and publishes it.
+
+    If another snapshot is published while this one is being built, it is
+    rebuilt on top of that one, so concurrent changes are never lost.
+    Returns: The published Dataset.
+    """
+    while True:
+        base = current_dataset
+        dataset = dataset_with(base, **changes)
+        if publish(dataset, base):
+            return dataset
+
+
+def set_movies(df, source=None):
+    """
+    Installs a cleaned movies DataFrame and rebuilds its genre bitset, index and aggregates.
+
+    `source` is the file_fingerprint() of the file it was read from, if any.
+    """
+    publish_update(movies=df, movies_source=source)
+
+
+def set_ratings(df, source=None):
+    """
+    Installs a cleaned ratings DataFrame and rebuilds the user index and rating aggregates.
+
+    `source` is the file_fingerprint() of the file it was read from, if any.
+    """
+    publish_update(ratings=df, ratings_source=source)
+
+
+def read_datasets(movies_path, ratings_path, backend=None, progress=None):
+    """
+    Reads and validates a movies file and a ratings file at the same time.
+
+    Each file is parsed in its own worker thread together with the indexes
+    that depend on it alone (the parsers release the GIL while tokenizing),
+    so the wall time is close to that of the slower file. `progress`
+    follows the ratings file (see read_ratings_with_progress()).
+
+    Returns:
+        tuple: ((movies, movie_indexes), (ratings, rating_indexes)) for dataset_with().
+    Raises: The error of the movies file, else of the ratings file (as read_movies_file / read_ratings_file).
+    """
+    def read_movies():
+        movies = read_movies_file(movies_path, backend)
+        return movies, prepare_movies(movies)
+
+    def read_ratings():
+        resolver = DuplicateResolver()
+        ratings = read_ratings_with_progress(ratings_path, backend, progress, resolver)
+        return ratings, prepare_ratings(ratings, resolved=resolver.result())
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        movies = pool.submit(read_movies)
+        ratings = pool.submit(read_ratings)
+        return movies.result(), ratings.result()
+
+
+def read_ratings_with_progress(file_path, backend=None, progress=None, resolver=None):
+    """
+    Reads a ratings file (through `resolver`, see read_ratings_file()),
+    reporting to `progress` (if given) as progress("reading", rows parsed so
+    far) after every block and progress("indexing", rows) once the whole file is parsed.
+    """
+    if progress is None:
+        return read_ratings_file(file_path, backend=backend, resolver=resolver)
+    progress("reading", 0)
+    ratings = read_ratings_file(file_path, backend=backend, progress=lambda rows: progress("reading", rows),
+                                resolver=resolver)
+    progress("indexing", len(ratings))
+    return ratings
+
+
+def load_datasets(movies_path, ratings_path, backend=None):
+    """
+    Loads a movies file and a ratings file concurrently and installs both.
+
+    The cross-file structures (title -> movie resolution and the rating
+    aggregates) are built once, after both files are parsed. Nothing is
+    installed if either file fails to load.
+
+    Returns: (movies_df, rating_df)
+    """
+    sources = file_fingerprint(movies_path), ratings_fingerprint(ratings_path)
+    (movies, movie_indexes), (ratings, rating_indexes) = read_datasets(movies_path, ratings_path, backend)
+    sources = (unchanged_source(sources[0], movies_path),
+               unchanged_source(sources[1], ratings_path, ratings_fingerprint))
+    dataset = publish_update(movies=movies, movie_indexes=movie_indexes, ratings=ratings,
+                             rating_indexes=rating_indexes, movies_source=sources[0], ratings_source=sources[1])
+    return dataset.movies_df, dataset.rating_df
+
+
+def reload_datasets(movies_path=None, ratings_path=None, backend=None, progress=None):
+    """
+    Reloads the movies and/or the ratings file in the background.
+
+    The files are read and validated and every index and aggregate is built
+    in a worker thread while queries keep answering from the current
+    snapshot; the new snapshot is then published in a single swap.
+    Reloads run one at a time, in the order they were requested.
+    `progress` is called from the worker as the ratings file is read (see
+    read_ratings_with_progress()).
+
+    Returns:
+        concurrent.futures.Future: Resolves to the published Dataset, or raises
+        the load error (the current snapshot then stays in place).
+    """
+    def reload():
+        if progress is not None:
+            progress("reading", 0)
+        if movies_path and ratings_path:
+            sources = file_fingerprint(movies_path), ratings_fingerprint(ratings_path)
+            (movies, movie_indexes), (ratings, rating_indexes) = read_datasets(movies_path, ratings_path, backend,
+                                                                               progress)
+            sources = (unchanged_source(sources[0], movies_path),
+                       unchanged_source(sources[1], ratings_path, ratings_fingerprint))
+            return publish_update(movies=movies, movie_indexes=movie_indexes, ratings=ratings,
+                                  rating_indexes=rating_indexes, movies_source=sources[0], ratings_source=sources[1])
+        if movies_path:
+            source = file_fingerprint(movies_path)
+            movies = read_movies_file(movies_path, backend)
+            return publish_update(movies=movies, movies_source=unchanged_source(source, movies_path))
+        source = ratings_fingerprint(ratings_path)
+        resolver = DuplicateResolver()
+        ratings = read_ratings_with_progress(ratings_path, backend, progress, resolver)
+        return publish_update(ratings=ratings, rating_indexes=prepare_ratings(ratings, resolved=resolver.result()),
+                              ratings_source=unchanged_source(source, ratings_path, ratings_fingerprint))
+
+    if not movies_path and not ratings_path:
+        raise ValueError("Nothing to reload: give a movies path, a ratings path or both.")
+    return reload_pool.submit(reload)
+
+
+def title_labels(titles, movies=None, keys=None):
+    """
+    Returns the names per-title results are reported under: the catalogue's
+    spelling for titles whose canonical key is in `movies` (matched through
+    its `keys`), else the cleaned title (see clean_titles).
+    """
+    labels = clean_titles(titles)
+    if movies is None or not len(movies):
+        return labels
+    rows = keys.get_indexer(pd.Series(labels, dtype=object).str.casefold())
+    names = movies["movie_name"].iloc[np.maximum(rows, 0)].to_numpy(dtype=object)
+    return np.where(rows >= 0, names, labels)
+
+
+def relabel_titles(table, movies=None, keys=None):
+    """Re-indexes a per-title table by title_labels(), summing the rows that become one title."""
+    labels = pd.Index(title_labels(table.index, movies, keys), name="movie_name")
+    if labels.equals(table.index):
+        return table
+    return table.groupby(labels).sum()
+
+
+def find_unmatched_titles(totals, keys):
+    """Returns the rating count of each title in a per-title totals table that has no catalogue movie."""
+    counts = totals["rating_count"]
+    if keys is not None:
+        counts = counts[keys.get_indexer(pd.Series(np.asarray(counts.index), dtype=object).str.casefold()) < 0]
+    return rank_descending(counts.rename("ratings"))
+
+
+def rating_totals_by_title(df):
+    """Returns the sum and count of ratings per (cleaned) title, indexed by movie_name."""
+    values = pd.Series(rating_values(df), index=df.index)
+    totals = values.groupby(df["movie_name"], observed=True).agg(rating_sum="sum", rating_count="count")
+    if isinstance(totals.index, pd.CategoricalIndex):
+        totals.index = pd.Index(np.asarray(totals.index), name="movie_name")
+    return relabel_titles(totals)
+
+
+# Histogram bins of the ratings 0.0, 0.5, ..., 5.0
+HALF_STAR_BINS = 11
+HALF_STARS = np.arange(HALF_STAR_BINS) / 2
+
+
+def rating_bins(values):
+    """Half-star bin (0-10) of each rating; ratings between half stars go to the nearest one (halves up)."""
+    return np.clip(np.floor(np.asarray(values, dtype=np.float64) * 2 + 0.5), 0, HALF_STAR_BINS - 1).astype(np.intp)
+
+
+def bin_counts(groups, values, n_groups):
+    """Half-star histograms of the ratings of each group (e.g. movie row), as an n_groups x 11 array."""
+    keys = groups * HALF_STAR_BINS + rating_bins(values)
+    return np.bincount(keys, minlength=n_groups * HALF_STAR_BINS).reshape(n_groups, HALF_STAR_BINS)
+
+
+def rating_histograms_by_title(df):
+    """Returns the half-star histogram of every (cleaned) title's ratings, indexed by movie_name."""
+    codes, titles = pd.factorize(df["movie_name"])
+    histograms = bin_counts(codes, rating_values(df), len(titles))
+    return relabel_titles(pd.DataFrame(histograms, index=pd.Index(np.asarray(titles), name="movie_name"),
+                                       columns=HALF_STARS))
+
+
+def build_user_index(user_col):
+    """
+    Groups rating rows by user so one user's ratings can be sliced out directly.
+
+    Returns:
+        tuple: (keys, order, bounds) - a pd.Index of distinct user ids, the
+               rating row positions sorted by user, and the slice boundaries
+               of each user within that order.
+    """
+    codes, keys = pd.factorize(user_col)
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(len(keys) + 1))
+    return pd.Index(keys), order, bounds
+
+
+def with_user_index(dataset):
+    """
+    Returns a snapshot with its user index, rebuilding it if appended ratings have invalidated it.
+
+    The rebuilt snapshot replaces `dataset` as the current one, unless
+    another was published meanwhile.
+    """
+    if dataset.user_keys is not None or dataset.rating_df is None:
+        return dataset
+    keys, order, bounds = build_user_index(dataset.rating_df["user_id"])
+    indexed = dataset.replace(user_keys=keys, user_row_order=order, user_bounds=bounds)
+    publish(indexed, dataset)
+    return indexed
+
+
+def user_rows(dataset, user_id):
+    """Returns the rating_df row positions of a user's ratings (empty if the user is unknown), from a snapshot with its user index."""
+    code = dataset.user_keys.get_indexer([user_id])[0]
+    if code < 0:
+        return np.array([], dtype=np.intp)
+    return dataset.user_row_order[dataset.user_bounds[code]:dataset.user_bounds[code + 1]]
+
+
+def rating_aggregates(fields):
+    """
+    Computes the cross-file aggregates of a dict of dataset fields: the
+    per-movie and per-genre rating sums, counts and histograms, the per-title
+    tables under catalogue names, and the unmatched titles.
+
+    This is the only full pass over the ratings needed by the genre queries;
+    it runs once per load instead of once per query. Ratings join the
+    catalogue on canonical title keys (see movie_positions).
+
+    Snapshots holding merged aggregates instead of ratings (see
+    set_aggregates) get theirs from the per-title tables (see aggregates_by_movie).
+
+    Returns: A dict of Dataset fields; the per-movie and per-genre ones are None unless both datasets are loaded.
+    """
+    movies, ratings, keys = fields["movies_df"], fields["rating_df"], fields["movie_keys"]
+    aggregates = {}
+    if fields["title_totals"] is not None:
+        aggregates["title_totals"] = relabel_titles(fields["title_totals"], movies, keys)
+        aggregates["unmatched_titles"] = find_unmatched_titles(aggregates["title_totals"], keys)
+    if fields["title_histograms"] is not None:
+        aggregates["title_histograms"] = relabel_titles(fields["title_histograms"], movies, keys)
+    if fields["aggregates_only"] and movies is not None:
+        return {**aggregates, "rating_movie_rows": None, **aggregates_by_movie({**fields, **aggregates})}
+    if movies is None or ratings is None:
+        return {**aggregates, **dict.fromkeys(("movie_sums", "movie_counts", "genre_sums", "genre_counts",
+                                               "rating_movie_rows", "movie_histograms", "genre_histograms"))}
+
+    rows = movie_positions(ratings["movie_name"], keys)
+    values = rating_values(ratings)
+    sums, counts = movie_rating_totals(rows, values, len(movies))
+    indicator = unpack_genre_bits(fields["genre_bits"], len(fields["genre_names"]))
+
+    matched = rows >= 0
+    histograms = bin_counts(rows[matched], values[matched], len(movies))
+    return {**aggregates, "rating_movie_rows": rows, "movie_sums": sums, "movie_counts": counts,
+            "genre_sums": sums @ indicator, "genre_counts": counts @ indicator,
+            "movie_histograms": histograms, "genre_histograms": indicator.T.astype(np.int64) @ histograms}
+
+
+def aggregates_by_movie(fields):
+    """
+    Computes the per-movie and per-genre rating sums, counts and histograms
+    of a dict of dataset fields from its per-title tables, for snapshots that
+    hold merged aggregates instead of the ratings themselves.
+    """
+    names = fields["movies_df"]["movie_name"]
+    totals = fields["title_totals"].reindex(names, fill_value=0)
+    sums = totals["rating_sum"].to_numpy(dtype=np.float64)
+    counts = totals["rating_count"].to_numpy(dtype=np.int64)
+    histograms = fields["title_histograms"].reindex(names, fill_value=0).to_numpy(dtype=np.int64)
+    indicator = unpack_genre_bits(fields["genre_bits"], len(fields["genre_names"]))
+    return {"movie_sums": sums, "movie_counts": counts, "genre_sums": sums @ indicator,
+            "genre_counts": counts @ indicator, "movie_histograms": histograms,
+            "genre_histograms": indicator.T.astype(np.int64) @ histograms}
+
+
+def dataset_with_appended(base, new_ratings):
+    """
+    Builds the snapshot that follows `base` with new (already cleaned) ratings added.
+
+    Unless DUPLICATE_POLICY is "keep", duplicates are resolved within the
+    new rows and against the loaded ones, which are found through the
+    RatingPairs index of `base` (built on the first append). The per-title, per-movie and
+    per-genre totals are updated from the new rows alone, on copies of the
+    arrays of `base`; only new ratings that replace or merge with loaded ones
+    ("last", "mean", "max") rebuild the snapshot (see dataset_with_merged).
+    The user and neighbour indexes are left to be rebuilt lazily on the
+    next query that needs them.
+    """
+    policy = DUPLICATE_POLICY
+    duplicates, pairs = base.duplicate_ratings, None
+    if policy != "keep":
+        new_ratings, duplicates, new_pairs = resolve_duplicates(new_ratings, policy)
+        pairs = base.rating_pairs if base.rating_pairs is not None else RatingPairs.of(base.rating_df)
+        rows, slots = pairs.find(new_pairs.keys())
+        seen = rows >= 0
+        duplicates += int(seen.sum()) + (base.duplicate_ratings or 0)
+        if seen.any() and policy != "first":
+            return dataset_with_merged(base, new_ratings, new_pairs, pairs, rows, slots, duplicates)
+        if seen.any():
+            kept = np.sort(new_pairs.rows[~seen])
+            positions = np.empty(len(new_ratings), dtype=np.intp)
+            positions[kept] = np.arange(len(kept))
+            new_pairs = RatingPairs(take_pair_keys(new_pairs.keys(), ~seen), positions[new_pairs.rows[~seen]])
+            new_ratings = new_ratings.take(kept)
+        pairs = pairs.added(new_pairs.keys(), new_pairs.rows + len(base.rating_df), new_pairs.weights)
+
+    ratings = base.rating_df
+    if is_compact(ratings):
+        ratings = concat_ratings([ratings, compact_ratings(new_ratings)])
+    else:
+        start = ratings.index.max() + 1 if len(ratings) else 0
+        new_ratings = new_ratings.set_axis(pd.RangeIndex(start, start + len(new_ratings)))
+        ratings = pd.concat([ratings, new_ratings])
+
+    new_totals = relabel_titles(rating_totals_by_title(new_ratings), base.movies_df, base.movie_keys)
+    new_histograms = relabel_titles(rating_histograms_by_title(new_ratings), base.movies_df, base.movie_keys)
+    title_totals = base.title_totals.add(new_totals, fill_value=0).astype({"rating_count": "int64"})
+    changes = {
+        "version": base.version + 1,
+        "rating_df": ratings,
+        "ratings_source": None,
+        "duplicate_ratings": duplicates, "rating_pairs": pairs,
+        "user_keys": None, "user_row_order": None, "user_bounds": None, "neighbour_index": None,
+        "title_totals": title_totals,
+        "title_histograms": base.title_histograms.add(new_histograms, fill_value=0).astype("int64"),
+        "unmatched_titles": find_unmatched_titles(title_totals, base.movie_keys),
+    }
+    if base.movies_df is None:
+        return base.replace(**changes)
+
+    rows = movie_positions(new_ratings["movie_name"], base.movie_keys)
+    values = rating_values(new_ratings)
+    matched = rows >= 0
+    movie_sums, movie_counts = base.movie_sums.copy(), base.movie_counts.copy()
+    movie_histograms = base.movie_histograms.copy()
+    np.add.at(movie_sums, rows[matched], values[matched])
+    np.add.at(movie_counts, rows[matched], 1)
+    indicator = unpack_genre_bits(base.genre_bits[rows[matched]], len(base.genre_names))
+    one_hot = bin_counts(np.arange(matched.sum()), values[matched], matched.sum())
+    np.add.at(movie_histograms, rows[matched], one_hot)
+    return base.replace(
+        **changes,
+        movie_sums=movie_sums,
+        movie_counts=movie_counts,
+        movie_histograms=movie_histograms,
+        genre_sums=base.genre_sums + values[matched] @ indicator,
+        genre_counts=base.genre_counts + indicator.sum(axis=0),
+        genre_histograms=base.genre_histograms + indicator.T.astype(np.int64) @ one_hot,
+        rating_movie_rows=np.concatenate([base.rating_movie_rows, rows]),
+    )
+
+
+def dataset_with_merged(base, new_ratings, new_pairs, pairs, rows, slots, duplicates):
+    """
+    Builds the snapshot that follows `base` with new ratings merged into the loaded ones.
+
+    New ratings of pairs already loaded (found at `rows` / index `slots` of
+    `pairs`) replace, or are merged into, the loaded rating as DUPLICATE_POLICY
+    says - "mean" weighs each side by the ratings it already averages - and
+    the others are appended. The ratings change in place, so the snapshot
+    is rebuilt from the merged frame.
+    """
+    policy = DUPLICATE_POLICY
+    seen = rows >= 0
+    values = rating_values(base.rating_df).copy()
+    new_values = rating_values(new_ratings, new_pairs.rows[seen])
+    targets = rows[seen]
+    if policy == "last":
+        values[targets] = new_values
+    elif policy == "max":
+        values[targets] = np.maximum(values[targets], new_values)
+    else:
+        old_weights, new_weights = pairs.weight(slots[seen]), new_pairs.weight(np.flatnonzero(seen))
+        values[targets] = (values[targets] * old_weights + new_values * new_weights) / (old_weights + new_weights)
+        pairs = pairs.reweighted(slots[seen], old_weights + new_weights)
+
+    appended = np.sort(new_pairs.rows[~seen])
+    positions = np.empty(len(new_ratings), dtype=np.intp)
+    positions[appended] = np.arange(len(base.rating_df), len(base.rating_df) + len(appended))
+    pairs = pairs.added(take_pair_keys(new_pairs.keys(), ~seen), positions[new_pairs.rows[~seen]],
+                        None if new_pairs.weights is None else new_pairs.weights[~seen])
+
+    loaded = with_rating_values(base.rating_df, values)
+    ratings = concat_ratings([loaded, new_ratings.take(appended)]) if len(appended) else loaded
+    if not is_compact(ratings):
+        ratings = ratings.set_axis(pd.RangeIndex(len(ratings)))
+    dataset = dataset_with(base, ratings=ratings, rating_indexes=prepare_ratings(ratings, "keep"))
+    return dataset.replace(duplicate_ratings=duplicates, rating_pairs=pairs)
+
+
+def append_ratings(new_ratings):
+    """
+    Folds newly arrived (already cleaned) ratings into the dataset and publishes the result.
+
+    The aggregates are updated at a cost proportional to the new data (see
+    dataset_with_appended); the user index is rebuilt lazily on the next
+    per-user query.
+    """
+    while True:
+        base = current_dataset
+        if base.rating_df is None:
+            set_ratings(new_ratings)
+            return
+        if new_ratings.empty:
+            return
+        if publish(dataset_with_appended(base, new_ratings), base):
+            return
+
+
+def genre_matrix(dataset, rows=None):
+    """
+    Expands the genre bitset of a snapshot into a boolean movie x genre indicator matrix.
+
+    Args:
+        rows (array-like, optional): Movie row positions to expand. Defaults to every movie.
+    """
+    bits = dataset.genre_bits
+    return unpack_genre_bits(bits if rows is None else bits[rows], len(dataset.genre_names))
+
+
+def unpack_genre_bits(bits, n_genres):
+    """Expands rows of a genre bitset into a boolean indicator matrix with n_genres columns."""
+    as_bytes = np.ascontiguousarray(bits, dtype="<u8").view(np.uint8)
+    return np.unpackbits(as_bytes, axis=1, count=n_genres, bitorder="little").astype(bool)
+
+
+def find_genre(genre, dataset=None):
+    """
+    Returns the bit position of a genre name (case- and whitespace-insensitive), or None if it is unknown.
+
+    Looks in `dataset`, by default the current snapshot.
+    """
+    dataset = current_dataset if dataset is None else dataset
+    return dataset.genre_positions.get(normalize_genre(genre))
+
+
+def movie_positions(movie_names, keys):
+    """
+    Maps titles to the row position of their movie in movies_df (-1 for titles not in the catalogue).
+
+    Titles match on their canonical key (see title_keys), so spacing, case
+    and Unicode variants of a catalogue title find its movie. Each distinct
+    title is normalized once and the result expanded through its codes.
+
+    Args:
+        movie_names (pd.Series): Titles, plain or categorical.
+        keys (pd.Index): Catalogue keys to match against (a snapshot's movie_keys).
+    """
+    if isinstance(movie_names.dtype, pd.CategoricalDtype):
+        codes, titles = movie_names.cat.codes.to_numpy(), movie_names.cat.categories
+    else:
+        codes, titles = pd.factorize(movie_names)
+    title_rows = np.append(keys.get_indexer(title_keys(titles)), -1)
+    return title_rows[codes]
+
+
+def movie_rating_totals(rows, values, n_movies):
+    """
+    Sums and counts ratings per catalogue movie without joining the two tables.
+
+    Args:
+        rows (np.ndarray): movies_df row position of each rating (-1 if not in the catalogue).
+        values (np.ndarray): The rating values.
+        n_movies (int): Catalogue size.
+
+    Returns: (sums, counts) arrays aligned with the rows of movies_df.
+    """
+    matched = rows >= 0
+    sums = np.bincount(rows[matched], weights=values[matched], minlength=n_movies)
+    counts = np.bincount(rows[matched], minlength=n_movies)
+    return sums, counts
+
+
+def rank_descending(series, n=None):
+    """
+    Sorts averages from highest to lowest, breaking ties by name; NaN averages go last.
+
+    For a top n much shorter than the series, only the values reaching the
+    n-th highest (found with a partial sort) are ranked.
+    """
+    if n is not None and 0 < n * 4 < len(series):
+        values = series.to_numpy(dtype=float)
+        valid = values[~np.isnan(values)]
+        if len(valid) > n:
+            series = series[values >= np.partition(valid, len(valid) - n)[len(valid) - n]]
+    ranked = series.sort_index(kind="mergesort").sort_values(ascending=False, kind="mergesort")
+    return ranked if n is None else ranked.head(n)
+
+
+# Bytes of hash values computed at a time while building MinHash signatures; each block of
+# (user, movie) pairs is sized so its num_perm x pairs uint64 temporaries stay within it
+MINHASH_BLOCK_BYTES = 32 << 20
+
+
+class UserNeighbourIndex:
+    """
+    Locality-sensitive hashing index over the sets of movies each user rated.
+
+    Every user's set is summarised by a MinHash signature of num_perm
+    values; two signatures agree at each position with probability equal to
+    the Jaccard similarity of the two sets. The signature is cut into bands
+    of num_perm // bands values and each band is hashed to a bucket key.
+    Users sharing a bucket in any band are neighbour candidates, so a query
+    only looks at its own buckets instead of every user, and only those
+    candidates get their exact similarity computed.
+
+    A pair with similarity s becomes candidates with probability
+    1 - (1 - s**r)**bands for r = num_perm // bands rows per band: more,
+    shorter bands find more true neighbours at the cost of more candidates
+    per query. The defaults (128 x 64, r = 2) put the threshold near
+    (1 / bands) ** (1 / r) = 0.125, because the nearest neighbours of a
+    rating set typically share only 15-30% of their movies. In
+    benchmark_neighbours.py (50k users, 1.25M ratings) they compare about
+    100 candidates per query for a recall@10 of 0.93; 128 x 32 (r = 4)
+    compares 3 and finds 7% of the neighbours. With min_rating set, only
+    ratings at or above it count (similar likes rather than similar viewing).
+    """
+
+    def __init__(self, num_perm=128, bands=64, min_rating=None, seed=0):
+        if bands <= 0 or num_perm % bands:
+            raise ValueError("num_perm must be a positive multiple of bands.")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.min_rating = min_rating
+        # Multiply-shift hash functions: the top 32 bits of a * x + b (mod 2**64) for odd a
+        rng = np.random.default_rng(seed)
+        max_u64 = np.iinfo(np.uint64).max
+        self.hash_a = rng.integers(0, max_u64, num_perm, dtype=np.uint64, endpoint=True) | np.uint64(1)
+        self.hash_b = rng.integers(0, max_u64, num_perm, dtype=np.uint64, endpoint=True)
+        self.band_mix = rng.integers(0, max_u64, (bands, num_perm // bands, 1), dtype=np.uint64, endpoint=True)
+
+    def build(self, dataset=None):
+        """Indexes the ratings of `dataset` (default: the current snapshot) in one vectorized pass. Returns self."""
+        dataset = with_user_index(current_dataset if dataset is None else dataset)
+        user_keys, ratings = dataset.user_keys, dataset.rating_df
+        self.user_keys = user_keys
+        user_codes = np.empty(len(ratings), dtype=np.int64)
+        user_codes[dataset.user_row_order] = np.repeat(np.arange(len(user_keys)), np.diff(dataset.user_bounds))
+        item_codes = pd.factorize(ratings["movie_name"])[0].astype(np.int64)
+        if self.min_rating is not None:
+            liked = rating_values(ratings) >= self.min_rating
+            user_codes, item_codes = user_codes[liked], item_codes[liked]
+
+        # Distinct (user, movie) pairs, sorted by user
+        n_items = item_codes.max(initial=0) + 1
+        pairs = np.unique(user_codes * n_items + item_codes)
+        self.pair_users = pairs // n_items
+        self.pair_items = pairs % n_items
+        self.pair_bounds = np.searchsorted(self.pair_users, np.arange(len(user_keys) + 1))
+        self.set_sizes = np.diff(self.pair_bounds)
+
+        # Signatures are stored hash-major (num_perm x users) so the per-user minimum runs along rows;
+        # the hashes are the top 32 bits, so they fit in uint32
+        n_users = len(user_keys)
+        signatures = np.full((self.num_perm, n_users), np.iinfo(np.uint32).max, dtype=np.uint32)
+        block = max(MINHASH_BLOCK_BYTES // (self.num_perm * 8), 1)
+        for start in range(0, len(pairs), block):
+            users = self.pair_users[start:start + block]
+            items = self.pair_items[start:start + block].astype(np.uint64)
+            hashes = (self.hash_a[:, None] * items + self.hash_b[:, None]) >> np.uint64(32)
+            group_starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]])
+            owners = users[group_starts]
+            # A user's pairs can straddle two blocks, so merge with what is already there
+            reduced = np.minimum.reduceat(hashes, group_starts, axis=1).astype(np.uint32)
+            signatures[:, owners] = np.minimum(signatures[:, owners], reduced)
+
+        # Buckets are numbered across all bands, in (band, key) order, and kept as CSR lists of
+        # users: bucket_users[bucket_bounds[b]:bucket_bounds[b + 1]] are the users of bucket b.
+        # Built one band at a time, so the temporaries are one row of keys per user.
+        rows = self.num_perm // self.bands
+        index_type = np.int32 if self.bands * n_users < np.iinfo(np.int32).max else np.int64
+        self.bucket_users = np.empty(self.bands * n_users, dtype=index_type)
+        self.user_buckets = np.empty((n_users, self.bands), dtype=index_type)
+        bounds, n_buckets = [], 0
+        for band in range(self.bands):
+            keys = (signatures[band * rows:(band + 1) * rows].astype(np.uint64) * self.band_mix[band]).sum(axis=0)
+            order = np.argsort(keys, kind="stable")
+            sorted_keys = keys[order]
+            new_bucket = np.r_[True, sorted_keys[1:] != sorted_keys[:-1]] if n_users else np.array([], dtype=bool)
+            self.user_buckets[order, band] = np.cumsum(new_bucket) - 1 + n_buckets
+            self.bucket_users[band * n_users:(band + 1) * n_users] = order
+            bounds.append(np.flatnonzero(new_bucket) + band * n_users)
+            n_buckets += int(new_bucket.sum())
+        self.bucket_bounds = np.append(np.concatenate(bounds), self.bands * n_users)
+        return self
+
+    def user_code(self, user_id):
+        """Position of a user in the index, or -1 if the user has no indexed ratings."""
+        code = self.user_keys.get_indexer([user_id])[0]
+        return code if code >= 0 and self.set_sizes[code] > 0 else -1
+
+    def jaccard(self, code, others):
+        """Exact Jaccard similarity between one user's movie set and each of the other users'."""
+        items = self.pair_items[self.pair_bounds[code]:self.pair_bounds[code + 1]]
+        sizes = self.set_sizes[others]
+        owners = np.repeat(np.arange(len(others)), sizes)
+        positions = np.arange(len(owners)) + np.repeat(self.pair_bounds[others] - np.cumsum(sizes) + sizes, sizes)
+        shared = np.bincount(owners[np.isin(self.pair_items[positions], items)], minlength=len(others))
+        return shared / np.maximum(sizes + len(items) - shared, 1)
+
+    def top_neighbours(self, code, candidates, k):
+        """The k candidates most similar to the user as a Series indexed by user_id, ties by user_id."""
+        candidates = candidates[(candidates != code) & (self.set_sizes[candidates] > 0)]
+        similarity = self.jaccard(code, candidates)
+        series = pd.Series(similarity, index=pd.Index(self.user_keys.to_numpy()[candidates], name="user_id"),
+                           name="similarity")
+        return rank_descending(series[series > 0], k)
+
+    def neighbours(self, user_id, k=10):
+        """
+        Approximate nearest neighbours of a user.
+
+        Only users sharing an LSH bucket with the user are compared, and
+        their similarity is then computed exactly.
+
+        Returns:
+            pd.Series: Up to k Jaccard similarities indexed by user_id, most similar first.
+        """
+        code = self.user_code(user_id)
+        if code < 0:
+            return self.top_neighbours(code, np.array([], dtype=np.int64), k)
+        # The users of the user's bucket in every band, gathered in one pass
+        buckets = self.user_buckets[code]
+        starts = self.bucket_bounds[buckets]
+        lengths = self.bucket_bounds[buckets + 1] - starts
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        return self.top_neighbours(code, np.unique(self.bucket_users[np.arange(lengths.sum()) + offsets]), k)
+
+    def exact_neighbours(self, user_id, k=10):
+        """
+        Exact nearest neighbours by Jaccard similarity, comparing the user with every other user.
+
+        Returns:
+            pd.Series: Up to k Jaccard similarities indexed by user_id, most similar first.
+        """
+        code = self.user_code(user_id)
+        candidates = np.arange(len(self.set_sizes)) if code >= 0 else np.array([], dtype=np.int64)
+        return self.top_neighbours(code, candidates, k)
+
+
+def get_neighbour_index(dataset):
+    """
+    Returns the neighbour index of a snapshot's ratings, building it if the
+    ratings changed (and installing it if the snapshot is still current).
+    """
+    if dataset.neighbour_index is None:
+        index = UserNeighbourIndex().build(dataset)
+        publish(dataset.replace(neighbour_index=index), dataset)
+        return index
+    return dataset.neighbour_index
+
+
+# Version tag written into serialized partial aggregates
+PARTIAL_FORMAT = "movie_recommender.partial/2"
+
+
+class PartialAggregates:
+    """
+    Rating sums and counts of one partition of the ratings, mergeable with others.
+
+    Holds three tables of rating_sum / rating_count: per title (indexed by
+    movie_name), per genre (movie_genre) and per user and genre (user_id,
+    movie_genre), and the half-star histogram of each title. Each partition of the ratings (e.g. a range of users) is
+    reduced to one of these on its own; merging adds the tables, so partials
+    can be combined in any order or grouping and the result equals the
+    aggregates of all the ratings together. Genre tables use the genre
+    names of the movies catalogue, which every partition must share.
+    """
+
+    def __init__(self, titles, genres, user_genres, histograms):
+        self.titles = titles
+        self.genres = genres
+        self.user_genres = user_genres
+        self.histograms = histograms
+
+    @classmethod
+    def from_ratings(cls, ratings, dataset=None):
+        """Aggregates a cleaned ratings DataFrame against the movies catalogue of `dataset` (default: the current snapshot)."""
+        dataset = current_dataset if dataset is None else dataset
+        movies_df, movie_keys, genre_names = dataset.movies_df, dataset.movie_keys, dataset.genre_names
+        rows = movie_positions(ratings["movie_name"], movie_keys)
+        values = rating_values(ratings)
+        sums, counts = movie_rating_totals(rows, values, len(movies_df))
+        indicator = genre_matrix(dataset)
+        genres = pd.DataFrame({"rating_sum": sums @ indicator, "rating_count": counts @ indicator},
+                              index=pd.Index(genre_names, name="movie_genre"))
+
+        # Reduce to (user, movie) totals first, then spread each over the movie's genres
+        matched = rows >= 0
+        user_codes, users = pd.factorize(ratings["user_id"].to_numpy()[matched])
+        n_movies = max(len(movies_df), 1)
+        n_genres = max(len(genre_names), 1)
+        pairs, inverse = np.unique(user_codes.astype(np.int64) * n_movies + rows[matched], return_inverse=True)
+        pair_sums = np.bincount(inverse, weights=values[matched], minlength=len(pairs))
+        pair_counts = np.bincount(inverse, minlength=len(pairs))
+        pair_idx, genre_pos = np.nonzero(genre_matrix(dataset, pairs % n_movies))
+        keys, key_inverse = np.unique((pairs[pair_idx] // n_movies) * n_genres + genre_pos, return_inverse=True)
+        key_counts = np.bincount(key_inverse, weights=pair_counts[pair_idx], minlength=len(keys))
+        user_genres = pd.DataFrame({
+            "rating_sum": np.bincount(key_inverse, weights=pair_sums[pair_idx], minlength=len(keys)),
+            "rating_count": key_counts.astype(np.int64),
+        }, index=pd.MultiIndex.from_arrays([np.asarray(users)[keys // n_genres],
+                                            np.array(genre_names, dtype=object)[keys % n_genres]],
+                                           names=["user_id", "movie_genre"]))
+
+        # Sorted like a merge result, so a partial equals the merge of its own parts
+        return cls(relabel_titles(rating_totals_by_title(ratings), movies_df, movie_keys),
+                   genres[genres["rating_count"] > 0].sort_index(), user_genres.sort_index(),
+                   relabel_titles(rating_histograms_by_title(ratings), movies_df, movie_keys).sort_index())
+
+    def merge(self, other):
+        """Returns the aggregates of both partitions together."""
+        def add(a, b):
+            return pd.concat([a, b]).groupby(level=list(range(a.index.nlevels))).sum()
+        return PartialAggregates(add(self.titles, other.titles), add(self.genres, other.genres),
+                                 add(self.user_genres, other.user_genres), add(self.histograms, other.histograms))
+
+    def to_json(self):
+        """Serializes the aggregates as a JSON document."""
+        def columns(df):
+            return df.reset_index().to_dict(orient="list")
+        return json.dumps({"format": PARTIAL_FORMAT, "titles": columns(self.titles), "genres": columns(self.genres),
+                           "user_genres": columns(self.user_genres),
+                           "histograms": {"movie_name": self.histograms.index.tolist(),
+                                          "counts": self.histograms.to_numpy().tolist()}}, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, text):
+        """Reads aggregates serialized with to_json()."""
+        payload = json.loads(text)
+        if payload.get("format") != PARTIAL_FORMAT:
+            raise ValueError(f"Not a partial aggregate file (expected format '{PARTIAL_FORMAT}').")
+
+        def table(name, index):
+            df = pd.DataFrame(payload[name], columns=index + ["rating_sum", "rating_count"])
+            return df.astype({"rating_sum": "float64", "rating_count": "int64"}).set_index(index)
+        histograms = pd.DataFrame(np.asarray(payload["histograms"]["counts"], dtype=np.int64).reshape(-1, HALF_STAR_BINS),
+                                  index=pd.Index(payload["histograms"]["movie_name"], dtype=object, name="movie_name"),
+                                  columns=HALF_STARS)
+        return cls(table("titles", ["movie_name"]), table("genres", ["movie_genre"]),
+                   table("user_genres", ["user_id", "movie_genre"]), histograms)
+
+    def save(self, file_path):
+        """Writes the aggregates to file_path atomically."""
+        atomic_write(file_path, self.to_json())
+
+    @classmethod
+    def load(cls, file_path):
+        """Reads aggregates written by save()."""
+        with open(file_path, encoding="utf-8") as f:
+            return cls.from_json(f.read())
+
+    def preferred_genres(self, user_id):
+        """The genre(s) with the user's highest average rating, in name order, or None if the user has none."""
+        if user_id not in self.user_genres.index.get_level_values("user_id"):
+            return None
+        totals = self.user_genres.xs(user_id, level="user_id")
+        averages = totals["rating_sum"] / totals["rating_count"]
+        return sorted(averages[averages == averages.max()].index)
+
+
+def merge_partials(partials):
+    """Merges any number of partial aggregates pairwise, as a balanced tree of merges."""
+    partials = list(partials)
+    if not partials:
+        raise ValueError("Nothing to merge.")
+    while len(partials) > 1:
+        partials = [partials[i].merge(partials[i + 1]) if i + 1 < len(partials) else partials[i]
+                    for i in range(0, len(partials), 2)]
+    return partials[0]
+
+
+def set_aggregates(partial):
+    """
+    Installs merged aggregates in place of a loaded ratings dataset.
+
+    The snapshot is flagged aggregates_only, which the menu accepts as
+    loaded ratings. The per-title totals and histograms are taken from the
+    aggregates, and the per-movie and per-genre ones derived from them
+    against the movies catalogue (again whenever it is reloaded). So the
+    averages, top-N and genre rankings, rating distributions, medians and
+    the ranked-table export answer for all partitions. Queries that need
+    the individual ratings (favourite genres, neighbours, recommendations)
+    are unavailable until a ratings file is loaded again; preferred genres
+    come from PartialAggregates.preferred_genres().
+    """
+    while True:
+        base = current_dataset
+        fields = base.fields()
+        fields.update(rating_df=None, ratings_source=None, duplicate_ratings=None, rating_pairs=None,
+                      user_keys=None, user_row_order=None, user_bounds=None, neighbour_index=None,
+                      title_totals=partial.titles, title_histograms=partial.histograms, aggregates_only=True)
+        fields.update(rating_aggregates(fields))
+        if publish(Dataset(base.version + 1, **fields), base):
+            return
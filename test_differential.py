@@ -0,0 +1,442 @@
+"""
+Differential tests for the optimized query paths.
+
+Random datasets are generated with the awkward cases real files contain:
+ties, ratings of titles missing from the catalogue, duplicate ratings,
+out-of-range and non-numeric ratings, multi-genre movies, and whitespace,
+case or Unicode noise in genre names and titles (titles match on their
+canonical key, reported under the catalogue's spelling). Every query is answered by a
+plain pandas reference (the original merge -> groupby -> sort pipelines)
+and by each engine registered in ENGINES. The answers must be identical.
+
+Ratings are multiples of 0.25, so sums and averages are exact in floating
+point and rankings (ties included) can be compared exactly.
+
+Set DIFF_TEST_SCALE to grow the datasets (default 1 = ~40k ratings) and
+DIFF_TEST_SEEDS for more random datasets.
+"""
+import os
+import sys
+import tempfile
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+import movie_data
+import movie_recommender as mr
+import result_cache
+import snapshots
+
+SCALE = float(os.environ.get("DIFF_TEST_SCALE", "1"))
+SEEDS = range(int(os.environ.get("DIFF_TEST_SEEDS", "3")))
+
+GENRES = ["Action", "Adventure", "Comedy", "Drama", "Film Noir", "Horror", "Romance", "Sci-Fi", "Thriller"]
+
+
+# DATASET GENERATION
+
+
+def genre_spelling(rng, genre):
+    """Returns the genre name with random case and whitespace noise."""
+    noisy = genre.upper() if rng.random() < 0.2 else genre.lower() if rng.random() < 0.2 else genre
+    if rng.random() < 0.2:
+        noisy = f" {noisy}  "
+    return noisy
+
+
+def generate_dataset(seed, tmp):
+    """
+    Writes one random dataset and returns the paths and parameters used.
+
+    The same catalogue is written twice: once in the original one-genre-per-row
+    layout (read by the reference) and once with 'A|B|id|name' genre lists.
+    """
+    rng = np.random.default_rng(seed)
+    n_movies = int(1500 * SCALE)
+    n_users = int(800 * SCALE)
+    n_ratings = int(40_000 * SCALE)
+
+    titles = [f"Movie {i} ({1950 + i % 60})" for i in range(n_movies)]
+    movie_genres = [list(rng.choice(GENRES, size=rng.integers(0, 4), replace=False)) for _ in range(n_movies)]
+
+    old_rows, multi_rows = [], []
+    for movie_id, (title, genres) in enumerate(zip(titles, movie_genres)):
+        spellings = [genre_spelling(rng, g) for g in genres]
+        # Some catalogue rows carry stray whitespace in the title
+        noisy = f"{title}  " if movie_id % 97 == 5 else title.replace(" ", "  ") if movie_id % 97 == 6 else title
+        old_rows += [f"{g}|{movie_id}|{noisy if i == 0 else title}" for i, g in enumerate(spellings)]
+        multi_rows.append(f"{'|'.join(spellings)}|{movie_id}|{noisy}")
+    # Movies with no genre are not representable in the one-genre-per-row layout
+    old_rows += [f"{GENRES[0]}|{i}|{titles[i]}" for i, g in enumerate(movie_genres) if not g]
+    multi_rows += [f"{GENRES[0]}|{i}|{titles[i]}" for i, g in enumerate(movie_genres) if not g]
+
+    # Ratings: popular movies are rated more (ties at the top), some titles are unknown,
+    # and some spell a catalogue title with other spacing, case or Unicode forms
+    variants = [titles[0] + "  ", titles[1].upper(), f" {titles[2]}", titles[3].replace(" ", "\u00a0"),
+                titles[4].replace("(", "\uff08").replace(")", "\uff09"), "missing movie 0", "MISSING MOVIE 0 "]
+    rated_titles = np.array(titles + [f"Missing Movie {i}" for i in range(50)] + variants, dtype=object)
+    weights = 1.0 / (np.arange(len(rated_titles)) % 300 + 1)
+    picks = rng.choice(len(rated_titles), size=n_ratings, p=weights / weights.sum())
+    values = rng.integers(0, 21, size=n_ratings) / 4
+    ratings = pd.DataFrame({
+        "movie_name": rated_titles[picks],
+        "rating": values.astype(object),
+        "user_id": rng.integers(1, n_users + 1, size=n_ratings),
+    })
+    # Duplicate ratings of the same movie by the same user
+    duplicates = ratings.sample(frac=0.05, random_state=seed)
+    duplicates["rating"] = rng.integers(0, 21, size=len(duplicates)) / 4
+    ratings = pd.concat([ratings, duplicates]).sample(frac=1.0, random_state=seed + 1)
+    # Out-of-range and non-numeric ratings (well under the 10% the loader tolerates)
+    noise = rng.random(len(ratings))
+    ratings.loc[noise < 0.01, "rating"] = -1.5
+    ratings.loc[(noise >= 0.01) & (noise < 0.02), "rating"] = 7.0
+    ratings.loc[(noise >= 0.02) & (noise < 0.025), "rating"] = "n/a"
+
+    paths = {
+        "movies_old": os.path.join(tmp, "movies_old.txt"),
+        "movies": os.path.join(tmp, "movies.txt"),
+        "ratings": os.path.join(tmp, "ratings.txt"),
+    }
+    with open(paths["movies_old"], "w") as f:
+        f.write("\n".join(old_rows) + "\n")
+    with open(paths["movies"], "w") as f:
+        f.write("\n".join(multi_rows) + "\n")
+    ratings.to_csv(paths["ratings"], sep="|", header=False, index=False)
+
+    users = list(rng.choice(np.arange(1, n_users + 1), size=25, replace=False)) + [n_users + 10]
+    query_genres = [genre_spelling(rng, g) for g in GENRES] + ["Western"]
+    return paths, users, query_genres
+
+
+# REFERENCE IMPLEMENTATION (plain pandas, original pipelines)
+
+
+def clean_title(title):
+    """Display form of a title: NFKC-normalized, whitespace collapsed and stripped."""
+    return " ".join(unicodedata.normalize("NFKC", str(title)).split())
+
+
+def genre_key(genre):
+    """Normalized genre key, as genre lookups are case- and whitespace-insensitive."""
+    return "".join(str(genre).split()).casefold()
+
+
+def rank(series, n=None):
+    """Highest average first, ties by name, NaN last."""
+    ranked = series.sort_index(kind="mergesort").sort_values(ascending=False, kind="mergesort")
+    return ranked if n is None else ranked.head(n)
+
+
+class Reference:
+    """The original merge/groupby implementation of every query."""
+
+    def __init__(self, paths):
+        movies = pd.read_csv(paths["movies_old"], sep="|", header=None, names=["movie_genre", "movie_id", "movie_name"])
+        movies["movie_name"] = movies["movie_name"].map(clean_title)
+        movies["genre_key"] = movies["movie_genre"].map(genre_key)
+        self.movies = movies.drop_duplicates(["movie_name", "genre_key"])
+
+        ratings = pd.read_csv(paths["ratings"], sep="|", header=None, names=["movie_name", "rating", "user_id"])
+        # Titles are reported under the catalogue's spelling when their case-folded clean form matches
+        catalogue = {name.casefold(): name for name in self.movies["movie_name"]}
+        cleaned = ratings["movie_name"].map(clean_title)
+        ratings["movie_name"] = [catalogue.get(title.casefold(), title) for title in cleaned]
+        ratings["rating"] = pd.to_numeric(ratings["rating"], errors="coerce")
+        ratings = ratings.dropna(subset=["rating"])
+        self.ratings = ratings[(ratings["rating"] >= 0) & (ratings["rating"] <= 5)]
+        self.recommendations = {}
+
+    def top_n_movies(self, n):
+        return rank(self.ratings.groupby("movie_name")["rating"].mean(), n)
+
+    def unmatched_titles(self):
+        unmatched = self.ratings[~self.ratings["movie_name"].isin(self.movies["movie_name"])]
+        return rank(unmatched.groupby("movie_name").size())
+
+    def top_n_movies_genre(self, genre, n):
+        genre_movies = self.movies[self.movies["genre_key"] == genre_key(genre)]
+        if genre_movies.empty:
+            return None
+        merged = self.ratings.merge(genre_movies, on="movie_name", how="right")
+        return rank(merged.groupby("movie_name")["rating"].mean(), n)
+
+    def top_n_genres(self, n):
+        merged = self.ratings.merge(self.movies, on="movie_name")
+        return rank(merged.groupby("genre_key")["rating"].mean(), n)
+
+    def user_genre_averages(self, user_id):
+        user_ratings = self.ratings[self.ratings["user_id"] == user_id]
+        merged = user_ratings.merge(self.movies, on="movie_name", how="inner")
+        return merged, merged.groupby("genre_key")["rating"].mean()
+
+    def preferred_genres(self, user_id):
+        _, averages = self.user_genre_averages(user_id)
+        if averages.empty:
+            return None
+        return sorted(averages[averages == averages.max()].index)
+
+    def top_3_movies_fav_genre(self, user_id):
+        merged, averages = self.user_genre_averages(user_id)
+        result = {}
+        for key in self.preferred_genres(user_id) or []:
+            in_genre = merged[merged["genre_key"] == key]
+            result[key] = rank(in_genre.groupby("movie_name")["rating"].mean(), 3)
+        return result
+
+    def raters_top_movies(self, genre, title, min_count, n):
+        """Top n movies of a genre among the ratings of users who rated a title, with at least min_count of them."""
+        genre_movies = self.movies[self.movies["genre_key"] == genre_key(genre)]
+        if genre_movies.empty:
+            return None
+        raters = self.ratings.loc[self.ratings["movie_name"] == title, "user_id"].unique()
+        merged = self.ratings[self.ratings["user_id"].isin(raters)].merge(genre_movies, on="movie_name")
+        stats = merged.groupby("movie_name")["rating"].agg(["mean", "size"])
+        return rank(stats.loc[stats["size"] >= min_count, "mean"], n)
+
+    def genre_averages_between(self, low, high):
+        ratings = self.ratings[self.ratings["rating"].between(low, high)]
+        return rank(ratings.merge(self.movies, on="movie_name").groupby("genre_key")["rating"].mean())
+
+    def half_star_ratings(self):
+        """Ratings rounded to the nearest half star (halves up), as the histograms count them."""
+        return self.ratings.assign(rating=np.floor(self.ratings["rating"] * 2 + 0.5) / 2)
+
+    def top_n_movies_by_median(self, n, genre=None):
+        ratings = self.half_star_ratings()
+        if genre is None:
+            return rank(ratings.groupby("movie_name")["rating"].median(), n)
+        genre_movies = self.movies[self.movies["genre_key"] == genre_key(genre)]
+        if genre_movies.empty:
+            return None
+        merged = ratings.merge(genre_movies, on="movie_name", how="right")
+        return rank(merged.groupby("movie_name")["rating"].median(), n)
+
+    def genre_percentiles(self, genre, q):
+        genre_movies = self.movies[self.movies["genre_key"] == genre_key(genre)]
+        return self.half_star_ratings().merge(genre_movies, on="movie_name")["rating"].quantile(q)
+
+    def recommendation_scores(self, user_id):
+        """Unseen movies' average rating plus the user's mean genre deviation over the movie's genres."""
+        if user_id in self.recommendations:
+            return self.recommendations[user_id]
+        catalogue_ratings = self.ratings[self.ratings["movie_name"].isin(self.movies["movie_name"])]
+        user_ratings = catalogue_ratings[catalogue_ratings["user_id"] == user_id]
+        _, genre_averages = self.user_genre_averages(user_id)
+        deviation = genre_averages - user_ratings["rating"].mean()
+        affinity = self.movies["genre_key"].map(deviation).fillna(0).groupby(self.movies["movie_name"]).mean()
+        averages = catalogue_ratings.groupby("movie_name")["rating"].mean()
+        scores = averages + affinity.reindex(averages.index)
+        self.recommendations[user_id] = scores.drop(user_ratings["movie_name"].unique())
+        return self.recommendations[user_id]
+
+
+# ENGINES UNDER TEST
+
+
+def load_default(paths):
+    mr.set_movies(mr.read_movies_file(paths["movies"]))
+    mr.set_ratings(mr.read_ratings_file(paths["ratings"], backend="pandas"))
+
+
+def load_concurrent(paths):
+    snapshots.load_datasets(paths["movies"], paths["ratings"], backend="pandas")
+
+
+def load_old_layout(paths):
+    mr.set_movies(mr.read_movies_file(paths["movies_old"]))
+    mr.set_ratings(mr.read_ratings_file(paths["ratings"], backend="pandas"))
+
+
+def load_pyarrow(paths):
+    mr.set_movies(mr.read_movies_file(paths["movies"], backend="pyarrow"))
+    mr.set_ratings(mr.read_ratings_file(paths["ratings"], backend="pyarrow"))
+
+
+def load_chunked(paths):
+    mr.set_movies(mr.read_movies_file(paths["movies"]))
+    mr.set_ratings(mr.read_ratings_file(paths["ratings"], chunksize=997, backend="pandas"))
+
+
+def load_compact(paths):
+    mr.set_movies(mr.read_movies_file(paths["movies"]))
+    mr.set_ratings(mr.read_ratings_file(paths["ratings"], chunksize=4999, compact=True))
+
+
+def load_watched(paths):
+    """Starts from part of the ratings file and folds in the rest as appended batches."""
+    with open(paths["ratings"]) as f:
+        lines = f.readlines()
+    watched = paths["ratings"] + ".watched.txt"
+    first = len(lines) * 2 // 5
+    with open(watched, "w") as f:
+        f.writelines(lines[:first])
+
+    mr.set_movies(mr.read_movies_file(paths["movies"]))
+    watcher = mr.RatingsWatcher(watched)
+    watcher.start()
+    for batch in np.array_split(np.arange(first, len(lines)), 3):
+        with open(watched, "a") as f:
+            f.writelines(lines[i] for i in batch)
+        watcher.poll()
+
+
+def load_cached(paths):
+    """Loads the files with the result cache on; the first run fills it, a later run answers from it."""
+    result_cache.RESULT_CACHE_PATH = os.path.join(os.path.dirname(paths["ratings"]), "results.sqlite")
+    result_cache.result_caches.clear()
+    snapshots.load_datasets(paths["movies"], paths["ratings"])
+
+
+ENGINES = {
+    "default": load_default,
+    "concurrent load of both files": load_concurrent,
+    "old one-genre-per-row layout": load_old_layout,
+    "chunked parsing": load_chunked,
+    "compact ratings": load_compact,
+    "watch mode (appended batches)": load_watched,
+    "result cache (cold)": load_cached,
+    "result cache (warm)": load_cached,
+}
+if movie_data.pa_csv is not None:
+    ENGINES["pyarrow parser"] = load_pyarrow
+
+
+# COMPARISON HELPERS
+
+
+def by_genre_key(series):
+    """Re-keys an engine result indexed by display genre names to normalized genre keys."""
+    return series.set_axis(series.index.map(genre_key))
+
+
+def assert_same_ranking(expected, actual, what):
+    """Rankings must list the same names in the same order with the same averages."""
+    assert actual is not None, f"❌ {what}: engine returned None"
+    assert list(actual.index) == list(expected.index), f"❌ {what}: order differs\n{expected}\n{actual}"
+    assert np.array_equal(actual.to_numpy(dtype=float), expected.to_numpy(dtype=float), equal_nan=True), \
+        f"❌ {what}: averages differ\n{expected}\n{actual}"
+
+
+def compare_engine(name, reference, users, query_genres):
+    """Runs every query on the currently loaded engine and checks it against the reference."""
+    n_all = len(reference.ratings)
+    for n in (1, 10, n_all):
+        assert_same_ranking(reference.top_n_movies(n), mr.get_top_n_movies(n), f"{name}: top {n} movies")
+        assert_same_ranking(reference.top_n_genres(n), by_genre_key(mr.get_top_n_genres(n)),
+                            f"{name}: top {n} genres")
+
+    assert_same_ranking(reference.unmatched_titles(), mr.get_unmatched_titles(), f"{name}: unmatched titles")
+
+    for genre in query_genres:
+        for n in (3, n_all):
+            expected = reference.top_n_movies_genre(genre, n)
+            actual = mr.get_top_n_movies_genre(genre, n)
+            if expected is None:
+                assert actual is None, f"❌ {name}: unknown genre '{genre}' should give None"
+            else:
+                assert_same_ranking(expected, actual, f"{name}: top {n} in '{genre}'")
+
+    catalogue_ratings = reference.ratings[reference.ratings["movie_name"].isin(reference.movies["movie_name"])]
+    popular = catalogue_ratings["movie_name"].value_counts().index[0]
+    for genre in query_genres:
+        expected = reference.raters_top_movies(genre, popular, 2, 10)
+        actual = mr.Query().genre(genre).raters_of(popular.upper()).min_ratings(2).top(10).execute()
+        if expected is None:
+            assert actual is None, f"❌ {name}: composed query on unknown genre '{genre}' should give None"
+        else:
+            assert_same_ranking(expected, actual, f"{name}: top 10 in '{genre}' among raters of {popular}")
+    assert_same_ranking(reference.genre_averages_between(2.5, 4),
+                        by_genre_key(mr.Query().ratings_between(2.5, 4).by_genre().execute()),
+                        f"{name}: genre averages of 2.5-4 star ratings")
+
+    quantiles = [0.0, 0.1, 0.25, 0.5, 0.9, 1.0]
+    assert_same_ranking(reference.top_n_movies_by_median(20), mr.get_top_n_movies_by_median(20),
+                        f"{name}: top 20 movies by median")
+    for genre in query_genres:
+        expected = reference.top_n_movies_by_median(10, genre)
+        actual = mr.get_top_n_movies_by_median(10, genre)
+        if expected is None:
+            assert actual is None and mr.get_rating_percentiles(genre=genre) is None, \
+                f"❌ {name}: unknown genre '{genre}' should give None"
+            continue
+        assert_same_ranking(expected, actual, f"{name}: top 10 by median in '{genre}'")
+        assert np.allclose(mr.get_rating_percentiles(genre=genre, q=quantiles).to_numpy(),
+                           reference.genre_percentiles(genre, quantiles).to_numpy(), equal_nan=True), \
+            f"❌ {name}: rating percentiles of '{genre}'"
+
+    batch = mr.get_all_users_top_3_fav_genre()
+    for user_id in users:
+        expected = reference.preferred_genres(user_id)
+        actual = mr.get_preferred_genres(user_id)
+        assert (sorted(map(genre_key, actual)) if actual else None) == expected, \
+            f"❌ {name}: preferred genres of user {user_id}"
+
+        expected_top = reference.top_3_movies_fav_genre(user_id)
+        actual_top = {genre_key(g): movies for g, movies in mr.get_top_3_movies_fav_genre(user_id).items()}
+        assert sorted(actual_top) == sorted(expected_top), f"❌ {name}: favourite genres of user {user_id}"
+        for key in expected_top:
+            assert_same_ranking(expected_top[key], actual_top[key], f"{name}: user {user_id} top 3 in {key}")
+
+            rows = batch[(batch["user_id"] == user_id) & (batch["movie_genre"].map(genre_key) == key)]
+            assert rows["movie_name"].tolist() == list(expected_top[key].index), \
+                f"❌ {name}: batch top 3 of user {user_id} in {key}"
+
+    recommendations = mr.get_all_users_recommendations(10, block_size=97)
+    for user_id in users:
+        expected = reference.recommendation_scores(user_id)
+        actual = mr.get_recommendations(user_id, 10)
+        assert len(actual) == min(10, len(expected)), f"❌ {name}: recommendation count of user {user_id}"
+        assert np.allclose(actual.to_numpy(), expected[actual.index].to_numpy()), \
+            f"❌ {name}: recommendation scores of user {user_id}"
+        assert actual.min() >= expected.nlargest(10).min() - 1e-9, f"❌ {name}: user {user_id} missed a better movie"
+        rows = recommendations[recommendations["user_id"] == user_id]
+        if user_id in mr.user_keys:
+            assert rows["movie_name"].tolist() == actual.index.tolist(), \
+                f"❌ {name}: batch recommendations of user {user_id}"
+
+    tables = mr.compute_rankings(5)
+    assert_same_ranking(reference.top_n_movies(5), tables["overall"].set_index("movie_name")["average_rating"],
+                        f"{name}: exported overall ranking")
+    assert_same_ranking(reference.top_n_genres(5),
+                        by_genre_key(tables["genres"].set_index("movie_genre")["average_rating"]),
+                        f"{name}: exported genre ranking")
+    for genre, rows in tables["by_genre"].groupby("movie_genre"):
+        assert_same_ranking(reference.top_n_movies_genre(genre, 5), rows.set_index("movie_name")["average_rating"],
+                            f"{name}: exported top 5 in '{genre}'")
+
+
+# TESTS
+
+
+def test_engines_match_reference():
+    """Every engine answers every query exactly like the pandas reference."""
+    print("\n" + "=" * 60)
+    print("DIFFERENTIAL TESTS (engines vs pandas reference)")
+    print("=" * 60)
+    for seed in SEEDS:
+        with tempfile.TemporaryDirectory() as tmp:
+            paths, users, query_genres = generate_dataset(seed, tmp)
+            reference = Reference(paths)
+            for name, load in ENGINES.items():
+                result_cache.RESULT_CACHE_PATH = None
+                load(paths)
+                compare_engine(name, reference, users, query_genres)
+                print(f"✓ seed {seed}: {name} matches the reference.")
+
+
+def run_all_tests():
+    """Run all tests"""
+    try:
+        test_engines_match_reference()
+        print("\n" + "=" * 60)
+        print("ALL DIFFERENTIAL TESTS PASSED ✓")
+        print("=" * 60)
+    except AssertionError as e:
+        print(f"\n❌ TEST FAILED: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run_all_tests()
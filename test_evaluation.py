@@ -0,0 +1,65 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import evaluation
+import movie_data
+import movie_recommender as mr
+import snapshots
+
+
+def test_folds_and_metrics():
+    """Folds deal every user's ratings evenly; the metrics are vectorized over users."""
+    users = pd.Series(np.repeat([7, 3, 9], [10, 4, 1]))
+    assignment = evaluation.split_user_folds(users, folds=4, seed=1)
+    per_user = pd.crosstab(users, assignment)
+    assert (per_user.max(axis=1) - per_user.min(axis=1) <= 1).all() and per_user.loc[7].sum() == 10
+    assert (evaluation.split_user_folds(users, folds=4, seed=1) == assignment).all()
+
+    assert evaluation.rmse(np.array([3.0, np.nan, 5.0]), np.array([4.0, 1.0, 5.0])) == np.sqrt(0.5)
+    precision, recall = evaluation.precision_recall_at_k(np.array([0, 0, 1, 1]), np.array([5, 6, 5, 8]),
+                                                         np.array([0, 1, 1, 1, 2]), np.array([6, 5, 7, 7, 1]), k=2)
+    assert np.isclose(precision, (0.5 + 0.5 + 0) / 3) and np.isclose(recall, (1 + 0.5 + 0) / 3)
+
+
+def test_evaluation(engine_data, monkeypatch):
+    """The cross-validation report is the same in one process or several, and never publishes a fold."""
+    dataset = snapshots.with_user_index(engine_data)
+    order = evaluation.ranked_movies(dataset)
+    pair_users, pair_movies = mr.user_genre_totals(dataset)[:2]
+    found = evaluation.first_unseen_movies(dataset, order, 2, np.arange(len(dataset.user_keys)),
+                                           pair_users, pair_movies)
+    for code in range(len(dataset.user_keys)):
+        rated = set(pair_movies[pair_users == code])
+        assert found[1][found[0] == code].tolist() == [row for row in order if row not in rated][:2]
+
+    report = evaluation.evaluate_rankers(folds=2, k=2, workers=1)
+    assert report.index.tolist() == list(evaluation.EVALUATION_METHODS) and snapshots.current_dataset is engine_data
+    assert np.isnan(report.loc["favourite genre", "rmse"]) and (report["seconds"] >= 0).all()
+    assert report[["precision@2", "recall@2"]].stack().between(0, 1).all()
+    assert report.drop(index="favourite genre")["rmse"].between(0, 5).all()
+    pooled = evaluation.evaluate_rankers(folds=2, k=2, workers=2)
+    assert np.allclose(pooled.drop(columns="seconds"), report.drop(columns="seconds"), equal_nan=True)
+    monkeypatch.setattr(evaluation, "RELEVANT_RATING", 3.0)
+    local, pooled = (evaluation.evaluate_rankers(folds=2, k=2, workers=n) for n in (1, 2))
+    assert np.allclose(pooled.drop(columns="seconds"), local.drop(columns="seconds"), equal_nan=True)
+
+    copy = pickle.loads(pickle.dumps(engine_data))
+    assert copy.version == engine_data.version and copy.rating_df.equals(engine_data.rating_df)
+    assert np.array_equal(copy.movie_sums, engine_data.movie_sums) and not copy.movie_sums.flags.writeable
+
+    def append_midway(dataset, totals, test_users, test_movies, k):
+        snapshots.append_ratings(movie_data.clean_ratings(pd.DataFrame({"movie_name": ["Movie Q"], "rating": [1.0],
+                                                                        "user_id": [9]})))
+        return evaluation.evaluate_global_average(dataset, totals, test_users, test_movies, k)
+
+    monkeypatch.setitem(evaluation.EVALUATION_METHODS, "append midway", append_midway)
+    ratings = engine_data.rating_df
+    evaluation.evaluate_fold(evaluation.split_user_folds(ratings["user_id"], folds=2), 0, k=2,
+                             methods=["append midway"])
+    assert len(snapshots.current_dataset.rating_df) == len(ratings) + 1, \
+        "An append during an evaluation should be kept."
+    with pytest.raises(ValueError):
+        evaluation.evaluate_rankers(methods=["coin flip"])
@@ -0,0 +1,84 @@
+import bz2
+import gzip
+import lzma
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import movie_data
+import movie_recommender as mr
+import snapshots
+
+
+def test_compressed_datasets(dataset_files):
+    """Compressed datasets load the same as plain ones, with chunked ratings parsing."""
+    movies_path, plain_ratings = dataset_files
+    expected = movie_data.read_ratings_file(plain_ratings)
+
+    for suffix, module in [(".gz", gzip), (".bz2", bz2), (".xz", lzma)]:
+        ratings_path = plain_ratings + suffix
+        with open(ratings_path, "wb") as f:
+            f.write(module.compress(Path(plain_ratings).read_bytes()))
+        assert movie_data.is_supported_dataset(ratings_path)
+        assert movie_data.read_ratings_file(ratings_path, chunksize=4).equals(expected)
+
+        with open(movies_path + suffix, "wb") as f:
+            f.write(module.compress(Path(movies_path).read_bytes()))
+        assert len(movie_data.read_movies_file(movies_path + suffix)) == 4
+
+    assert not movie_data.is_supported_dataset("ratings.gz")
+    assert not movie_data.is_supported_dataset("ratings.csv")
+
+
+def test_parser_backends(write_dataset, dataset_files, monkeypatch):
+    """Every available parser backend loads identical frames."""
+    backends = ["pandas"] + (["pyarrow"] if movie_data.pa_csv is not None else [])
+    assert movie_data.resolve_parser_backend("auto") == backends[-1]
+    with pytest.raises(ValueError):
+        movie_data.resolve_parser_backend("polars")
+
+    movies_path, plain_ratings = dataset_files
+    rating_content = Path(plain_ratings).read_text()
+    ratings_path = plain_ratings + ".gz"
+    with gzip.open(ratings_path, "wt") as f:
+        f.write(rating_content + "Movie A|abc|5\nMovie B|4.5|6\n")
+    ratings = [movie_data.read_ratings_file(ratings_path, chunksize=3, backend=b) for b in backends]
+    movies = [movie_data.read_movies_file(movies_path, backend=b) for b in backends]
+    assert len(ratings[0]) == 10
+    assert all(r.equals(ratings[0]) for r in ratings)
+    assert all(m.equals(movies[0]) for m in movies)
+
+    if movie_data.pa_csv is not None:
+        ratings_path = write_dataset("long_ratings.txt", rating_content * 20 + "Movie A|abc|5\n" + rating_content)
+        monkeypatch.setattr(movie_data, "ARROW_BLOCK_SIZE", 256)
+        batches = list(movie_data.iter_arrow_batches(ratings_path, ["line"], "\x1f", {"line": movie_data.pa.string()}))
+        streamed = movie_data.read_ratings_file(ratings_path, chunksize=7, backend="pyarrow")
+        assert len(batches) > 5 and sum(batch.num_rows for batch in batches) == 21 * 9 + 1
+        assert streamed.equals(movie_data.read_ratings_file(ratings_path, chunksize=7, backend="pandas"))
+
+
+def test_compact_ratings(engine_data):
+    """Compact storage shrinks the ratings frame without changing any answer."""
+    regular = engine_data.rating_df
+    compact = movie_data.compact_ratings(regular)
+    assert compact["rating"].dtype == np.uint8
+    assert compact["user_id"].dtype == np.uint8
+    assert isinstance(compact["movie_name"].dtype, pd.CategoricalDtype)
+    assert (movie_data.rating_values(compact) == movie_data.rating_values(regular)).all()
+
+    answers = []
+    for ratings in (regular, compact):
+        snapshots.set_ratings(ratings)
+        answers.append((mr.get_top_n_movies(10), mr.get_top_n_genres(10), mr.user_favourites(4)[2]["Comedy"]))
+    for expected, actual in zip(*answers):
+        assert expected.index.tolist() == actual.index.tolist()
+        assert np.allclose(expected.to_numpy(), actual.to_numpy())
+
+    odd = movie_data.compact_ratings(regular.assign(rating=regular["rating"] - 0.25).query("rating >= 0"))
+    assert odd["rating"].dtype == np.float32, "Non-half-step ratings should fall back to float32."
+    combined = movie_data.concat_ratings([compact, odd])
+    assert combined["rating"].dtype == np.float32
+    assert len(combined) == len(compact) + len(odd)
+    assert set(combined["movie_name"].cat.categories) == set(regular["movie_name"])
@@ -1,8 +1,18 @@
+import numpy as np
 import pandas as pd
 import pandas.errors as pe
+import contextlib
+import io
+import json
 import os
 import sys
 
+import pytest
+
+import movie_data
+import movie_recommender as mr
+import snapshots
+
 # Global variables to simulate the original program
 movies_df = None
 rating_df = None
@@ -426,6 +436,452 @@ def test_edge_cases():
     print(f"✓ Requesting N=100 returns {len(top_100)} available movies.")
 
 
+# ENGINE TESTS (exercise movie_recommender directly, with the fixtures in conftest.py)
+
+
+def test_multi_genre_movies(engine_data, unload_ratings, tmp_path, monkeypatch):
+    """Multi-genre movies are stored once and counted once per rating in each genre."""
+    assert len(mr.movies_df) == 4, "Repeated movie rows should be merged."
+    genres = dict(zip(mr.movies_df["movie_name"], mr.movies_df["movie_genre"]))
+    assert genres["Movie Z"] == "Action|Comedy"
+    assert genres["Movie X"] == "Action|Comedy"
+    assert mr.genre_names == ["Action", "Comedy", "Drama"]
+
+    # Same answers as joining against the exploded one-genre-per-row table
+    exploded = mr.movies_df.assign(movie_genre=mr.movies_df["movie_genre"].str.split("|")).explode("movie_genre")
+    merged = mr.rating_df.merge(exploded, on="movie_name")
+    expected = merged.groupby("movie_genre")["rating"].mean()
+    top_genres = mr.get_top_n_genres(10)
+    assert sorted(top_genres.index) == sorted(expected.index)
+    assert all(abs(top_genres[g] - expected[g]) < 1e-9 for g in expected.index)
+
+    comedy = mr.get_top_n_movies_genre("COMEDY", 10)
+    assert comedy.index.tolist() == ["Movie Z", "Movie X", "Movie A"]
+    assert mr.get_top_n_movies_genre("Western", 10) is None
+
+    assert mr.get_preferred_genres(4) == ["Action", "Comedy"]
+    top_3 = mr.get_top_3_movies_fav_genre(4)
+    assert top_3["Comedy"].index.tolist() == ["Movie A", "Movie Z"]
+
+    unload_ratings()
+    assert mr.user_favourites(4)[1:] == ([], {})
+    assert mr.get_preferred_genres(4) is None and mr.get_top_3_movies_fav_genre(4) == {}
+
+    out_dir = tmp_path / "saved"
+    out_dir.mkdir()
+    path = out_dir / "movies.txt"
+    mr.save_movies_file(mr.movies_df, path)
+    assert mr.read_movies_file(path)["movie_genre"].tolist() == mr.movies_df["movie_genre"].tolist()
+    saved = path.read_text()
+
+    def interrupted(fd):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "fsync", interrupted)
+    with pytest.raises(OSError):
+        mr.save_movies_file(mr.movies_df.iloc[:1], path)
+    assert path.read_text() == saved, "An interrupted save should leave the previous file."
+    assert os.listdir(out_dir) == ["movies.txt"]
+
+
+def test_user_favourites_single_pass(engine_data):
+    """Per-user favourites and the all-users batch give the same answers."""
+    genre_averages, favourites, top_movies = mr.user_favourites(4)
+    assert favourites == ["Action", "Comedy"]
+    assert genre_averages["Drama"] == 3.0
+    assert top_movies["Action"].index.tolist() == ["Movie Z"]
+    assert mr.user_favourites(99)[1] == [], "Unknown users have no favourites."
+
+    batch = mr.get_all_users_top_3_fav_genre()
+    for user_id in mr.rating_df["user_id"].unique():
+        _, favourites, top_movies = mr.user_favourites(user_id)
+        expected = [(genre, name) for genre in favourites for name in top_movies[genre].index]
+        rows = batch[batch["user_id"] == user_id]
+        assert list(zip(rows["movie_genre"], rows["movie_name"])) == expected
+
+
+def test_export_rankings(engine_data, unload_ratings, tmp_path):
+    """Bulk export matches the single-genre queries and is written in both formats."""
+    tables = mr.compute_rankings(2)
+    assert tables["overall"]["movie_name"].tolist() == mr.get_top_n_movies(2).index.tolist()
+    assert tables["genres"]["movie_genre"].tolist() == mr.get_top_n_genres(2).index.tolist()
+    for genre in mr.genre_names:
+        rows = tables["by_genre"][tables["by_genre"]["movie_genre"] == genre]
+        assert rows["movie_name"].tolist() == mr.get_top_n_movies_genre(genre, 2).index.tolist()
+        assert rows["rank"].tolist() == list(range(1, len(rows) + 1))
+
+    out_dir = tmp_path / "rankings"
+    out_dir.mkdir()
+    paths = mr.save_rankings(out_dir, 2)
+    assert sorted(os.listdir(out_dir)) == ["top_genres.txt", "top_movies.txt", "top_movies_by_genre.txt"]
+    exported = pd.read_csv(paths[2], sep="|", header=None)
+    assert len(exported) == len(tables["by_genre"])
+
+    mr.save_rankings(out_dir, 2, "json")
+    payload = json.loads((out_dir / "rankings.json").read_text())
+    assert set(payload["by_genre"]) == set(mr.genre_names)
+    assert not [name for name in os.listdir(out_dir) if name.startswith(".tmp-")], "Temp files left behind."
+
+    unload_ratings()
+    empty_dir = tmp_path / "empty"
+    empty_dir.mkdir()
+    assert mr.compute_rankings(2) is None and mr.save_rankings(empty_dir, 2) is None
+    assert os.listdir(empty_dir) == []
+
+
+def test_ratings_watcher(engine_data, dataset_files, tmp_path):
+    """Appended lines are folded into the aggregates; truncation triggers a reload."""
+    with open(dataset_files[1]) as f:
+        lines = f.readlines()
+    path = str(tmp_path / "watched.txt")
+    with open(path, "w") as f:
+        f.writelines(lines[:4])
+    watcher = mr.RatingsWatcher(path)
+    assert watcher.start() == 4
+
+    with open(path, "a") as f:
+        f.writelines(lines[4:])
+        f.write("Movie B|5.")
+    assert watcher.poll() == (5, False)
+    assert watcher.poll() == (0, False), "A partial line must wait for its newline."
+    with open(path, "a") as f:
+        f.write("0|9\n")
+    assert watcher.poll() == (1, False)
+
+    incremental = (mr.movie_sums.copy(), mr.genre_counts.copy(), mr.title_totals.copy())
+    assert mr.get_preferred_genres(9) == ["Drama"]
+    mr.set_ratings(mr.read_ratings_file(path))
+    assert (incremental[0] == mr.movie_sums).all()
+    assert (incremental[1] == mr.genre_counts).all()
+    assert incremental[2].equals(mr.title_totals)
+
+    with open(path, "w") as f:
+        f.writelines(lines[:2])
+    assert watcher.poll() == (2, True)
+    assert len(mr.rating_df) == 2
+
+    before = len(mr.rating_df)
+    for bad in ("Movie A|4|Movie A\n", 'Movie A|4|"1\nMovie B|3|2|extra\n'):
+        with open(path, "a") as f:
+            f.write(bad)
+        with pytest.raises(mr.DatasetValidationError, match="Skipped"):
+            watcher.poll()
+    with open(path, "a") as f:
+        f.write("Movie B|2|8\nMovie A|4|Movie A\n")
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        watcher.watch(interval=0, max_polls=1)
+    assert "Skipped 2 new line(s)" in out.getvalue() and len(mr.rating_df) == before
+    with open(path, "a") as f:
+        f.write("Movie B|2|8\n")
+    assert watcher.poll() == (1, False) and len(mr.rating_df) == before + 1
+
+
+def test_recommendations(engine_data, unload_ratings):
+    """Unseen movies are scored by their average plus the user's genre affinity."""
+    # User 2 rates Action one point above their average and Comedy at their average
+    assert mr.get_recommendations(2, 5).to_dict() == {"Movie X": 5.0, "Movie B": 3.0}
+    user_4 = mr.get_recommendations(4, 5)
+    assert user_4.index.tolist() == ["Movie X"], "Rated movies should never be recommended."
+    assert abs(user_4["Movie X"] - (4.5 + 2 / 3)) < 1e-9
+
+    assert mr.get_recommendations(99, 2).index.tolist() == ["Movie Z", "Movie X"]
+    assert mr.get_recommendations(2, 1).index.tolist() == ["Movie X"]
+
+    batch = mr.get_all_users_recommendations(2, block_size=3)
+    for user_id in mr.rating_df["user_id"].unique():
+        single = mr.get_recommendations(user_id, 2)
+        rows = batch[batch["user_id"] == user_id]
+        assert rows["movie_name"].tolist() == single.index.tolist()
+        assert rows["rank"].tolist() == list(range(1, len(rows) + 1))
+        assert np.allclose(rows["score"], single.to_numpy())
+
+    unload_ratings()
+    assert mr.get_recommendations(2, 5) is None and mr.get_all_users_recommendations(2).empty
+
+
+def test_similar_users(engine_data, unload_ratings, monkeypatch):
+    """LSH neighbours agree with exact Jaccard search and drive neighbour recommendations."""
+    # Users 1 and 3 rated the same titles; user 2's two movies are among user 4's three
+    assert mr.get_similar_users(1).to_dict() == {3: 1.0}
+    assert mr.get_similar_users(2, exact=True).to_dict() == {4: 2 / 3}
+    for user_id in [1, 2, 3, 4]:
+        assert mr.get_similar_users(user_id).equals(mr.get_similar_users(user_id, exact=True))
+    assert mr.get_similar_users(99).empty
+
+    liked = snapshots.UserNeighbourIndex(num_perm=8, bands=4, min_rating=5.0).build()
+    assert liked.exact_neighbours(2).to_dict() == {4: 0.5}
+    assert liked.exact_neighbours(3).empty, "User 3 gave no 5-star rating."
+    with pytest.raises(ValueError):
+        snapshots.UserNeighbourIndex(num_perm=10, bands=4)
+
+    whole = snapshots.UserNeighbourIndex(num_perm=8, bands=4).build()
+    with monkeypatch.context() as blocks:
+        blocks.setattr(snapshots, "MINHASH_BLOCK_BYTES", 8 * 8 * 2)
+        blocked = snapshots.UserNeighbourIndex(num_perm=8, bands=4).build()
+    assert (whole.user_buckets == blocked.user_buckets).all() and (whole.bucket_users == blocked.bucket_users).all()
+
+    # User 4 has only Movie X left; user 2 is their neighbour but has not rated it
+    assert mr.get_neighbour_recommendations(2).to_dict() == {"Movie B": 3.0}
+    assert mr.get_neighbour_recommendations(4).empty
+    mr.append_ratings(mr.clean_ratings(pd.DataFrame({"movie_name": ["Movie X"], "rating": [2.0], "user_id": [2]})))
+    assert mr.neighbour_index is None, "Appended ratings should invalidate the neighbour index."
+    assert mr.get_neighbour_recommendations(4).to_dict() == {"Movie X": 2.0}
+
+    unload_ratings()
+    assert mr.get_similar_users(1) is None and mr.get_similar_users(1, exact=True) is None
+    assert mr.get_neighbour_recommendations(1) is None and mr.neighbour_index is None
+
+
+def test_rating_histograms(engine_data, unload_ratings):
+    """Medians, percentiles and distributions come from half-star histograms."""
+    distribution = mr.get_rating_distribution(genre="comedy")
+    assert distribution.index.tolist() == [i / 2 for i in range(11)]
+    assert distribution[5.0] == 4 and distribution[4.0] == 1 and distribution[3.0] == 1
+    assert mr.get_rating_distribution(movie_name="Movie Y")[4.0] == 2, "Titles outside the catalogue count too."
+    assert mr.get_rating_distribution(movie_name="Missing") is None
+
+    quartiles = mr.get_rating_percentiles(genre="Comedy")
+    expected = mr.rating_df.merge(mr.movies_df[mr.movies_df["movie_genre"].str.contains("Comedy")], on="movie_name")
+    assert np.allclose(quartiles.to_numpy(), expected["rating"].quantile([0.25, 0.5, 0.75]).to_numpy())
+    assert mr.get_rating_percentiles(movie_name="Movie X", q=0.5).tolist() == [4.5]
+
+    assert mr.get_top_n_movies_by_median(2).to_dict() == {"Movie Z": 5.0, "Movie X": 4.5}
+    by_median = mr.get_top_n_movies_by_median(10, "drama")
+    assert by_median.index.tolist() == ["Movie B"] and mr.get_top_n_movies_by_median(3, "Western") is None
+
+    mr.append_ratings(mr.clean_ratings(pd.DataFrame({"movie_name": ["Movie B", "Movie B"], "rating": [0.4, 5.0],
+                                                     "user_id": [5, 6]})))
+    drama = mr.get_rating_distribution(genre="Drama")
+    assert drama[0.5] == 1 and drama[3.0] == 1 and drama[5.0] == 1, "Appends should update the histograms."
+    assert mr.get_rating_percentiles(movie_name="Movie B", q=0.5).tolist() == [3.0]
+
+    unload_ratings()
+    assert mr.get_rating_distribution() is None and mr.get_rating_distribution(movie_name="Movie B") is None
+    assert mr.get_rating_distribution(genre="Drama") is None and mr.get_rating_percentiles(genre="Drama") is None
+    assert mr.get_top_n_movies_by_median(3) is None and mr.get_top_n_movies_by_median(3, "action") is None
+
+
+def test_table_rendering(tmp_path):
+    """Result tables are formatted lazily and streamed to files and streams row by row."""
+    ratings = pd.Series([4.5, 3.0, np.nan], index=pd.Index(["A Long Title", "B", "C"], name="movie_name"))
+    lines = list(mr.iter_table_lines(ratings, ("Movie Name", "Average Rating")))
+    assert lines == ["Movie Name   Average Rating",
+                     "A Long Title           4.50",
+                     "B                      3.00",
+                     "C                       NaN"], lines
+    users = pd.Series([0.5, 1.0], index=pd.Index([3, 120], name="user_id"))
+    assert list(mr.iter_table_lines(users, ("User ID", "Similarity"))) == [
+        "User ID Similarity", "      3       0.50", "    120       1.00"]
+    assert list(mr.iter_table_lines(ratings.iloc[:0], ("Movie Name", "Average Rating"))) == [
+        "Movie Name Average Rating"]
+
+    big = pd.Series(np.arange(2 * mr.RENDER_BLOCK + 5) / 10,
+                    index=pd.Index([f"Movie {i}" for i in range(2 * mr.RENDER_BLOCK + 5)], name="movie_name"))
+    stream = mr.iter_table_lines(big, ("Movie Name", "Average Rating"))
+    assert next(stream).startswith("Movie Name") and next(stream).startswith("Movie 0 ")
+    out = io.StringIO()
+    assert mr.write_table(big, ("Movie Name", "Average Rating"), out) == len(big)
+    assert out.getvalue().count("\n") == len(big) + 1
+    path = tmp_path / "top.txt"
+    mr.save_table(big, ("Movie Name", "Average Rating"), path)
+    assert path.read_text(encoding="utf-8") == out.getvalue()
+
+
+def test_title_search(engine_data):
+    """Title autocomplete and trigram search match a brute-force scan of the catalogue."""
+    assert mr.autocomplete_titles("movie") == ["Movie A", "Movie B", "Movie X", "Movie Z"]
+    assert mr.autocomplete_titles("  MOVIE   x") == ["Movie X"] and mr.autocomplete_titles("Toy") == []
+    assert mr.search_titles("mvie z").index[0] == "Movie Z"
+
+    rng = np.random.default_rng(7)
+    words = ["Toy", "Story", "Amélie", "Night", "Dark", "Knight", "Returns", "of", "the", "Kid"]
+    titles = sorted({" ".join(rng.choice(words, rng.integers(1, 4))) + f" ({rng.integers(1990, 2000)})"
+                     for _ in range(300)})
+    index = snapshots.TitleIndex(titles)
+    for query in ["toy sto", "night", "dark knigt", "AMÉLIE", "the kid (199", "xyz", "ki"]:
+        key = mr.title_key(query)
+        grams = {key[i:i + 3] for i in range(len(key) - 2)}
+        expected = {}
+        for title in titles:
+            title_key = mr.title_key(title)
+            if grams:
+                share = sum(gram in title_key for gram in grams) / len(grams)
+                if share >= 0.5:
+                    expected[title] = share
+            elif title_key.startswith(key):
+                expected[title] = 1.0
+        found = index.search(query, limit=len(titles))
+        assert rounded_scores(found.to_dict()) == rounded_scores(expected), query
+        assert list(found) == sorted(found, reverse=True), query
+        assert index.autocomplete(query, 5) == [t for t in titles if mr.title_key(t).startswith(key)][:5]
+
+
+def rounded_scores(scores):
+    """Rounds the similarity scores of a {title: score} dict for comparison."""
+    return {title: round(score, 9) for title, score in scores.items()}
+
+
+def test_title_canonicalization(load_engine_data):
+    """Ratings join the catalogue on normalized, case-folded titles; leftover titles are reported."""
+    movies = "Comedy|1| Movie  A \nAction|2|Movie B\nDrama|1|movie a\n"
+    ratings = ("MOVIE A|4|1\nMovie\u00a0B|3|1\n  movie a  |2|2\nMovie B|5|2\n"
+               "\uff2d\uff4f\uff56\uff49\uff45 B|1|3\nMovie Q|5|3\nmovie q |4|4\n")
+    load_engine_data(movies, ratings)
+    assert list(mr.movies_df["movie_name"]) == ["Movie A", "Movie B"], mr.movies_df
+    assert list(mr.movies_df["movie_genre"]) == ["Comedy|Drama", "Action"], mr.movies_df
+
+    assert mr.get_top_n_movies_genre("Comedy", 5).to_dict() == {"Movie A": 3.0}
+    assert mr.get_top_n_movies_genre("Action", 5).to_dict() == {"Movie B": 3.0}
+    assert mr.get_top_n_movies(5).to_dict() == {"Movie Q": 5.0, "movie q": 4.0, "Movie B": 3.0, "Movie A": 3.0}
+    assert int(mr.get_rating_distribution(movie_name="movie  b").sum()) == 3
+
+    assert mr.get_unmatched_titles().to_dict() == {"Movie Q": 1, "movie q": 1}
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        mr.report_unmatched_titles()
+    assert "2 ratings of 2 titles" in output.getvalue() and "'Movie Q' (1)" in output.getvalue()
+
+
+def test_rating_matrix_export(engine_data, tmp_path):
+    """The sparse export holds every rating once per user and title, in scipy's CSR .npz layout."""
+    mr.append_ratings(mr.clean_ratings(pd.DataFrame({"movie_name": ["Movie X", "Movie X", " Movie  Y"],
+                                                     "rating": [2.0, 3.0, 1.0], "user_id": [2, 1, 5]})))
+    ratings, genres, labels = (np.load(path) for path in mr.save_rating_matrix(tmp_path))
+    assert set(ratings.files) == {"data", "indices", "indptr", "format", "shape"}
+    assert ratings["format"].item() == b"csr" and genres["format"].item() == b"csr"
+    assert list(labels["user_ids"]) == [1, 2, 3, 4, 5]
+    assert list(labels["titles"]) == ["Movie Z", "Movie X", "Movie A", "Movie B", "Movie Y"]
+    expected = [[0, 4, 0, 0, 4], [5, 2, 3, 0, 0], [0, 4, 0, 0, 4], [5, 0, 5, 3, 0], [0, 0, 0, 0, 1]]
+    assert dense_csr(ratings).tolist() == expected, dense_csr(ratings)
+
+    genre_names = list(labels["genres"])
+    assert genre_names == mr.genre_names
+    expected = np.zeros((5, len(genre_names)), dtype=np.int8)
+    for row, names in enumerate([("Action", "Comedy"), ("Action", "Comedy"), ("Comedy",), ("Drama",)]):
+        expected[row, [genre_names.index(name) for name in names]] = 1
+    assert (dense_csr(genres) == expected).all(), dense_csr(genres)
+
+    blocked = mr.build_rating_matrix(block_size=1)
+    whole = mr.build_rating_matrix()
+    assert all(np.array_equal(blocked[name], whole[name]) for name in ("data", "indices", "indptr"))
+    assert blocked["indices"].dtype == np.int32
+
+
+def dense_csr(arrays):
+    """Expands the CSR arrays of an exported matrix into a dense array, for checking small cases."""
+    dense = np.zeros(tuple(arrays["shape"]), dtype=arrays["data"].dtype)
+    rows = np.repeat(np.arange(dense.shape[0]), np.diff(arrays["indptr"]))
+    dense[rows, arrays["indices"]] = arrays["data"]
+    return dense
+
+
+def test_query_builder(engine_data):
+    """Chained Query steps combine filters, grouping and top-k, and match the fixed queries."""
+    comedy = mr.Query().genre("comedy")
+    assert comedy.execute().to_dict() == {"Movie Z": 5.0, "Movie X": 4.5, "Movie A": 4.0}
+    assert comedy.top(1).execute().index.tolist() == ["Movie Z"]
+    assert comedy.steps == (("genre", ("comedy",)),), "Chaining must not change the query it extends."
+    assert comedy.genre("ACTION").execute().index.tolist() == ["Movie Z", "Movie X"]
+    assert mr.Query().genre("Horror").execute() is None
+
+    assert mr.Query().raters_of("movie x").execute().to_dict() == {"Movie X": 4.5, "Movie Y": 4.0}
+    assert mr.Query().raters_of("Movie X").genre("Action").execute().to_dict() == {"Movie X": 4.5}
+    assert mr.Query().users([2, 4, 99]).min_ratings(2).execute().to_dict() == {"Movie Z": 5.0, "Movie A": 4.0}
+    assert mr.Query().movies(["movie a", " Movie  B"]).execute().to_dict() == {"Movie A": 4.0, "Movie B": 3.0}
+    unrated = mr.Query().users([1]).genre("Drama").include_unrated().execute()
+    assert unrated.index.tolist() == ["Movie B"] and np.isnan(unrated.iloc[0])
+
+    by_genre = mr.Query().ratings_between(4, 5).by_genre().execute()
+    assert by_genre.to_dict() == {"Comedy": 4.8, "Action": 4.75}
+    assert mr.Query().by_genre().top(2).execute().equals(mr.get_top_n_genres(2))
+    favourites = mr.user_favourites(4)
+    assert favourites[0].equals(mr.Query().users([4]).by_genre().execute())
+
+
+def test_background_load(dataset_files, tmp_path, monkeypatch):
+    """A background load publishes the files, reports its progress and keeps the old data on failure."""
+    movies_path, ratings_path = dataset_files
+    assert mr.estimate_rows(ratings_path) == 9 and mr.estimate_rows(str(tmp_path / "none.txt")) is None
+
+    mr.set_movies(mr.read_movies_file(movies_path).iloc[:1])
+    load = mr.BackgroundLoad(ratings_path=ratings_path)
+    load.future.result()
+    assert len(mr.rating_df) == 9 and len(mr.movies_df) == 1 and load.kinds == {"ratings"}
+    assert "finished" in load.status() and load.elapsed() >= 0
+
+    stages = []
+    mr.reload_datasets(movies_path, ratings_path, progress=lambda *step: stages.append(step)).result()
+    assert stages[0] == ("reading", 0) and stages[-1] == ("indexing", 9) and len(mr.movies_df) > 1
+    assert all(rows <= 9 for stage, rows in stages if stage == "reading")
+
+    load = mr.BackgroundLoad(ratings_path, ratings_path)
+    monkeypatch.setattr(mr, "pending_load", load)
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        load.future.exception()
+        assert mr.ready_for(("ratings",)) and mr.pending_load is None
+    assert "Validation Failed" in out.getvalue() and "loaded in" not in out.getvalue()
+    assert len(mr.rating_df) == 9 and len(mr.movies_df) > 1, "A failed load should keep the loaded data."
+
+
+def test_rating_sample(load_engine_data, tmp_path, monkeypatch):
+    """Reservoir samples keep their capacity, and estimate averages with intervals around the exact ones."""
+    rng = np.random.default_rng(0)
+    ratings = pd.DataFrame({"movie_name": [f"Movie {i}" for i in rng.zipf(1.5, 20_000) % 50],
+                            "rating": rng.integers(0, 11, 20_000) / 2, "user_id": rng.integers(1, 500, 20_000)})
+    uniform, stratified = mr.RatingsSample(1000, seed=1), mr.RatingsSample(20, stratified=True, seed=1)
+    for block in np.array_split(np.arange(len(ratings)), 7):
+        uniform.add(ratings.iloc[block])
+        stratified.add(movie_data.compact_ratings(ratings.iloc[block]))
+    sizes = ratings["movie_name"].value_counts()
+    kept = pd.Series(np.bincount(stratified.codes), index=stratified.titles)
+    assert len(uniform) == 1000 and uniform.rows_seen == 20_000 and uniform.rate() == 0.05
+    assert kept.equals(np.minimum(sizes, 20).reindex(kept.index)), "Each title should keep up to 20 ratings."
+    assert pd.Series(stratified.title_sizes, index=stratified.titles).equals(sizes.reindex(stratified.titles))
+
+    load_engine_data()
+    everything = mr.RatingsSample(100, stratified=True, seed=2)
+    everything.add(mr.rating_df)
+    mr.set_sample(everything)
+    genres = mr.get_approximate_top_n_genres(10)
+    assert np.allclose(genres["rating"], mr.get_top_n_genres(10)) and (genres["low"] == genres["high"]).all()
+    movies = mr.get_approximate_top_n_movies(10)
+    assert movies.index.equals(mr.get_top_n_movies(10).index) and (movies["sampled"] > 0).all()
+    assert mr.get_approximate_top_n_movies(3, "Comedy").index.tolist() == ["Movie Z", "Movie X", "Movie A"]
+    assert mr.get_approximate_top_n_movies(3, "Horror") is None
+
+    movies_path, ratings_path = str(tmp_path / "sample_movies.txt"), str(tmp_path / "sample_ratings.txt")
+    genres = np.array(["Action", "Comedy", "Drama"])
+    with open(movies_path, "w") as f:
+        f.writelines(f"{genres[i % 3]}|{i}|Movie {i}\n" for i in range(50))
+    ratings.to_csv(ratings_path, sep="|", header=False, index=False)
+    snapshots.load_datasets(movies_path, ratings_path)
+    exact = mr.get_top_n_genres(3)
+    widths = []
+    for sample in (mr.load_ratings_sample(ratings_path, rate=0.1, seed=3),
+                   mr.load_ratings_sample(ratings_path, per_title=50, seed=3)):
+        mr.set_sample(sample)
+        estimates = mr.get_approximate_top_n_genres(3, confidence=0.999).reindex(exact.index)
+        assert ((estimates["low"] <= exact) & (exact <= estimates["high"])).all()
+        assert sample.file_path == ratings_path
+        widths.append((estimates["high"] - estimates["low"]).max())
+    assert widths[0] < 0.6, "2,000 uniformly sampled ratings should pin genre averages down."
+    assert len(mr.rating_df) == 20_000, "Sampling should leave the loaded ratings alone."
+    mr.set_sample(None)
+
+    latin1_path, folder_path = str(tmp_path / "latin1.txt"), str(tmp_path / "folder.txt")
+    with open(latin1_path, "wb") as f:
+        f.write("Movie \u00e9|4|1\n".encode("latin-1"))
+    os.mkdir(folder_path)
+    messages = {}
+    for path, answers in ((latin1_path, ["u", ""]), (folder_path, ["u", ""]), (latin1_path, ["u", "lots"])):
+        monkeypatch.setattr(mr, "input", lambda prompt, answers=iter([path, *answers]): next(answers), raising=False)
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            mr.approximate_rankings()
+        messages[path, answers[1]] = out.getvalue()
+    assert "Error reading file" in messages[latin1_path, ""] and "Invalid number" not in messages[latin1_path, ""]
+    assert "Could not read" in messages[folder_path, ""]
+    assert "Invalid number" in messages[latin1_path, "lots"] and mr.rating_sample is None
+
 
 # RUN ALL TESTS
 
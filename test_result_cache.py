@@ -0,0 +1,69 @@
+import os
+import time
+
+import numpy as np
+
+import movie_data
+import movie_recommender as mr
+import result_cache
+import snapshots
+
+
+def test_result_cache(dataset_files, tmp_path, monkeypatch):
+    """Repeated queries on the same files come from the on-disk cache; changed files are recomputed."""
+    if not os.environ.get("MOVIE_RECOMMENDER_CACHE"):
+        assert result_cache.RESULT_CACHE_PATH is None, "The result cache must be opt-in."
+    movies_path, ratings_path = dataset_files
+    monkeypatch.setattr(result_cache, "RESULT_CACHE_PATH", str(tmp_path / "cache" / "results.sqlite"))
+
+    snapshots.load_datasets(movies_path, ratings_path)
+    cache = result_cache.result_cache()
+    expected = (mr.get_top_n_genres(5), mr.get_top_n_movies_genre("Comedy", n=2))
+    assert (cache.hits, cache.misses) == (0, 2)
+    # A new session: same files, nothing in memory but the loaded data
+    result_cache.result_caches.clear()
+    snapshots.load_datasets(movies_path, ratings_path)
+    cache = result_cache.result_cache()
+    snapshots.publish(snapshots.current_dataset.replace(genre_sums=None, genre_counts=None, genre_index={}))
+    actual = (mr.get_top_n_genres(5), mr.get_top_n_movies_genre("Comedy", 2))
+    assert actual[0].equals(expected[0]) and actual[1].equals(expected[1]) and cache.hits == 2
+
+    with open(ratings_path, "a") as f:
+        f.write("Movie A|0.5|5\n")
+    snapshots.load_datasets(movies_path, ratings_path)
+    assert mr.get_top_n_movies_genre("Comedy", 2).to_dict() == {"Movie Z": 5.0, "Movie X": 4.5}
+    assert cache.hits == 2 and cache.misses == 1
+    snapshots.set_ratings(snapshots.current_dataset.rating_df)
+    mr.get_top_n_genres(5)
+    assert (cache.hits, cache.misses) == (2, 1), "In-memory data must bypass the cache."
+
+    for module, setting, value in ((movie_data, "COMPACT_RATINGS", True), (snapshots, "DUPLICATE_POLICY", "last")):
+        with monkeypatch.context() as settings:
+            settings.setattr(module, setting, value)
+            snapshots.load_datasets(movies_path, ratings_path)
+            misses = cache.misses
+            mr.get_top_n_movies_genre("Comedy", 2)
+            assert cache.misses == misses + 1, f"{setting} must be part of the cache key."
+
+    read_datasets = snapshots.read_datasets
+
+    def read_then_append(*args, **kwargs):
+        loaded = read_datasets(*args, **kwargs)
+        with open(ratings_path, "a") as f:
+            f.write("Movie A|1.0|6\n")
+        return loaded
+
+    with monkeypatch.context() as changing:
+        changing.setattr(snapshots, "read_datasets", read_then_append)
+        snapshots.load_datasets(movies_path, ratings_path)
+    hits, misses = cache.hits, cache.misses
+    mr.get_top_n_genres(5)
+    assert snapshots.current_dataset.ratings_source is None and (cache.hits, cache.misses) == (hits, misses)
+
+    small = result_cache.ResultCache(str(tmp_path / "small.sqlite"), max_bytes=600)
+    for key in ("a", "b", "a", "c"):
+        if not small.get(key)[0]:
+            small.put(key, np.zeros(20))
+        time.sleep(0.01)
+    assert small.get("a")[0] and not small.get("b")[0] and small.get("c")[0]
+    assert small.size()[1] <= 600
@@ -0,0 +1,233 @@
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import movie_data
+import movie_recommender as mr
+import snapshots
+
+
+def test_genre_index(load_engine_data):
+    """Genre lookups go through the normalized index and load-time aggregates."""
+    dataset = load_engine_data("Action|Comedy|101|Movie Z\nAction|102|Movie X\nComedy|102|Movie X\n"
+                               "Comedy|104|Movie A\nDrama|105|Movie B\nsci fi|106|Movie C\nSci-Fi|107|Movie D\n")
+
+    assert snapshots.find_genre("  SCI FI ") == snapshots.find_genre("scifi")
+    assert snapshots.find_genre("Sci-Fi") != snapshots.find_genre("scifi")
+    assert dataset.genre_index["comedy"].tolist() == [0, 1, 2]
+
+    action = snapshots.find_genre("action")
+    assert dataset.genre_counts[action] == 4
+    assert dataset.genre_sums[action] == 19.0
+    assert mr.get_top_n_movies_genre(" aCtIoN", 1).index.tolist() == ["Movie Z"]
+
+    snapshots.set_ratings(dataset.rating_df[dataset.rating_df["user_id"] != 4])
+    assert snapshots.current_dataset.genre_counts[action] == 3, "Aggregates should follow a ratings reload."
+
+
+def test_partial_aggregates(engine_data, load_engine_data, tmp_path):
+    """Partials of any partitioning merge into the aggregates of the whole dataset."""
+    ratings = engine_data.rating_df
+    expected = (mr.get_top_n_movies(10), mr.get_top_n_genres(10), mr.get_top_n_movies_genre("Comedy", 10))
+    distributions = (mr.get_rating_distribution(movie_name="Movie B"),
+                     mr.get_rating_distribution(genre="Drama"), mr.get_rating_percentiles(genre="Comedy"),
+                     mr.get_top_n_movies_by_median(3), mr.get_top_n_movies_by_median(3, "action"))
+
+    whole = snapshots.PartialAggregates.from_ratings(ratings)
+    parts = [snapshots.PartialAggregates.from_ratings(ratings[ratings["user_id"] <= 2]),
+             snapshots.PartialAggregates.from_ratings(ratings[ratings["user_id"] == 3]),
+             snapshots.PartialAggregates.from_ratings(ratings[ratings["user_id"] >= 4])]
+    for merged in (snapshots.merge_partials(parts), parts[2].merge(parts[0]).merge(parts[1])):
+        for table in ("titles", "genres", "user_genres", "histograms"):
+            assert getattr(merged, table).equals(getattr(whole, table)), f"Merged {table} differ."
+
+    path = tmp_path / "partial.json"
+    whole.save(path)
+    restored = snapshots.PartialAggregates.load(path)
+    assert restored.user_genres.equals(whole.user_genres) and restored.titles.equals(whole.titles)
+    assert restored.histograms.equals(whole.histograms)
+    with pytest.raises(ValueError):
+        snapshots.PartialAggregates.from_json('{"format": "other"}')
+
+    snapshots.set_aggregates(restored)
+    assert snapshots.current_dataset.rating_df is None and snapshots.current_dataset.aggregates_only
+    for before, after in zip(expected, (mr.get_top_n_movies(10), mr.get_top_n_genres(10),
+                                        mr.get_top_n_movies_genre("Comedy", 10))):
+        assert before.index.tolist() == after.index.tolist()
+        assert np.allclose(before.to_numpy(), after.to_numpy(), equal_nan=True)
+    assert restored.preferred_genres(4) == ["Action", "Comedy"] and restored.preferred_genres(99) is None
+
+    snapshots.set_movies(engine_data.movies_df.copy())
+    after = (mr.get_rating_distribution(movie_name="Movie B"),
+             mr.get_rating_distribution(genre="Drama"), mr.get_rating_percentiles(genre="Comedy"),
+             mr.get_top_n_movies_by_median(3), mr.get_top_n_movies_by_median(3, "action"))
+    for before, now in zip(distributions, after):
+        assert before.index.tolist() == now.index.tolist()
+        assert np.allclose(before.to_numpy(), now.to_numpy(), equal_nan=True)
+    assert snapshots.current_dataset.aggregates_only and mr.get_top_n_genres(10).equals(expected[1])
+
+    assert mr.ratings_loaded(need_movies=True)
+    assert not mr.ratings_loaded(need_movies=True, need_rows=True)
+    load_engine_data()
+    assert snapshots.current_dataset.aggregates_only is None and mr.ratings_loaded(need_rows=True)
+
+
+def test_load_datasets(dataset_files):
+    """Both files load concurrently into the same state as loading them one by one."""
+    movies_path, ratings_path = dataset_files
+    snapshots.set_movies(movie_data.read_movies_file(movies_path))
+    snapshots.set_ratings(movie_data.read_ratings_file(ratings_path))
+    expected = (mr.get_top_n_genres(10), mr.get_top_n_movies_genre("Comedy", 10), mr.get_preferred_genres(4))
+    snapshots.set_movies(snapshots.current_dataset.movies_df.iloc[:1])
+    snapshots.set_ratings(snapshots.current_dataset.rating_df.iloc[:1])
+
+    movies, ratings = snapshots.load_datasets(movies_path, ratings_path)
+    dataset = snapshots.current_dataset
+    assert movies is dataset.movies_df and ratings is dataset.rating_df and len(ratings) == 9
+    actual = (mr.get_top_n_genres(10), mr.get_top_n_movies_genre("Comedy", 10), mr.get_preferred_genres(4))
+    assert actual[0].equals(expected[0]) and actual[1].equals(expected[1]) and actual[2] == expected[2]
+
+    with pytest.raises(movie_data.DatasetValidationError):
+        snapshots.load_datasets(ratings_path, ratings_path)
+    assert snapshots.current_dataset is dataset, "A failed load should keep the loaded data."
+
+
+def test_dataset_snapshots(engine_data, dataset_files, write_dataset, monkeypatch):
+    """Reloads publish whole new snapshots; concurrent readers only ever see one of them."""
+    snapshot = engine_data
+    with pytest.raises(AttributeError):
+        snapshot.rating_df = None
+    assert not snapshot.movie_sums.flags.writeable and mr.movie_sums is snapshot.movie_sums
+    assert mr.current_dataset is snapshots.current_dataset, "The menu globals should mirror the published snapshot."
+
+    with open(dataset_files[1]) as f:
+        lines = f.read().splitlines()[:6]
+    reversed_content = "".join(f"{name}|{5.5 - float(rating)}|{user}\n"
+                               for name, rating, user in (line.split("|") for line in lines))
+    paths = [dataset_files[1], write_dataset("reversed_ratings.txt", reversed_content)]
+    expected = []
+    for path in paths:
+        snapshots.reload_datasets(ratings_path=path).result()
+        expected.append([mr.get_top_n_movies_genre("Comedy", 10).to_dict(), mr.get_top_n_genres(10).to_dict()])
+
+    answers = []
+    stop = threading.Event()
+
+    def read():
+        while not stop.is_set():
+            answers.append((0, mr.get_top_n_movies_genre("Comedy", 10).to_dict()))
+            answers.append((1, mr.get_top_n_genres(10).to_dict()))
+
+    # Switch threads often so that reads overlap the swaps
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)
+    readers = [threading.Thread(target=read) for _ in range(2)]
+    for reader in readers:
+        reader.start()
+    versions = [snapshots.current_dataset.version]
+    for i in range(40):
+        versions.append(snapshots.reload_datasets(ratings_path=paths[i % 2]).result().version)
+        snapshots.append_ratings(movie_data.clean_ratings(pd.DataFrame({"movie_name": ["Movie Q"], "rating": [1.0],
+                                                                        "user_id": [9]})))
+    stop.set()
+    for reader in readers:
+        reader.join()
+    sys.setswitchinterval(switch_interval)
+    assert answers and all(answer in (expected[0][query], expected[1][query]) for query, answer in answers), \
+        "A reader saw a mixed snapshot."
+    assert versions == sorted(set(versions)), "Versions should grow with every publish."
+
+    # A publish that lands mid-query (here: reversed ratings, published from inside the genre
+    # lookup) does not reach the query, which reads every field from the snapshot it started on
+    expected_comedy = mr.get_top_n_movies_genre("Comedy", 10).to_dict()
+    ratings = snapshots.current_dataset.rating_df
+    flipped = ratings.assign(rating=5.5 - ratings["rating"])
+    reversed_dataset = snapshots.dataset_with(snapshots.current_dataset, ratings=flipped)
+    normalize_genre = mr.normalize_genre
+
+    def publish_midway(genre):
+        monkeypatch.setattr(mr, "normalize_genre", normalize_genre)
+        snapshots.publish(reversed_dataset)
+        return normalize_genre(genre)
+
+    monkeypatch.setattr(mr, "normalize_genre", publish_midway)
+    assert mr.get_top_n_movies_genre("Comedy", 10).to_dict() == expected_comedy
+    assert snapshots.current_dataset is reversed_dataset and mr.current_dataset is reversed_dataset
+    assert mr.get_top_n_movies_genre("Comedy", 10).to_dict() != expected_comedy
+    assert not hasattr(mr, "consistent_read")
+
+    current = snapshots.current_dataset
+    with pytest.raises(movie_data.DatasetValidationError):
+        snapshots.reload_datasets(movies_path=paths[0]).result()
+    assert snapshots.current_dataset is current and len(snapshot.rating_df) == 9
+
+
+def test_duplicate_ratings(tmp_path, monkeypatch):
+    """Repeated (user, movie) ratings are resolved by policy at load, across blocks and on append."""
+    ratings = pd.DataFrame({"movie_name": ["Toy Story (1995)", "Heat (1995)", "toy story (1995) ", "Toy Story (1995)"],
+                            "rating": [4.5, 3.0, 0.0, 2.0], "user_id": [7, 7, 7, 8]})
+    expected = {"first": 4.5, "last": 0.0, "mean": 2.25, "max": 4.5}
+    snapshots.set_ratings(ratings)
+    dataset = snapshots.current_dataset
+    assert len(dataset.rating_df) == 4 and dataset.duplicate_ratings is None, \
+        "The default policy should keep every rating."
+    for policy, value in expected.items():
+        monkeypatch.setattr(snapshots, "DUPLICATE_POLICY", policy)
+        snapshots.set_ratings(ratings)
+        dataset = snapshots.current_dataset
+        kept = dataset.rating_df[dataset.rating_df["user_id"] == 7].set_index("movie_name")["rating"]
+        assert dataset.duplicate_ratings == 1 and len(dataset.rating_df) == 3
+        assert kept.filter(like="tory (1995)").tolist() == [value], f"'{policy}' kept {kept.tolist()}."
+
+    rng = np.random.default_rng(0)
+    many = pd.DataFrame({"movie_name": rng.choice(["A", "B", "C", "D"], 2000), "rating": rng.integers(0, 11, 2000) / 2,
+                         "user_id": rng.integers(1, 60, 2000)})
+    grouped = many.groupby(["user_id", "movie_name"])["rating"]
+    path = tmp_path / "ratings.txt"
+    many.to_csv(path, sep="|", header=False, index=False)
+    for policy, compact in [("mean", False), ("max", True)]:
+        monkeypatch.setattr(snapshots, "DUPLICATE_POLICY", policy)
+        snapshots.set_ratings(movie_data.read_ratings_file(path, chunksize=300, compact=compact))
+        dataset = snapshots.current_dataset
+        resolved = pd.Series(movie_data.rating_values(dataset.rating_df),
+                             index=pd.MultiIndex.from_arrays([dataset.rating_df["user_id"].astype("int64"),
+                                                              dataset.rating_df["movie_name"].astype(str)]))
+        assert np.allclose(resolved.sort_index(), grouped.agg(policy)), f"'{policy}' across blocks"
+        assert dataset.duplicate_ratings == len(many) - grouped.ngroups
+    for policy in expected:
+        for compact in (False, True):
+            whole = snapshots.resolve_duplicates(movie_data.read_ratings_file(path, compact=compact), policy)
+            resolver = snapshots.DuplicateResolver(policy)
+            streamed = movie_data.read_ratings_file(path, chunksize=137, compact=compact, resolver=resolver)
+            _, duplicates, pairs = resolver.result()
+            assert duplicates == whole[1] == len(many) - grouped.ngroups
+            assert np.array_equal(movie_data.rating_values(streamed), movie_data.rating_values(whole[0])), \
+                f"'{policy}' streamed"
+            assert (pairs.find(snapshots.rating_pair_keys(streamed))[0] == np.arange(len(streamed))).all()
+
+    with monkeypatch.context() as colliding:
+        # Every user's rating of a movie now hashes alike: pairs must still be told apart
+        colliding.setattr(snapshots, "PAIR_HASH_MIX", np.uint64(0))
+        for policy in expected:
+            resolved, duplicates, pairs = snapshots.resolve_duplicates(many, policy)
+            assert duplicates == len(many) - grouped.ngroups, f"'{policy}' merged colliding pairs"
+            assert (pairs.find(snapshots.rating_pair_keys(resolved))[0] == np.arange(len(resolved))).all()
+            assert pairs.find(snapshots.rating_pair_keys(many.assign(user_id=1000)))[0].max() == -1
+
+    for policy in expected:
+        monkeypatch.setattr(snapshots, "DUPLICATE_POLICY", policy)
+        snapshots.set_ratings(many.iloc[:500])
+        for start in range(500, len(many), 300):
+            snapshots.append_ratings(many.iloc[start:start + 300])
+        dataset = snapshots.current_dataset
+        appended = dataset.rating_df.groupby(["user_id", "movie_name"])["rating"].agg(["first", "size"])
+        assert (appended["size"] == 1).all() and dataset.duplicate_ratings == len(many) - grouped.ngroups
+        assert np.allclose(appended["first"], grouped.agg(policy)), f"'{policy}' over appends"
+        snapshots.set_ratings(dataset.rating_df.copy())
+        assert np.allclose(snapshots.current_dataset.title_totals.sort_index(), dataset.title_totals.sort_index())
+        assert dataset.movies_df is None or np.allclose(snapshots.current_dataset.movie_sums, dataset.movie_sums)
+    with pytest.raises(ValueError):
+        snapshots.resolve_duplicates(ratings, "median")